@@ -0,0 +1,82 @@
+""" Two concurrent WebSocket streams of one tree in the asynchronous server
+(needs aiohttp). Every stream must get all the primitives of its region.
+
+    python experiments/test_streams.py
+"""
+import asyncio
+import json
+import multiprocessing
+import random
+
+from smartview import async_server, geometry, wire
+from smartview.ctree import Tree
+from smartview.main import TreeImage
+from smartview.region_cache import RegionCache
+from smartview.style import TreeStyle
+
+PORT = 8125
+SCENES = [[1, 0, 0, 20000, 50000], [2, 0, 1000, 20000, 50000]]
+
+
+def get_tree_image():
+    random.seed(3)
+    t = Tree()
+    t.populate(100000, random_branches=True)
+    ts = TreeStyle()
+    ts.mode = "r"
+    return TreeImage(t, ts)
+
+def serve():
+    async_server.start_async_server(get_tree_image(), port=PORT, workers=2)
+
+
+async def stream(session, scene, client):
+    """Number of batches received, and of primitives of each section."""
+    import aiohttp
+    url = "http://localhost:%d/stream?client=%s" % (PORT, client)
+    async with session.ws_connect(url) as ws:
+        await ws.send_str(json.dumps({"seq": 1, "scene": scene, "format": "bin"}))
+        nbatches, counts = 0, {}
+        while True:
+            msg = await ws.receive(timeout=60)
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                assert json.loads(msg.data)["batches"] == nbatches
+                return nbatches, counts
+            _, sections = wire.decode_scene(msg.data)
+            for kind, (coords, ids) in sections.items():
+                counts[kind] = counts.get(kind, 0) + len(coords)
+            nbatches += 1
+            await ws.send_str(json.dumps({"seq": 1, "ack": nbatches}))
+
+async def check_streams():
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        for _ in range(300):
+            try:
+                async with session.get("http://localhost:%d/trees" % PORT) as r:
+                    if r.status == 200:
+                        break
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.5)
+        results = await asyncio.gather(stream(session, SCENES[0], "a"),
+                                       stream(session, SCENES[1], "b"))
+
+    tree_image = get_tree_image()
+    for scene, (nbatches, counts) in zip(SCENES, results):
+        region = RegionCache().get_region(tree_image, *scene, "tree")
+        full = geometry.get_scene_geometry(tree_image, *region[1:])
+        assert counts["hzln"] == len(full.hz_lines)
+        assert counts["vtln"] == len(full.vt_lines)
+        assert counts["rect"] == len(full.rects)
+        assert counts["anch"] == len(full.anchors)
+        print("scene %s: %d batches, %s" % (scene, nbatches, counts))
+
+
+if __name__ == "__main__":
+    server = multiprocessing.Process(target=serve)
+    server.start()
+    try:
+        asyncio.run(check_streams())
+    finally:
+        server.terminate()
+        server.join()
@@ -67,6 +67,9 @@ var Data = function () {
   this.hello = "texto";
   this.draw = draw_scene;
   this.zoom_factor = 2;
+  this.binary = true;  // binary responses (JSON ones are easier to debug)
+  this.delta = true;  // when panning, only ask for what was not drawn yet
+  this.stream = true;  // stream regions in batches (with --async_server)
 };
 mydata = new Data();
 
@@ -151,6 +154,174 @@ document.body.addEventListener("wheel", event => {
 }, {passive: false});
 
 
+// color names or codes (as in node styles) to PIXI colors
+var colors = {};
+const color_ctx = document.createElement("canvas").getContext("2d");
+
+function get_color(name) {
+  if (!(name in colors)) {
+    color_ctx.fillStyle = "#000000";
+    color_ctx.fillStyle = name;
+    colors[name] = PIXI.utils.string2hex(color_ctx.fillStyle);
+  }
+  return colors[name];
+}
+
+// Decodes a scene region in the binary format of smartview/wire.py: a
+// header with JSON metadata, and sections of float32 coordinates (relative to
+// metadata.origin) followed by uint16 or uint32 style ids, aligned to 4 bytes
+// (typed arrays read them in the platform byte order, little endian)
+function decode_scene(buffer) {
+  const view = new DataView(buffer);
+  const pad4 = n => n + (4 - n % 4) % 4;
+  const tag = offset => String.fromCharCode(...new Uint8Array(buffer, offset, 4));
+  if (tag(0) != "STV1")
+    throw new Error("not an encoded scene");
+
+  const meta_len = view.getUint32(4, true);
+  const meta = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, meta_len)));
+  const sections = {};
+  let offset = 8 + pad4(meta_len);
+  while (offset < buffer.byteLength) {
+    const kind = tag(offset);
+    const count = view.getUint32(offset + 4, true);
+    const ncols = view.getUint32(offset + 8, true);
+    const idsize = view.getUint32(offset + 12, true);
+    offset += 16;
+    const coords = new Float32Array(buffer, offset, count * ncols);
+    offset += count * ncols * 4;
+    const ids = idsize == 2 ? new Uint16Array(buffer, offset, count)
+                            : new Uint32Array(buffer, offset, count);
+    offset += pad4(count * idsize);
+    sections[kind] = { count: count, ncols: ncols, coords: coords, ids: ids };
+  }
+  return { meta: meta, sections: sections };
+}
+
+function draw_items(graphics, items) {
+  items.forEach(item => {
+    if (item["0"] == "r") {
+      graphics.lineStyle(1, 0xc1d6f7, 1, 0, false, "square");
+      graphics.drawRect(item[1], item[2], item[3], item[4]);
+    } else if (item["0"] == "l") {
+      graphics.lineStyle(1, get_color(item[5]), 1, 1, false, "square");
+      graphics.moveTo(item[1], item[2]);
+      graphics.lineTo(item[3], item[4]);
+    } else if (item["0"] == "a") {
+      draw_arc(graphics, item[1], item[2], item[3], item[4], item[5], get_color(item[6]));
+    }
+  });
+}
+
+// cx, cy, radius, start and end angles (clockwise radians)
+function draw_arc(graphics, cx, cy, r, a0, a1, color) {
+  graphics.lineStyle(1, color, 1, 1, false, "square");
+  graphics.moveTo(cx + r * Math.cos(a0), cy + r * Math.sin(a0));
+  graphics.arc(cx, cy, r, a0, a1);
+}
+
+function draw_decoded_scene(graphics, scene) {
+  const [ox, oy] = scene.meta.origin;
+  const draw_lines = (section, colors) => {
+    const c = section.coords;
+    for (let i = 0; i < section.count; i++) {
+      graphics.lineStyle(1, get_color(colors[section.ids[i]]), 1, 1, false, "square");
+      graphics.moveTo(ox + c[4*i], oy + c[4*i + 1]);
+      graphics.lineTo(ox + c[4*i + 2], oy + c[4*i + 3]);
+    }
+  };
+  draw_lines(scene.sections["vtln"], scene.meta.vt_colors);
+  draw_lines(scene.sections["hzln"], scene.meta.hz_colors);
+
+  const arcs = scene.sections["arcs"];
+  for (let i = 0, c = arcs.coords; i < arcs.count; i++)
+    draw_arc(graphics, ox + c[5*i], oy + c[5*i + 1], c[5*i + 2], c[5*i + 3], c[5*i + 4],
+             get_color(scene.meta.vt_colors[arcs.ids[i]]));
+
+  const rects = scene.sections["rect"];
+  graphics.lineStyle(1, 0xc1d6f7, 1, 0, false, "square");
+  for (let i = 0, c = rects.coords; i < rects.count; i++)
+    graphics.drawRect(ox + c[4*i], oy + c[4*i + 1], c[4*i + 2], c[4*i + 3]);
+}
+
+// Every request has a growing sequence number, so that the server can drop
+// the ones made obsolete by newer viewports (answered with 204, No Content),
+// and responses arriving after a newer one are not drawn
+const client_id = Math.random().toString(36).slice(2);
+var last_seq = 0;
+var drawn_seq = 0;
+
+// Responses are drawn in their own graphics, kept while their bounds overlap
+// the region of the last response drawn. known_id is the id of the region
+// whose primitives are all drawn, sent to get only the new ones when panning
+// (see smartview/server.py)
+var chunks = [];
+var known_id = null;
+
+function clear_chunks(keep) {
+  chunks = chunks.filter(chunk => {
+    const b = chunk.bounds;
+    if (keep && b && b[0] < keep[0] + keep[2] && b[2] > keep[0] &&
+        b[1] < keep[1] + keep[3] && b[3] > keep[1])
+      return true;
+    tree_scene.removeChild(chunk.graphics);
+    chunk.graphics.destroy();
+    return false;
+  });
+}
+
+function add_chunk(bounds, draw) {
+  const chunk = { graphics: new PIXI.Graphics(), bounds: bounds };
+  draw(chunk.graphics);
+  tree_scene.addChild(chunk.graphics);
+  chunks.push(chunk);
+}
+
+function draw_chunk(info, draw) {
+  clear_chunks(info.delta ? info.region : null);
+  add_chunk(info.bounds, draw);
+  known_id = info.region_id;
+}
+
+// region ids start with their zoom
+function can_ask_delta() {
+  return mydata.delta && known_id && parseFloat(known_id) == mydata.zoom_factor;
+}
+
+// With the asynchronous server, regions can come through a WebSocket in
+// batches, coarse first (see smartview/async_server.py). Every batch drawn is
+// acknowledged, and the server stops sending the ones of old viewports
+var socket = null;
+var stream_seq = 0;
+
+function open_stream() {
+  const ws = new WebSocket((location.protocol == "https:" ? "wss://" : "ws://") +
+                           location.host + "/stream?client=" + client_id);
+  ws.binaryType = "arraybuffer";
+  ws.onopen = () => { socket = ws; };
+  ws.onclose = () => { socket = null; };
+  ws.onmessage = event => draw_stream_message(event.data);
+}
+
+function draw_stream_message(data) {
+  const binary = typeof data != "string";
+  const scene = binary ? decode_scene(data) : null;
+  const info = binary ? scene.meta : JSON.parse(data);
+  if (info.seq != stream_seq || info.seq < drawn_seq)
+    return;
+  if (info.done) {
+    known_id = info.region_id;
+    return;
+  }
+  if (info.batch == 0) {
+    drawn_seq = info.seq;
+    clear_chunks(null);
+    known_id = null;
+  }
+  add_chunk(info.bounds, g => binary ? draw_decoded_scene(g, scene) : draw_items(g, info.items));
+  socket.send(JSON.stringify({ seq: info.seq, ack: info.batch + 1 }));
+}
+
 function draw_scene() {
   gui.__controllers.forEach(c => c.updateDisplay());
 
@@ -159,21 +330,39 @@ function draw_scene() {
     "" + mydata.zoom_factor + "," + r[0] + "," + r[1] + "," + r[2] + "," + r[3];
 
   console.log(query);
-  fetch("/get_scene_region/" + query + "/")
-    .then(response => response.json())
+  const binary = mydata.binary;
+  const seq = ++last_seq;
+  if (mydata.stream && socket && !can_ask_delta()) {
+    stream_seq = seq;
+    socket.send(JSON.stringify({ seq: seq, scene: [mydata.zoom_factor].concat(r),
+                                 format: binary ? "bin" : "json" }));
+    return;
+  }
+  stream_seq = 0;
+  const known = can_ask_delta() ? known_id : null;
+  const params = "?client=" + client_id + "&seq=" + seq + (binary ? "&format=bin" : "") +
+                 (known ? "&known=" + encodeURIComponent(known) : "");
+  fetch("/get_scene_region/" + query + "/" + params)
+    .then(response => {
+      if (response.status == 204)
+        return null;
+      return binary ? response.arrayBuffer() : response.json();
+    })
     .then(data => {
-      graphics.clear();
-
-      data.items.forEach(item => {
-        if (item["0"] == "r") {
-          graphics.lineStyle(1, 0xc1d6f7, 1, 0, false, "square");
-          graphics.drawRect(item[1], item[2], item[3], item[4]);
-        } else if (item["0"] == "l") {
-          graphics.lineStyle(1, 0x000000, 1, 1, false, "square");
-          graphics.moveTo(item[1], item[2]);
-          graphics.lineTo(item[3], item[4]);
-        }
-      });
+      if (data === null || seq < drawn_seq)
+        return;
+      const scene = binary ? decode_scene(data) : null;
+      const info = binary ? scene.meta : data;
+      // a delta is only good on top of what it was asked for
+      if (info.delta && known != known_id) {
+        draw_scene();
+        return;
+      }
+      drawn_seq = seq;
+      if (binary)
+        draw_chunk(info, g => draw_decoded_scene(g, scene));
+      else
+        draw_chunk(info, g => draw_items(g, data.items));
     })
     .catch(function (error) {
       console.log(error);
@@ -187,6 +376,9 @@ var gui = new dat.GUI();
 gui.add(mydata, "hello");
 gui.add(mydata, "draw");
 gui.add(mydata, "zoom_factor");
+gui.add(mydata, "binary");
+gui.add(mydata, "delta");
+gui.add(mydata, "stream");
 //gui.add(app, "antialias");
 
 const gra = new PIXI.Graphics();
@@ -205,6 +397,7 @@ console.log(sprite);
 app.stage.addChild(sprite);
 //app.stage.addChild(gra);
 
+open_stream();
 draw_scene();
 
 // app.ticker.add(() => {
@@ -0,0 +1,443 @@
+""" Asynchronous web server (needs aiohttp).
+
+Scene regions are rendered by a pool of worker processes, so that the event
+loop keeps answering while they work. Clients tag their requests with an id
+and a sequence number that grows with every new viewport (?client=...&seq=N),
+and only the newest request of each client (for each tree) is answered: when
+a newer one arrives, the older ones still waiting for a worker are cancelled
+and the ones being rendered are dropped when done, and the ones arriving after
+a newer one are not rendered (nor read from the cache) at all. All of them are
+answered with 204 (No Content). Requests without client id or sequence number
+are always answered.
+
+Rendered regions are kept in a RegionCache (see region_cache), so workers only
+get the requests for regions not seen before. With a prefetch budget, the
+regions likely to be requested next (see prefetch) are rendered after every
+request, one at a time, until a new request arrives, in a worker of their own
+with the lowest priority.
+
+Several trees can be served from a TreeRegistry (see tree_registry). The server
+loads a tree in a thread the first time it is requested, and then forks the
+workers again, so that they share all the loaded trees (copy-on-write) and the
+memory budget of the registry holds for all of them.
+
+Scene regions can also be streamed through a WebSocket (/stream, or
+/trees/<tree id>/stream), in batches from coarse to fine (see
+geometry.get_scene_batches) so that clients draw something before the whole
+region is ready. Clients send the viewports as {"seq": N, "scene": [zoom, x, y,
+w, h], "format": "bin"} and acknowledge every batch drawn with {"seq": N,
+"ack": <batches drawn>}: only STREAM_WINDOW batches are sent ahead of the
+acknowledgements, and a new viewport cancels the batches left of the previous
+one. Each batch is a scene region (in the format asked, with its "seq" and
+"batch" number), and the last one is followed by {"seq": N, "done": true,
+"batches": <count>, ...} with the region info (see server). Batches are
+rendered by the workers, as the requests of the client given in the URL
+(?client=...), whose newer requests make them obsolete, and the whole region
+is kept in the cache when complete.
+"""
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+
+from . import geometry, region_cache, server, tiles, tree_registry, prefetch
+
+import logging
+logger = logging.getLogger("smartview")
+
+# tree registry of the worker processes (inherited from the server on fork)
+_registry = None
+
+
+def _init_worker(registry):
+    global _registry
+    _registry = registry
+
+def _init_prefetch_worker(registry):
+    _init_worker(registry)
+    os.nice(19)  # requests go first
+
+def _render(tree_id, zoom, x, y, w, h):
+    return geometry.get_scene_geometry(_registry.get(tree_id), zoom, x, y, w, h)
+
+def _render_delta(tree_id, qzoom, zoom, x, y, w, h, known):
+    return region_cache.get_scene_delta(_registry.get(tree_id), qzoom, zoom, x, y, w, h, known)
+
+def _get_batches(tree_id, zoom, x, y, w, h):
+    return geometry.get_scene_batches(_registry.get(tree_id), zoom, x, y, w, h)
+
+def _render_batch(tree_id, zoom, batch):
+    return geometry.make_scene_geometry(_registry.get(tree_id), zoom, *batch)
+
+def _render_tile(tree_id, z, x, y, fmt):
+    return tiles.render_tile(_registry.get(tree_id), z, x, y, fmt)
+
+
+class SceneRenderer(object):
+    """Renders scene regions in worker processes, keeping only the newest
+    request of each client, and prefetches regions with a fraction
+    prefetch_budget of the time of one more worker, of the lowest priority
+    (so that a prefetch still running never holds back a request).
+
+    Workers are forked again whenever the trees loaded in the server, or
+    their versions, change: they only render the trees (and node styles) of
+    the server, shared copy-on-write, and never load their own copies.
+    """
+    def __init__(self, registry, workers=1, prefetch_budget=0):
+        self.registry = registry
+        self.workers = max(1, workers)
+        self.executor = None
+        self.prefetch_executor = None
+        self.workers_state = None
+        self.restarts = 0
+        self.latest = {}   # (client, tree id) -> newest sequence number
+        self.pending = {}  # (client, tree id) -> {future: sequence number}
+        self.rendered = 0
+        self.dropped = 0
+        self.prefetch_budget = prefetch_budget
+        self.prefetching = None
+        self.prefetched = 0
+        self.prefetch_cancelled = 0
+
+    def get_registry_state(self):
+        """Version of every tree loaded in the server."""
+        return {tid: region_cache.get_version(tree_image)
+                for tid, tree_image in self.registry.loaded().items()}
+
+    def get_executor(self, prefetching=False):
+        """Executor with workers forked from the current state of the server
+        (the one for prefetching, or the one for requests)."""
+        state = self.get_registry_state()
+        if state != self.workers_state:
+            if self.executor is not None:
+                self.restarts += 1
+            self.close(wait=False)  # their running jobs still finish
+            context = multiprocessing.get_context("fork")
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=context,
+                initializer=_init_worker, initargs=(self.registry,))
+            if self.prefetch_budget > 0:
+                self.prefetch_executor = concurrent.futures.ProcessPoolExecutor(
+                    1, mp_context=context,
+                    initializer=_init_prefetch_worker, initargs=(self.registry,))
+            self.workers_state = state
+        return self.prefetch_executor if prefetching else self.executor
+
+    def close(self, wait=True):
+        for executor in [self.executor, self.prefetch_executor]:
+            if executor is not None:
+                executor.shutdown(wait=wait, cancel_futures=wait)
+
+    def is_newest(self, key, seq):
+        """Returns False (and counts it as dropped) if a request with the same
+        key ((client, tree id)) and a higher sequence number was seen, and
+        otherwise records seq as the newest one, cancelling the older
+        requests still waiting for a worker. Requests without key or seq are
+        always the newest."""
+        if key is None or seq is None:
+            return True
+        if seq < self.latest.get(key, seq):
+            self.dropped += 1
+            return False
+        self.latest[key] = seq
+        for previous, previous_seq in self.pending.get(key, {}).items():
+            if previous_seq < seq:
+                previous.cancel()
+        return True
+
+    async def render(self, key, seq, func, *args):
+        """Returns func(*args) (the SceneGeometry of a scene rect), or None if
+        a newer request with the same key made it obsolete (see is_newest).
+
+        Only requests still queued for a worker can be cancelled: a render
+        already running finishes, and its result is dropped."""
+        loop = asyncio.get_running_loop()
+        if key is None or seq is None:
+            result = await loop.run_in_executor(self.get_executor(), func, *args)
+            self.rendered += 1
+            return result
+
+        if not self.is_newest(key, seq):
+            return None
+        pending = self.pending.setdefault(key, {})
+        future = loop.run_in_executor(self.get_executor(), func, *args)
+        pending[future] = seq
+        try:
+            result = await future
+        except asyncio.CancelledError:
+            if self.latest[key] > seq and future.cancelled():
+                self.dropped += 1
+                return None
+            raise  # the request itself was cancelled
+        finally:
+            del pending[future]
+            if not pending:
+                del self.pending[key]
+        if self.latest[key] > seq:  # it was already running
+            self.dropped += 1
+            return None
+        self.rendered += 1
+        return result
+
+    def prefetch(self, cache, tree_image, tree_id, zoom, x, y, w, h):
+        """Starts prefetching into cache the regions likely to be requested
+        after the scene rect."""
+        if self.prefetch_budget > 0:
+            self.cancel_prefetch()
+            self.prefetching = asyncio.ensure_future(
+                self._prefetch(cache, tree_image, tree_id, zoom, x, y, w, h))
+
+    def cancel_prefetch(self):
+        if self.prefetching is not None and not self.prefetching.done():
+            self.prefetching.cancel()
+            self.prefetch_cancelled += 1
+
+    async def _prefetch(self, cache, tree_image, tree_id, zoom, x, y, w, h):
+        loop = asyncio.get_running_loop()
+        for region in prefetch.get_missing_regions(cache, tree_image, tree_id,
+                                                   zoom, x, y, w, h):
+            t0 = time.time()
+            scene = await loop.run_in_executor(self.get_executor(prefetching=True),
+                                               _render, tree_id, *region[1:])
+            cache.put(region, scene)
+            self.prefetched += 1
+            await asyncio.sleep(prefetch.get_rest(time.time() - t0, self.prefetch_budget))
+
+    def stats(self):
+        return {"rendered": self.rendered, "dropped": self.dropped,
+                "prefetched": self.prefetched, "prefetch_cancelled": self.prefetch_cancelled,
+                "worker_restarts": self.restarts}
+
+    async def render_tile(self, tree_id, z, x, y, fmt):
+        """Tile z/x/y in the given format (see tiles.render_tile)."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), _render_tile,
+                                          tree_id, z, x, y, fmt)
+
+
+STREAM_WINDOW = 4  # batches sent ahead of the acknowledgements of the client
+
+
+class SceneStream(object):
+    """Scene regions of a tree sent through a WebSocket in batches, for the
+    newest viewport only. Batches are rendered by the workers of renderer,
+    as the requests of client (or of this stream, if None)."""
+    def __init__(self, ws, tree_image, cache, tree_id, renderer, client=None):
+        self.ws = ws
+        self.tree_image = tree_image
+        self.cache = cache
+        self.tree_id = tree_id
+        self.renderer = renderer
+        self.key = (id(self) if client is None else client, tree_id)
+        self.task = None
+        self.seq = None
+        self.acked = 0
+        self.acked_event = asyncio.Event()
+
+    def request(self, seq, zoom, x, y, w, h, fmt="bin"):
+        """Starts sending the scene rect, cancelling the previous one."""
+        self.cancel()
+        self.seq, self.acked = seq, 0
+        self.task = asyncio.ensure_future(self.send(seq, zoom, x, y, w, h, fmt))
+
+    def ack(self, seq, count):
+        if seq == self.seq:
+            self.acked = max(self.acked, count)
+            self.acked_event.set()
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def send(self, seq, zoom, x, y, w, h, fmt):
+        try:
+            await self._send(seq, zoom, x, y, w, h, fmt)
+        except ConnectionError:
+            pass  # the client is gone
+
+    async def _send(self, seq, zoom, x, y, w, h, fmt):
+        region = self.cache.get_region(self.tree_image, zoom, x, y, w, h, self.tree_id)
+        scene = self.cache.get(region, zoom)
+        if scene is not None:
+            await self.send_batch(seq, 0, scene, (x, y), fmt)
+            nbatches = 1
+        else:
+            render = self.renderer.render
+            batches = await render(self.key, seq, _get_batches, self.tree_id, *region[1:])
+            if batches is None:
+                return  # a newer viewport of the client is being streamed
+            parts = []
+            for batch in batches:
+                part = await render(self.key, seq, _render_batch, self.tree_id,
+                                    region.zoom, batch)
+                if part is None:
+                    return
+                while len(parts) - self.acked >= STREAM_WINDOW:
+                    self.acked_event.clear()
+                    await self.acked_event.wait()
+                await self.send_batch(seq, len(parts),
+                                      region_cache.rescale_scene(part, zoom / region.zoom),
+                                      (x, y), fmt)
+                parts.append(part)
+            scene = geometry.join_scenes(parts)
+            self.cache.put(region, scene)
+            scene = region_cache.rescale_scene(scene, zoom / region.zoom)
+            nbatches = len(parts)
+
+        info = server.get_region_info(self.tree_image, scene, zoom, (x, y, w, h))
+        await self.ws.send_str(json.dumps(dict(info, seq=seq, done=True, batches=nbatches)))
+
+    async def send_batch(self, seq, batch, scene, origin, fmt):
+        info = {"seq": seq, "batch": batch,
+                "bounds": scene.bounds[0].tolist() if len(scene.bounds) else None}
+        _, body = server.encode_scene_region(self.tree_image, scene, origin, fmt, info)
+        if fmt == "bin":
+            await self.ws.send_bytes(body)
+        else:
+            await self.ws.send_str(body)
+
+
+def start_async_server(trees, host="localhost", port=8090, workers=1, cache_mb=128,
+                       tree_id="tree", tiles_dir=None, prefetch_budget=0):
+    """Serves trees, a TreeImage (with id tree_id) or a TreeRegistry.
+    Requests without a tree id (/get_scene_region/...) go to tree_id."""
+    from aiohttp import web, WSMsgType
+
+    registry = tree_registry.as_registry(trees, tree_id)
+    renderer = SceneRenderer(registry, workers, prefetch_budget)
+    cache = region_cache.RegionCache(cache_mb)
+    loading = {}  # tree id -> future of the tree being loaded
+
+    async def get_tree_image(tid):
+        if tid not in registry:
+            raise web.HTTPNotFound(text="Unknown tree: %s" % tid)
+        if registry.is_loaded(tid):
+            return registry.get(tid)
+        if tid not in loading:  # requests for a tree being loaded wait for it
+            loop = asyncio.get_running_loop()
+            loading[tid] = loop.run_in_executor(None, registry.load, tid)
+            loading[tid].add_done_callback(lambda _: loading.pop(tid, None))
+        tree_image = await asyncio.shield(loading[tid])
+        if not registry.is_loaded(tid):  # the registry only changes in this thread
+            registry.put(tid, tree_image)
+        return registry.get(tid)
+
+    async def get_trees(request):
+        return web.json_response({"trees": registry.ids()})
+
+    async def get_scene_region(request):
+        tid = request.match_info.get("tid", str(tree_id))
+        tree_image = await get_tree_image(tid)
+        zoom, x, y, w, h = map(float, request.match_info["scene"].split(','))
+        zoom = max(0.00001, zoom)
+        query = request.query
+        # only the newest request of each client (and tree) is rendered
+        key = (query["client"], tid) if "client" in query else None
+        seq = int(query["seq"]) if "seq" in query else None
+        fmt = query.get("format", "json")
+        known_id = query.get("known")
+        known = server.get_known_rect(tree_image, zoom, known_id) if known_id else None
+        renderer.cancel_prefetch()
+        if not renderer.is_newest(key, seq):  # even if it is cached
+            return web.Response(status=204)
+
+        t1 = time.time()
+        region = cache.get_region(tree_image, zoom, x, y, w, h, tid)
+        etag = cache.get_etag(region, zoom, x, y, w, h, fmt, known)
+        if request.headers.get("If-None-Match") == etag:
+            cache.not_modified += 1
+            renderer.prefetch(cache, tree_image, tid, zoom, x, y, w, h)
+            return web.Response(status=304, headers={"ETag": etag})
+
+        # deltas, and regions missing in the cache, are rendered by the workers
+        if known is not None:
+            scene = await renderer.render(key, seq, _render_delta, tid, region.zoom,
+                                          zoom, x, y, w, h, known)
+        else:
+            scene = cache.get(region, zoom)
+            if scene is None:
+                scene = await renderer.render(key, seq, _render, tid, *region[1:])
+                if scene is not None:
+                    cache.put(region, scene)
+                    scene = region_cache.rescale_scene(scene, zoom / region.zoom)
+        if scene is None:
+            return web.Response(status=204)
+        renderer.prefetch(cache, tree_image, tid, zoom, x, y, w, h)
+
+        info = server.get_region_info(tree_image, scene, zoom, (x, y, w, h), known is not None)
+        content_type, body = server.encode_scene_region(tree_image, scene, (x, y), fmt, info)
+        logger.debug("scene region %s of %s: %d bytes, %.3fs",
+                     (zoom, x, y, w, h), tid, len(body), time.time() - t1)
+        return web.Response(body=body, content_type=content_type,
+                            headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    async def stream_scene(request):
+        """WebSocket streaming scene regions (see SceneStream)."""
+        tid = request.match_info.get("tid", str(tree_id))
+        tree_image = await get_tree_image(tid)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        stream = SceneStream(ws, tree_image, cache, tid, renderer,
+                             request.query.get("client"))
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                message = json.loads(msg.data)
+                if "ack" in message:
+                    stream.ack(message["seq"], message["ack"])
+                else:
+                    zoom, x, y, w, h = map(float, message["scene"])
+                    stream.request(int(message["seq"]), max(0.00001, zoom), x, y, w, h,
+                                   message.get("format", "bin"))
+        finally:
+            stream.cancel()
+        return ws
+
+    async def get_tile(request):
+        """Tile z/x/y of the tree (y with the format extension: .png or
+        .bin), pre-rendered in tiles_dir or rendered by the workers."""
+        info = request.match_info
+        y, _, fmt = info["y"].partition('.')
+        tid = info["tid"]
+        if tid not in registry or fmt not in tiles.FORMATS:
+            raise web.HTTPNotFound()
+        z, x, y = int(info["z"]), int(info["x"]), int(y)
+        body = tiles.read_tile(tiles_dir, tid, z, x, y, fmt)
+        if body is None:
+            await get_tree_image(tid)  # loaded here, for the workers to share it
+            body = await renderer.render_tile(tid, z, x, y, fmt)
+        return web.Response(body=body, content_type=tiles.FORMATS[fmt])
+
+    async def cache_stats(request):
+        return web.json_response(dict(cache.stats(), trees=registry.stats(),
+                                      **renderer.stats()))
+
+    async def options(request):
+        return web.Response()
+
+    async def enable_cors(request, response):
+        response.headers.update(server.CORS_HEADERS)
+
+    async def close_renderer(app):
+        renderer.close()
+
+    app = web.Application()
+    app.router.add_get("/get_scene_region/{scene}/", get_scene_region)
+    app.router.add_route("OPTIONS", "/get_scene_region/{scene}/", options)
+    app.router.add_get("/stream", stream_scene)
+    app.router.add_get("/trees", get_trees)
+    app.router.add_get("/trees/{tid}/stream", stream_scene)
+    app.router.add_get("/trees/{tid}/get_scene_region/{scene}/", get_scene_region)
+    app.router.add_route("OPTIONS", "/trees/{tid}/get_scene_region/{scene}/", options)
+    app.router.add_get(r"/tiles/{tid}/{z:\d+}/{x:\d+}/{y}", get_tile)
+    app.router.add_get("/cache_stats", cache_stats)
+    if os.path.isdir(server.STATIC_DIR):
+        app.router.add_static("/static/", server.STATIC_DIR)
+    else:
+        logger.warning("No web client in %s, not serving /static/" % server.STATIC_DIR)
+    app.on_response_prepare.append(enable_cors)
+    app.on_cleanup.append(close_renderer)
+    web.run_app(app, host=host, port=port)
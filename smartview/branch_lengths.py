@@ -0,0 +1,320 @@
+""" Branch length adjustment strategies.
+
+Every strategy receives the Topology arrays of a tree image (see
+layout.get_topology) plus the current node apertures (img_data[:, _fnh]), and
+returns a new _blen column. Strategies are registered by name, so they can be
+selected from the command line (-b) or from TreeStyle.branch_mode.
+"""
+import heapq
+import math
+import time
+
+import numpy as np
+
+from .common import R180
+from .layout import get_topology, subtree_sum
+from .utils import logger
+
+STRATEGIES = {}
+
+
+def register_strategy(name):
+    def decorator(fn):
+        STRATEGIES[name] = fn
+        return fn
+    return decorator
+
+
+def get_strategy(name):
+    try:
+        return STRATEGIES[name]
+    except KeyError:
+        raise ValueError("Unknown branch length strategy '%s'. Valid values are: %s"
+                         % (name, ', '.join(sorted(STRATEGIES))))
+
+
+def get_children(topo, nid):
+    return topo.child_ids[topo.child_ptr[nid]:topo.child_ptr[nid + 1]]
+
+
+def _scale_by_parent_size(topo, stop):
+    nleaves = topo.nleaves
+    blen = topo.dist.copy()
+
+    # internal nodes with few leaves are scaled by themselves...
+    small = ~topo.is_leaf & (nleaves < stop)
+    blen[small] = topo.dist[small] * 3
+
+    # ... but larger parents impose their own branch length on their children
+    factor = np.select([nleaves >= stop * 3, nleaves >= stop * 2, nleaves >= stop],
+                       [1000.0, 20.0, 10.0], default=0.0)
+    parent = topo.parent[1:]
+    by_parent = factor[parent] > 0
+    children = np.arange(1, len(blen))[by_parent]
+    blen[children] = topo.dist[parent[by_parent]] * factor[parent[by_parent]]
+    return blen
+
+
+@register_strategy("real")
+def real(topo, aperture, stop=None):
+    return topo.dist.copy()
+
+
+@register_strategy("by_level")
+def by_level(topo, aperture, stop=None):
+    if stop is None:
+        stop = 4
+    return np.where(topo.depth <= stop, topo.dist * 1000, topo.dist * 1.5)
+
+
+@register_strategy("by_islands")
+def by_islands(topo, aperture, stop=None):
+    return _scale_by_parent_size(topo, 150 if stop is None else stop)
+
+
+@register_strategy("by_size2")
+def by_size2(topo, aperture, stop=None):
+    return _scale_by_parent_size(topo, 100 if stop is None else stop)
+
+
+@register_strategy("by_scale")
+def by_scale(topo, aperture, stop=None):
+    # distance to the farthest leaf
+    maxd = topo.rootdist[topo.is_leaf].max()
+    with np.errstate(over="ignore"):
+        scale_ranges = [(maxd/4, 100), (maxd/3, 16), (maxd/2, 16),
+                        (np.power(maxd, maxd), 1)]
+
+    fbranch = topo.dist
+    current_pos = topo.rootdist - topo.dist
+    blen = np.zeros(len(fbranch))
+    for scamax, sca in scale_ranges:
+        inrange = current_pos <= scamax
+        offset = np.minimum(scamax, current_pos + fbranch)
+        current_pos = np.where(inrange, current_pos + offset, current_pos)
+        blen += np.where(inrange, offset * sca, 0.0)
+
+    blen[0] = maxd / 2
+    return blen
+
+
+@register_strategy("by_size")
+def by_size(topo, aperture, stop=None):
+    """Scales branches by rounds. In each round, the topmost clades with less than
+    `stop` terminal nodes get the current scale and are collapsed into a single
+    terminal node. The scale grows 10 times per round.
+    """
+    if stop is None:
+        stop = 100
+
+    nnodes = len(topo.dist)
+    end = topo.end
+    parent = topo.parent
+    ids = np.arange(nnodes)
+
+    median_dist = np.median(topo.dist)
+    scale = 10.0 / median_dist if median_dist else 1.0
+
+    def count_terminal_nodes(alive):
+        # terminal nodes of the current (collapsed) tree under each node
+        has_alive_child = np.zeros(nnodes, dtype=bool)
+        has_alive_child[parent[1:][alive[1:]]] = True
+        terminal = alive & ~has_alive_child
+        return terminal, subtree_sum(terminal, end)
+
+    blen = topo.dist.copy()
+    alive = np.ones(nnodes, dtype=bool)
+    terminal, nterminal = count_terminal_nodes(alive)
+    while True:
+        candidate = alive & (nterminal <= stop)
+        topmost = candidate & ~candidate[parent]
+        topmost[0] = candidate[0]
+        topmost &= ~terminal
+
+        # strict descendants of the topmost small clades take current scale
+        seeds = ids[topmost]
+        cover = np.bincount(seeds + 1, minlength=nnodes + 1)
+        cover -= np.bincount(end[seeds] + 1, minlength=nnodes + 1)
+        covered = (np.cumsum(cover)[:nnodes] > 0) & alive
+        blen[covered] = topo.dist[covered] * scale
+        alive &= ~covered
+
+        logger.debug("by_size scale used: %s, nodes processed: %d" %(scale, covered.sum()))
+        scale = scale * 10
+        terminal, nterminal = count_terminal_nodes(alive)
+        if nterminal[0] < stop or not covered.any():
+            break
+
+    blen[alive] = topo.dist[alive] * scale
+    return blen
+
+
+@register_strategy("adjust_lengths_by_size")
+def adjust_lengths_by_size(topo, aperture, stop=None):
+    """Splits the tree into clades of about `stop` (200) nodes, and scales the
+    branches in each level of clades so that they have enough radius to
+    allocate all their leaves.
+
+    Only nodes with more than `stop` leaves are ever split, so the python
+    work here is proportional to the number of large clades, not to the
+    number of nodes.
+    """
+    opt_size = 200 if stop is None else stop
+    nleaves = topo.nleaves
+    dist = topo.dist
+    rootdist = topo.rootdist + 1
+
+    blen = dist.copy()
+    n2scale = {}
+    seeds = [0]
+    while seeds:
+        seed = seeds.pop()
+        if topo.is_leaf[seed]:
+            continue
+
+        # Split the largest clade until there are opt_size clades, or all of
+        # them are small enough
+        clades = [(-nleaves[seed], seed)]
+        expanded = []
+        while len(clades) < opt_size and -clades[0][0] > opt_size:
+            size, largest = heapq.heappop(clades)
+            expanded.append(largest)
+            for ch in get_children(topo, largest):
+                heapq.heappush(clades, (-nleaves[ch], ch))
+        clades = np.array([c for _, c in clades], dtype=np.int64)
+
+        seed_aperture = aperture[seed]
+        if seed_aperture < R180:
+            hyp = nleaves[seed] / math.sin(seed_aperture / 2.0)
+        else:
+            hyp = nleaves[seed]
+
+        dist_to_clades = rootdist[clades].max()
+        if seed == 0:
+            clade_scale = hyp / dist_to_clades
+            n2scale[seed] = hyp
+        else:
+            diff = dist_to_clades - rootdist[seed]
+            current_rad = n2scale[seed]
+            if not diff:
+                clade_scale = 1.0
+            elif current_rad >= hyp:
+                clade_scale = 500 / diff
+            else:
+                clade_scale = (hyp - current_rad) / diff
+
+        # branches down to the children of each clade are scaled
+        scaled = np.concatenate([get_children(topo, n) for n in expanded]
+                                + [get_children(topo, n) for n in clades])
+        blen[scaled] = dist[scaled] * clade_scale
+
+        large = clades[nleaves[clades] > opt_size]
+        for n, rad in zip(large, n2scale[seed] + (rootdist[large] - rootdist[seed]) * clade_scale):
+            n2scale[n] = rad
+        seeds.extend(large)
+
+    return blen * 0.1
+
+
+@register_strategy("ultrametric_by_size")
+def ultrametric_by_size(topo, aperture, stop=None):
+    """Converts the backbone of the tree (nodes above clades of less than `stop`
+    leaves) into a balanced ultrametric topology, scaled to fit the number of
+    leaves in the root aperture. Branches within small clades are not
+    modified.
+    """
+    if stop is None:
+        stop = 500
+    nnodes = len(topo.dist)
+    parent = topo.parent
+    nchildren = np.diff(topo.child_ptr)
+
+    # terminal nodes of the backbone, and nodes hanging under them
+    terminal = (topo.nleaves <= stop) | (nchildren > stop)
+    hidden = np.zeros(nnodes, dtype=bool)
+    for level in topo.levels[1:]:
+        hidden[level] = hidden[parent[level]] | terminal[parent[level]]
+    internal = ~terminal & ~hidden
+
+    # number of splits remaining under each backbone node
+    max_depth = np.ones(nnodes)
+    for level in reversed(topo.levels[1:]):
+        level = level[~hidden[level]]
+        up = parent[level]
+        np.maximum.at(max_depth, up, np.where(internal[up], max_depth[level] + 1, 1))
+
+    tree_length = 10.0
+    udist = np.zeros(nnodes)
+    cumdist = np.zeros(nnodes)
+    for level in topo.levels[1:]:
+        level = level[~hidden[level]]
+        up = parent[level]
+        udist[level] = (tree_length - cumdist[up]) / max_depth[level]
+        cumdist[level] = cumdist[up] + udist[level]
+
+    blen = topo.dist.copy()
+    backbone = ~hidden
+    backbone[0] = False
+    if not backbone.any():
+        return blen
+
+    angle_span = aperture[0]
+    if not angle_span:
+        return blen
+    expected_rad = topo.nleaves[0] / angle_span
+    root_scale = expected_rad / udist[backbone].max()
+    if root_scale > 1:
+        blen[backbone] = udist[backbone] * root_scale
+    return blen
+
+
+def random_topology(nleaves, seed=None):
+    """Returns the Topology of a random binary tree with nleaves leaves."""
+    rng = np.random.default_rng(seed)
+    nnodes = 2 * nleaves - 1
+    parent = np.zeros(nnodes, dtype=np.int64)
+    end = np.zeros(nnodes, dtype=np.int64)
+    nid = 0
+    stack = [(nleaves, 0)]
+    while stack:
+        size, up = stack.pop()
+        parent[nid] = up
+        end[nid] = nid + 2 * size - 2
+        if size > 1:
+            left = int(rng.integers(1, size))
+            stack.append((size - left, nid))
+            stack.append((left, nid))
+        nid += 1
+    dist = rng.random(nnodes)
+    return get_topology(parent, end, dist)
+
+
+def benchmark(topo, aperture=None, names=None, repeat=3):
+    """Runs every strategy over the same topology and returns (name, best time in
+    seconds) tuples."""
+    if aperture is None:
+        aperture = np.full(len(topo.dist), 2 * math.pi)
+        aperture[1:] = 2 * math.pi * topo.nleaves[1:] / topo.nleaves[0]
+    results = []
+    for name in (names or sorted(STRATEGIES)):
+        fn = get_strategy(name)
+        timings = []
+        for _ in range(repeat):
+            t1 = time.time()
+            fn(topo, aperture)
+            timings.append(time.time() - t1)
+        results.append((name, min(timings)))
+    return results
+
+
+def print_benchmark(results, title=None):
+    from .utils import print_table
+    print_table([[name, "%0.6f" % secs] for name, secs in results],
+                header=["strategy", "seconds"], title=title, max_col_width=30)
+
+
+if __name__ == "__main__":
+    import sys
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print_benchmark(benchmark(random_topology(size, seed=0)),
+                    title="Branch length strategies (%d leaves)" % size)
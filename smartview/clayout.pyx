@@ -1,185 +1,257 @@
-from common import *
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""Compiled layout kernels. Same API as nplayout.py, which is used instead when
+this module is not built.
+
+All kernels work over the img_data matrix (float32, preorder) and the parent
+array of the tree Topology. Since every parent comes before its children in
+preorder, a forward pass resolves top-down values and a reverse pass visits
+every child before its parent.
+"""
+from libc.math cimport hypot, tan, INFINITY, NAN, isnan
+from libc.stdint cimport int64_t
 import math
-import time
-from colors import *
 import numpy as np
-cimport numpy as np
 
-# "ctypedef" assigns a corresponding compile-time type to DTYPE_t. For
-# every type in the numpy module there's a corresponding compile-time
-# type with a _t-suffix.
-ctypedef np.float64_t DTYPE_t
+from . import common
+
+# img_data columns. Must match common.py (checked below)
+cdef enum:
+    IS_LEAF = 0
+    BTW = 3
+    BTH = 4
+    BBW = 5
+    BBH = 6
+    BRW = 7
+    BRH = 8
+    NHT = 13
+    NHB = 14
+    BLEN = 15
+    BH = 16
+    FNW = 17
+    FNH = 18
+    RAD = 19
+    ACENTER = 20
+    ASTART = 21
+    AEND = 22
+    XEND = 19
+    YCENTER = 20
+    YSTART = 21
+    YEND = 22
+
+for _name, _col in [("_is_leaf", IS_LEAF), ("_btw", BTW), ("_bth", BTH),
+                    ("_bbw", BBW), ("_bbh", BBH), ("_brw", BRW), ("_brh", BRH),
+                    ("_nht", NHT), ("_nhb", NHB), ("_blen", BLEN), ("_bh", BH),
+                    ("_fnw", FNW), ("_fnh", FNH), ("_rad", RAD),
+                    ("_acenter", ACENTER), ("_astart", ASTART), ("_aend", AEND),
+                    ("_xend", XEND), ("_ycenter", YCENTER), ("_ystart", YSTART),
+                    ("_yend", YEND)]:
+    if getattr(common, _name) != _col:
+        raise ImportError("clayout is out of sync with common.%s" % _name)
 
+cdef double R90 = math.pi / 2.0
 
-cdef get_min_radius(double rect_width, double rect_height, double parent_radius, double radians):
-    cdef double radius, adjacent, R90
-    radius = math.hypot(parent_radius+rect_width, rect_height)
+
+cdef inline double get_min_radius(double rect_width, double rect_height,
+                                  double parent_radius, double radians) noexcept nogil:
+    cdef double radius = hypot(parent_radius + rect_width, rect_height)
+    cdef double adjacent
     if radians < R90:
-        # converts to radians
-        adjacent = rect_height / math.tan(radians)
-        radius = max(radius, math.hypot(adjacent+rect_width, rect_height))
+        adjacent = rect_height / tan(radians)
+        radius = max(radius, hypot(adjacent + rect_width, rect_height))
     return radius
 
-cdef get_node_end_radius(double parent_radius, dim, double scale):
-    cdef htop, hbot, branch, wtop, wbot, aperture_top, aperture_bot, rad_top, rad_bot
-
-
-    htop = max(dim[_bth] + (dim[_bh]/2.0), dim[_brh]/2.0, dim[_bh]/2.0)
-    hbot = max(dim[_bbh] + (dim[_bh]/2.0), dim[_brh]/2.0, dim[_bh]/2.0)
-    if scale:
-        branch = dim[_blen] * scale
-        wtop = max(dim[_btw], branch) + dim[_brw]
-        wbot = max(dim[_bbw], branch) + dim[_brw]
-    else:
-        wtop = dim[_btw] + dim[_brw]
-        wbot = dim[_bbw] + dim[_brw]
-
-    aperture_top = dim[_acenter] - dim[_astart]
-    aperture_bot = dim[_aend] - dim[_acenter]
-
-    rad_top = get_min_radius(wtop, htop, parent_radius, aperture_top)
-    rad_bot = get_min_radius(wbot, hbot, parent_radius, aperture_bot)
-
-    radius = max(rad_top, rad_bot)
-    return radius, max(wtop, wbot), htop, hbot
-
-
-def adjust_branch_lengths(tree_image):
-    t1 = time.time()
-    img_data = tree_image.img_data
-    #min_absolute_rad = (len(tree_image.cached_leaves))/(2*math.pi)
-    root = tree_image.root_node
-    n2leaves = root.get_cached_content(container_type=list)
-    starts = [root]
-    colors = random_color(num=len(starts))
-    stop = 500
-    def is_leaf(_node):
-        if len(n2leaves[_node]) <= stop or len(_node.children) > stop:
-            return True
-        else:
-            return False
-
-    root.convert_to_ultrametric(tree_length=10, is_leaf_fn=is_leaf)
-    cdist = {}
-    angle_span = img_data[root._id][_aend]-img_data[root._id][_astart]
-    for n in root.iter_descendants(is_leaf_fn=is_leaf):
-        cdist[n] = cdist.get(n, 0.0)
-        cdist[n] += n.dist
-    expected_rad = len(n2leaves[root]) / angle_span
-    root_scale =  expected_rad / max(cdist.values())
-    if root_scale > 1:
-        linecolor = colors.pop()
-        for n in cdist:
-            n.img_style.hz_line_color = linecolor
-            img_data[n._id][_blen] = n.dist * root_scale
-            n.dist = len(n2leaves[n])
-    print "SCALED", len(cdist), "nodes, using scale", root_scale
-    print "TIME adjusting branches", time.time() - t1
-
-
-def get_optimal_circular_scale(tree_image, optimization_level="med", root_opening_factor=0.0):
-    cdef int nid
-
-    t1 = time.time()
-
-    adjust_branch_lengths(tree_image)
-
-    imgdata = tree_image.img_data
-
-    n2minradius = {}
-    n2sumdist = {}
-    n2sumwidth = {}
-
-    # Calculate min node radius at scale 1
-    most_distant = 0
-    for nid, dim in enumerate(imgdata):
-        parent_radius = n2minradius[dim[_parent]] if nid > 0 else 0
-        radius, node_width, nht, nhb = get_node_end_radius(parent_radius, dim, scale=0.0)
-        n2minradius[nid] = radius
-        n2sumwidth[nid] = n2sumwidth.get(dim[_parent], 0) + node_width
-        n2sumdist[nid] = n2sumdist.get(dim[_parent], 0) + dim[_blen]
-        most_distant = max(n2sumdist[nid], most_distant)
-    print time.time()-t1
-    if most_distant == 0:
-        return 0.0
 
-    root_opening = 0.0
-    best_scale = None
-    max_rad = 0.0
-    for nid, dim in enumerate(imgdata):
-        ndist = dim[_blen]
-        if best_scale is None:
-            best_scale = (n2minradius[nid] - n2sumwidth[nid]) / ndist if ndist else 0.0
-        else:
-            # Whats the expected radius of this node?
-            current_rad = (n2sumdist[nid] * best_scale) + (n2sumwidth[nid] + root_opening)
-
-            # If still too small, it means we need to increase scale.
-            if current_rad < n2minradius[nid]:
-                # This is a simplification of the real equation needed to
-                # calculate the best scale. Given that I'm not taking into
-                # account the versed sine of each parent node, the equation is
-                # simpler
-                if root_opening_factor:
-                    best_scale = (n2minradius[nid] - (n2sumwidth[nid])) / (n2sumdist[nid] + (most_distant * root_opening_factor))
-                    root_opening = most_distant * best_scale * root_opening_factor
-                else:
-                    best_scale = (n2minradius[nid] - (n2sumwidth[nid]) + root_opening) / n2sumdist[nid] if n2sumdist[nid] else 0.0
-
-            # If the width of branch top/bottom faces is not covered, we can
-            # also increase the scale to adjust it. This may produce huge
-            # scales, so let's keep it optional
-            if optimization_level == "full":
-                min_w = max(dim[_btw], dim[_bbw])
-                if min_w > ndist * best_scale:
-                    best_scale = min_w / ndist
-
-        max_rad = max(max_rad, (n2sumdist[nid] * best_scale) + (n2sumwidth[nid] + root_opening))
-
-    # Adjust scale for aligned faces
-    print "Max rad,",  max_rad, root_opening
-    if 0:
-        for nid, dim in enumerate(imgdata):
-            current_rad = (n2sumdist[nid] * best_scale) + (n2sumwidth[nid] + root_opening)
-            needed_rad = get_min_radius(dim[_baw], dim[_bah]/2, current_rad, (dim[_aend]-dim[_astart])/2)
-            if needed_rad > current_rad:
-
-                if root_opening_factor:
-                    best_scale = (needed_rad - (n2sumwidth[nid])) / (n2sumdist[nid] + (most_distant * root_opening_factor))
-                    root_opening = most_distant * best_scale * root_opening_factor
-                else:
-                    best_scale = (needed_rad - (n2sumwidth[nid]) + root_opening) / n2sumdist[nid]
-
-    print "                                   TIME optimal best scale", time.time()-t1
-    return best_scale,  max_rad, most_distant
-
-
-def update_node_radius(imgdata, cached_prepostorder,
-                       cached_preorder,
-                       scale, root_opening):
-    max_radius = 0.0
-    root_visited = False
-    for nid in cached_prepostorder:
-        postorder = nid < 0 or nid == 0 and root_visited
-        if nid == 0: root_visited = True
-
-        node = cached_preorder[abs(nid)]
-        dim = imgdata[node._id]
-        if not postorder:
-            parent_radius = imgdata[dim[_parent]][_rad] if node._id > 0 else root_opening
-            end_radius, node_width, node_height_top, node_height_bot = get_node_end_radius(parent_radius, dim, scale)
-            dim[_nht] = node_height_top
-            dim[_nhb] = node_height_bot
-            dim[_rad] = end_radius
-            max_radius = max(max_radius, end_radius)
-            if dim[_is_leaf]:
-                dim[_fnw] = end_radius
-                # dim[_fnh] = dim[_nht] + dim[_nhb]
-                angle =  (dim[_aend] - dim[_astart])
-                dim[_fnh] = dim[_fnw] * angle
+cdef double _update_node_radius(float[:, ::1] img, const int64_t[::1] parent,
+                                double root_opening) noexcept nogil:
+    cdef Py_ssize_t i, n = img.shape[0]
+    cdef double rad, max_radius = 0.0
+    for i in range(n):
+        rad = (img[parent[i], RAD] if i > 0 else root_opening) + img[i, BLEN]
+        img[i, RAD] = rad
+        img[i, NHT] = img[i, BH] / 2.0
+        img[i, NHB] = img[i, BH] / 2.0
+        img[i, FNW] = rad if img[i, IS_LEAF] else -INFINITY
+        max_radius = max(max_radius, rad)
 
+    for i in range(n - 1, 0, -1):
+        if img[i, FNW] > img[parent[i], FNW]:
+            img[parent[i], FNW] = img[i, FNW]
+    return max_radius
+
+
+cdef void _center_from_children(float[:, ::1] img, const int64_t[::1] parent,
+                                double[::1] last_center, int start, int end,
+                                int center) noexcept nogil:
+    """Sets the start/end of internal nodes to those of their first/last child,
+    and their center to the middle point between both children centers."""
+    cdef Py_ssize_t i, p
+    for i in range(img.shape[0]):
+        last_center[i] = NAN
+    for i in range(img.shape[0] - 1, -1, -1):
+        if not img[i, IS_LEAF]:
+            # first child center was stored in the node itself
+            img[i, center] = img[i, center] + (last_center[i] - img[i, center]) / 2.0
+            img[i, FNH] = img[i, end] - img[i, start]
+        if i > 0:
+            p = parent[i]
+            # the first child visited in reverse order is the last one
+            if isnan(last_center[p]):
+                last_center[p] = img[i, center]
+                img[p, end] = img[i, end]
+            img[p, center] = img[i, center]
+            img[p, start] = img[i, start]
+
+
+cdef void _update_node_angles(float[:, ::1] img, const int64_t[::1] parent,
+                              const double[::1] leaf_apertures, double current_angle,
+                              double[::1] last_center) noexcept nogil:
+    cdef Py_ssize_t i, leaf = 0
+    cdef double step
+    for i in range(img.shape[0]):
+        if img[i, IS_LEAF]:
+            step = max(leaf_apertures[leaf], 0.0)
+            leaf += 1
+            img[i, ASTART] = current_angle
+            img[i, AEND] = current_angle + step
+            img[i, ACENTER] = current_angle + step / 2.0
+            img[i, FNH] = step
+            current_angle += step
+    _center_from_children(img, parent, last_center, ASTART, AEND, ACENTER)
+
+
+cdef void _update_rect_positions(float[:, ::1] img, const int64_t[::1] parent,
+                                 double[::1] last_center) noexcept nogil:
+    cdef Py_ssize_t i, n = img.shape[0]
+    cdef double height, current_y = 0.0
+    for i in range(n):
+        img[i, XEND] = (img[parent[i], XEND] if i > 0 else 0.0) + img[i, BLEN]
+        if img[i, IS_LEAF]:
+            height = img[i, NHT] + img[i, NHB] + img[i, BH]
+            img[i, YSTART] = current_y
+            img[i, YEND] = current_y + height
+            img[i, YCENTER] = current_y + img[i, NHT] + img[i, BH] / 2.0
+            img[i, FNW] = img[i, BLEN]
+            img[i, FNH] = height
+            current_y += height
         else:
-            dim[_fnw] = max([imgdata[ch._id][_fnw] for ch in node.children])
-            dim[_fnh] = dim[_fnw] * (dim[_aend] - dim[_astart])
+            img[i, FNW] = 0.0
+    _center_from_children(img, parent, last_center, YSTART, YEND, YCENTER)
+
+    # full node width is the widest child plus the node's own branch
+    for i in range(n - 1, -1, -1):
+        if not img[i, IS_LEAF]:
+            img[i, FNW] += img[i, BLEN]
+        if i > 0 and img[i, FNW] > img[parent[i], FNW]:
+            img[parent[i], FNW] = img[i, FNW]
+
 
+cdef double _get_min_radii(float[:, ::1] img, const int64_t[::1] parent,
+                           double[::1] minr, double[::1] sumw,
+                           double[::1] sumd) noexcept nogil:
+    """Fills the min radius of each node at scale 1, and the cumulative face
+    widths and branch distances from the root. Returns the max distance."""
+    cdef Py_ssize_t i, p
+    cdef double lw, htop, hbot, wtop, wbot, parent_radius, most_distant = 0.0
+    for i in range(img.shape[0]):
+        p = parent[i]
+        parent_radius = minr[p] if i > 0 else 0.0
+        lw = img[i, BH] / 2.0
+        htop = max(img[i, BTH] + lw, img[i, BRH] / 2.0)
+        hbot = max(img[i, BBH] + lw, img[i, BRH] / 2.0)
+        wtop = img[i, BTW] + img[i, BRW]
+        wbot = img[i, BBW] + img[i, BRW]
+        minr[i] = max(get_min_radius(wtop, htop, parent_radius,
+                                     img[i, ACENTER] - img[i, ASTART]),
+                      get_min_radius(wbot, hbot, parent_radius,
+                                     img[i, AEND] - img[i, ACENTER]))
+        sumw[i] = (sumw[p] if i > 0 else 0.0) + max(wtop, wbot)
+        sumd[i] = (sumd[p] if i > 0 else 0.0) + img[i, BLEN]
+        most_distant = max(most_distant, sumd[i])
+    return most_distant
+
+
+cdef double _get_best_scale(float[:, ::1] img, double[::1] minr, double[::1] sumw,
+                            double[::1] sumd, double most_distant, bint full,
+                            double root_opening_factor, double *max_rad) noexcept nogil:
+    """Every node gives a lower bound for the scale, so that its radius
+    (sumd*s + sumw + root opening) covers its min radius. Returns the max
+    bound, and sets the max radius of the tree at that scale."""
+    cdef Py_ssize_t i
+    cdef double ndist, denom, root_opening, best_scale
+
+    ndist = img[0, BLEN]
+    best_scale = (minr[0] - sumw[0]) / ndist if ndist else 0.0
+    for i in range(1, img.shape[0]):
+        # nodes at distance 0 cannot be fixed by scaling
+        denom = sumd[i] + most_distant * root_opening_factor
+        if denom > 0:
+            best_scale = max(best_scale, (minr[i] - sumw[i]) / denom)
+
+        # Optionally, make branches as long as their top/bottom faces
+        ndist = img[i, BLEN]
+        if full and ndist > 0:
+            best_scale = max(best_scale, max(img[i, BTW], img[i, BBW]) / ndist)
+
+    root_opening = most_distant * best_scale * root_opening_factor
+    max_rad[0] = 0.0
+    for i in range(img.shape[0]):
+        max_rad[0] = max(max_rad[0], sumd[i] * best_scale + sumw[i] + root_opening)
+    return best_scale
+
+
+def update_node_radius(img_data, topology, root_opening):
+    """Sets the end radius of every node and returns the max radius."""
+    cdef float[:, ::1] img = img_data
+    cdef const int64_t[::1] parent = topology.parent
+    cdef double opening = root_opening
+    cdef double max_radius
+    with nogil:
+        max_radius = _update_node_radius(img, parent, opening)
     return max_radius
+
+
+def update_node_angles(img_data, topology, leaf_apertures, arc_start):
+    """Sets the start, center and end angles of every node, given the aperture
+    (in radians) of every leaf and the start angle (in degrees) of the tree."""
+    cdef float[:, ::1] img = img_data
+    cdef const int64_t[::1] parent = topology.parent
+    cdef const double[::1] apertures = np.ascontiguousarray(leaf_apertures, dtype=np.float64)
+    cdef double[::1] last_center = np.empty(len(img_data))
+    cdef double start = math.radians(arc_start)
+    with nogil:
+        _update_node_angles(img, parent, apertures, start, last_center)
+
+
+def update_rect_positions(img_data, topology):
+    """Sets the x end and y start, center and end of every node."""
+    cdef float[:, ::1] img = img_data
+    cdef const int64_t[::1] parent = topology.parent
+    cdef double[::1] last_center = np.empty(len(img_data))
+    with nogil:
+        _update_rect_positions(img, parent, last_center)
+
+
+def get_optimal_circular_scale(img_data, topology, optimization_level="med",
+                               root_opening_factor=0.0):
+    """ Returns the minimum branch scale necessary to display all faces
+    avoiding extra (dashed) branch lines, the max radius of the tree at that
+    scale, and the distance to the most distant node. Returns 0.0 if there
+    are no branch lengths.
+    """
+    cdef float[:, ::1] img = img_data
+    cdef const int64_t[::1] parent = topology.parent
+    cdef double[::1] minr = np.empty(len(img_data))
+    cdef double[::1] sumw = np.empty(len(img_data))
+    cdef double[::1] sumd = np.empty(len(img_data))
+    cdef bint full = optimization_level == "full"
+    cdef double factor = root_opening_factor
+    cdef double most_distant, best_scale, max_rad = 0.0
+
+    with nogil:
+        most_distant = _get_min_radii(img, parent, minr, sumw, sumd)
+    if most_distant == 0:
+        return 0.0
+    with nogil:
+        best_scale = _get_best_scale(img, minr, sumw, sumd, most_distant, full,
+                                     factor, &max_rad)
+    return best_scale, max_rad, most_distant
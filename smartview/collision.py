@@ -0,0 +1,111 @@
+""" Analytic bounds of nodes, used for visibility and hit tests.
+
+Bounds are computed on demand from img_data for a given array of node ids:
+boxes (x0, y0, x1, y1) in rect mode and annular sectors (r0, r1, a0, a1) in
+circular mode, all in the untransformed scene (circular coordinates relative
+to the tree center). Each of the four elements is an array with one value per
+node.
+"""
+import numpy as np
+
+from .common import *
+
+
+def rect_boxes(img_data, nodes, root_opening=0.0, full=False):
+    """Box of the branch of each node, or of its full subtree."""
+    nodes = np.asarray(nodes, dtype=np.int64)
+    dim = img_data[nodes].astype(np.float64)
+    x0 = img_data[dim[:, _parent].astype(np.int64), _xend].astype(np.float64)
+    x0[nodes == 0] = root_opening
+    y0 = dim[:, _ystart]
+    if full:
+        return x0, y0, x0 + dim[:, _fnw], y0 + dim[:, _fnh]
+    return x0, y0, dim[:, _xend], dim[:, _yend]
+
+def sectors(img_data, nodes, root_opening=0.0, full=False):
+    """Annular sector of the branch of each node, or of its full subtree."""
+    nodes = np.asarray(nodes, dtype=np.int64)
+    dim = img_data[nodes].astype(np.float64)
+    r0 = img_data[dim[:, _parent].astype(np.int64), _rad].astype(np.float64)
+    r0[nodes == 0] = root_opening
+    r1 = dim[:, _fnw] if full else dim[:, _rad]
+    return r0, r1, dim[:, _astart], dim[:, _aend]
+
+def sector_boxes(bounds):
+    """Bounding boxes of annular sectors."""
+    r0, r1, a0, a1 = bounds
+    corners_x = np.stack([r * np.cos(a) for r in (r0, r1) for a in (a0, a1)])
+    corners_y = np.stack([r * np.sin(a) for r in (r0, r1) for a in (a0, a1)])
+    x0, x1 = corners_x.min(axis=0), corners_x.max(axis=0)
+    y0, y1 = corners_y.min(axis=0), corners_y.max(axis=0)
+
+    # the outer arc reaches r1 on every axis direction it crosses
+    span = a1 - a0
+    crosses = lambda axis: ((axis - a0) % R360 <= span) | (span >= R360)
+    x1 = np.where(crosses(0.0), r1, x1)
+    y1 = np.where(crosses(R90), r1, y1)
+    x0 = np.where(crosses(R180), -r1, x0)
+    y0 = np.where(crosses(R270), -r1, y0)
+    return x0, y0, x1, y1
+
+def boxes_intersect(boxes, rect):
+    """Which boxes overlap the rect (x0, y0, x1, y1)."""
+    x0, y0, x1, y1 = boxes
+    return (x0 < rect[2]) & (x1 > rect[0]) & (y0 < rect[3]) & (y1 > rect[1])
+
+def boxes_contain(boxes, x, y):
+    x0, y0, x1, y1 = boxes
+    return (x0 <= x) & (x <= x1) & (y0 <= y) & (y <= y1)
+
+def sectors_contain(bounds, x, y):
+    r0, r1, a0, a1 = bounds
+    radius = np.hypot(x, y)
+    offset = (np.arctan2(y, x) - a0) % R360
+    return (r0 <= radius) & (radius <= r1) & (offset <= a1 - a0)
+
+def sectors_intersect(bounds, rect):
+    """Which sectors overlap the rect (x0, y0, x1, y1). Both the bounding
+    boxes and the polar ranges (angles and radii) covered by the rect must
+    overlap."""
+    r0, r1, a0, a1 = bounds
+    hit = boxes_intersect(sector_boxes(bounds), rect)
+
+    x0, y0, x1, y1 = rect
+    xs = np.array([x0, x1, x1, x0])
+    ys = np.array([y0, y0, y1, y1])
+    rmax = np.hypot(xs, ys).max()
+    if x0 <= 0 <= x1 and y0 <= 0 <= y1:
+        return hit & (r0 <= rmax)
+
+    rmin = np.hypot(min(max(0.0, x0), x1), min(max(0.0, y0), y1))
+    hit &= (r0 <= rmax) & (r1 >= rmin)
+
+    # angular interval of the rect, as seen from its center
+    center = np.arctan2((y0 + y1) / 2.0, (x0 + x1) / 2.0)
+    offsets = (np.arctan2(ys, xs) - center + R180) % R360 - R180
+    start = center + offsets.min()
+    width = offsets.max() - offsets.min()
+    # two arcs overlap if either start falls within the other arc
+    return hit & (((start - a0) % R360 <= a1 - a0) | ((a0 - start) % R360 <= width))
+
+
+def node_bounds(tree_image, nodes, full=False):
+    """Bounds of the branch (or full subtree) of nodes, in the tree mode."""
+    if tree_image.tree_style.mode == "c":
+        return sectors(tree_image.scene_data, nodes, tree_image.root_open, full)
+    return rect_boxes(tree_image.scene_data, nodes, tree_image.root_open, full)
+
+def bounding_boxes(tree_image, bounds):
+    if tree_image.tree_style.mode == "c":
+        return sector_boxes(bounds)
+    return bounds
+
+def intersects(tree_image, bounds, rect):
+    if tree_image.tree_style.mode == "c":
+        return sectors_intersect(bounds, rect)
+    return boxes_intersect(bounds, rect)
+
+def contains(tree_image, bounds, x, y):
+    if tree_image.tree_style.mode == "c":
+        return sectors_contain(bounds, x, y)
+    return boxes_contain(bounds, x, y)
@@ -1,4 +1,4 @@
-from checkers import *
+from .checkers import *
 
 cdef class cNodeStyle(object):
     cdef public int hz_line_type
@@ -1,4 +1,5 @@
 from . import layout
+from . import collision
 from .utils import timeit, debug
 from .common import *
 from .utils import colorify
@@ -10,7 +11,7 @@ from ctypes import *
 from numpy.ctypeslib import ndpointer
 import numpy as np
 
-from PyQt5 import QtCore
+from PyQt5 import QtCore, sip
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 from PyQt5.QtSvg import *
@@ -19,10 +20,13 @@ import logging
 logger = logging.getLogger("smartview")
 
 
-COLLAPSE_RESOLUTION = 5
-W_COLLAPSE_RESOLUTION = 5
 MAX_SCREEN_SIZE = 500
 
+# circular arcs are drawn as polylines with segments of about ARC_SEGMENT_PX
+# pixels, and no more than MAX_ARC_SEGMENTS segments per arc
+ARC_SEGMENT_PX = 4
+MAX_ARC_SEGMENTS = 1024
+
 def pol2cart(rho, phi):
     x = rho * np.cos(phi)
     y = rho * np.sin(phi)
@@ -44,13 +48,14 @@ def get_aperture(radius, angle, default):
 
 
 def get_node_arc_path(tree_image, nid):
-    dim = tree_image.img_data[nid]
+    img_data = tree_image.scene_data
+    dim = img_data[nid]
     node = tree_image.cached_preorder[nid]
     radius = dim[_rad]
-    parent_radius = tree_image.img_data[int(dim[_parent])][_rad]
+    parent_radius = img_data[int(dim[_parent])][_rad]
     if not dim[_is_leaf]:
-        angles = (tree_image.img_data[node.children[0]._id][_astart],
-                  tree_image.img_data[node.children[-1]._id][_aend])
+        angles = (img_data[node.children[0]._id][_astart],
+                  img_data[node.children[-1]._id][_aend])
     else:
         angles = (dim[_astart], dim[_aend])
 
@@ -61,13 +66,14 @@ def get_node_arc_path(tree_image, nid):
 
 
 def get_node_rect_path(tree_image, nid):
-    dim = tree_image.img_data[nid]
+    img_data = tree_image.scene_data
+    dim = img_data[nid]
     node = tree_image.cached_preorder[nid]
 
     ystart = dim[_ystart]
     yend = dim[_yend]
     xend = dim[_xend]
-    xstart = tree_image.img_data[int(dim[_parent])][_xend]
+    xstart = img_data[int(dim[_parent])][_xend]
     path = QPainterPath()
     fpath = QPainterPath()
     path.addRect(xstart, ystart, xend-xstart, yend-ystart)
@@ -75,6 +81,119 @@ def get_node_rect_path(tree_image, nid):
     return path, fpath
 
 
+def get_rgba(color):
+    """Color name or code as an RGBA integer (0, transparent, for None)."""
+    return QColor(color).rgba() if color else 0
+
+def get_style_colors(tree_image, attr):
+    """QColor of attribute attr (a NodeStyle color) of every style id."""
+    palette = tree_image.tree_data.styles.palette(attr, get_rgba)
+    return [QColor.fromRgba(int(rgba)) for rgba in palette]
+
+def get_point_pairs(coords):
+    """Rows x0, y0, x1, y1 of coords as an array of QPointF pairs for
+    QPainter.drawLines, filled from numpy in one copy."""
+    if not hasattr(sip, "array"):  # sip < 6.7
+        return [QLineF(*c) for c in coords.tolist()]
+    points = sip.array(QPointF, 2 * len(coords))
+    np.frombuffer(memoryview(points).cast("B"), np.float64)[:] = coords.ravel()
+    return points
+
+def draw_lines(pp, lines, styles, colors, M):
+    """Draws lines (arrays x0, y0, x1, y1 in the untransformed scene) mapped
+    by M (scale and translation only), with a drawLines call per style id."""
+    x0, y0, x1, y1 = (np.asarray(v, dtype=np.float64) for v in lines)
+    sx, sy, dx, dy = M.m11(), M.m22(), M.dx(), M.dy()
+    coords = np.column_stack([x0 * sx + dx, y0 * sy + dy, x1 * sx + dx, y1 * sy + dy])
+    for sid in np.unique(styles).tolist():
+        pp.setPen(colors[sid])
+        pp.drawLines(get_point_pairs(coords[styles == sid]))
+
+def get_visible_angles(rect):
+    """Angle range (a0, a1) of the untransformed scene rect (x0, y0, x1, y1)
+    seen from the center of the tree, or None if it contains the center."""
+    x0, y0, x1, y1 = rect
+    if x0 <= 0 <= x1 and y0 <= 0 <= y1:
+        return None
+    middle = math.atan2((y0 + y1) / 2, (x0 + x1) / 2)
+    corners = np.arctan2([y0, y0, y1, y1], [x0, x1, x0, x1]) - middle
+    corners = (corners + math.pi) % (2 * math.pi) - math.pi
+    return middle + corners.min(), middle + corners.max()
+
+def get_arc_segments(rad, a0, a1, zoom, rect=None):
+    """Polar segments (index of the arc, start and end angles) of the arcs
+    of radius rad from angles a0 to a1, as seen at zoom. With the
+    untransformed scene rect, only their parts in its angle range."""
+    a0, a1 = np.minimum(a0, a1), np.maximum(a0, a1)
+    arcs = np.arange(len(rad))
+    visible = get_visible_angles(rect) if rect is not None else None
+    if visible is not None and len(arcs):
+        # an arc can reach the range at any turn, so it is cut at all of them
+        turns = range(math.floor((a0.min() - visible[1]) / (2 * math.pi)),
+                      math.ceil((a1.max() - visible[0]) / (2 * math.pi)) + 1)
+        pieces = [(arcs, np.maximum(a0, visible[0] + 2 * math.pi * turn),
+                   np.minimum(a1, visible[1] + 2 * math.pi * turn)) for turn in turns]
+        arcs, a0, a1 = (np.concatenate(v) for v in zip(*pieces))
+        keep = a1 > a0
+        arcs, a0, a1 = arcs[keep], a0[keep], a1[keep]
+
+    # segments per arc, and their position k in it
+    span = a1 - a0
+    nsegs = np.clip(np.ceil(rad[arcs] * span * zoom / ARC_SEGMENT_PX),
+                    1, MAX_ARC_SEGMENTS).astype(np.int64)
+    first = np.cumsum(nsegs) - nsegs
+    seg_arcs = np.repeat(np.arange(len(arcs)), nsegs)
+    k = np.arange(len(seg_arcs)) - first[seg_arcs]
+    step = (span / nsegs)[seg_arcs]
+    start = a0[seg_arcs] + k * step
+    return arcs[seg_arcs], start, start + step
+
+def draw_branches(pp, tree_image, img_data, nodes, M, root_open, anchor=(0.0, 0.0),
+                  rect=None):
+    """Draws the branches of nodes and the lines connecting their first and
+    last children, grouped by style. In circular mode, anchor is the
+    cartesian point subtracted from all positions (see M), and only the
+    parts of the arcs in the angle range of rect (the untransformed scene
+    rect x0, y0, x1, y1, if given) are drawn."""
+    topology = tree_image.topology
+    circular = tree_image.tree_style.mode == "c"
+    style_ids = tree_image.tree_data.style_ids
+    hz_colors = get_style_colors(tree_image, "hz_line_color")
+    vt_colors = get_style_colors(tree_image, "vt_line_color")
+
+    styles = style_ids[nodes]
+    parent_radius = img_data[topology.parent[nodes], _rad if circular else _xend]
+    parent_radius = np.where(nodes == 0, root_open, parent_radius)
+    end_radius = parent_radius + img_data[nodes, _blen]
+    center = np.asarray(img_data[nodes, _acenter], dtype=np.float64)
+
+    # internal nodes with more than one child
+    ptr = topology.child_ptr
+    inner = np.flatnonzero(ptr[nodes + 1] - ptr[nodes] > 1)
+    acen_0 = img_data[topology.child_ids[ptr[nodes[inner]]], _acenter]
+    acen_1 = img_data[topology.child_ids[ptr[nodes[inner] + 1] - 1], _acenter]
+    if circular:
+        ax, ay = anchor
+        # arcs are drawn as polylines, with the lines of each style at once
+        rad = np.asarray(img_data[nodes[inner], _rad], dtype=np.float64)
+        arcs, start, end = get_arc_segments(rad, np.asarray(acen_0, dtype=np.float64),
+                                            np.asarray(acen_1, dtype=np.float64),
+                                            M.m11(), rect)
+        r = rad[arcs]
+        draw_lines(pp, (r * np.cos(start) - ax, r * np.sin(start) - ay,
+                        r * np.cos(end) - ax, r * np.sin(end) - ay),
+                   styles[inner][arcs], vt_colors, M)
+
+        cos, sin = np.cos(center), np.sin(center)
+        draw_lines(pp, (end_radius * cos - ax, end_radius * sin - ay,
+                        parent_radius * cos - ax, parent_radius * sin - ay),
+                   styles, hz_colors, M)
+    else:
+        draw_lines(pp, (end_radius[inner], acen_0, end_radius[inner], acen_1),
+                   styles[inner], vt_colors, M)
+        draw_lines(pp, (parent_radius, center, end_radius, center),
+                   styles, hz_colors, M)
+
 def get_qt_corrected_angle(rad, angle):
     path = QPainterPath()
     inner_diam = rad * 2.0
@@ -151,11 +270,11 @@ def get_arc_path(inner_r, outter_r, rad_angles):
     return path
 
 
-def get_tile_img(pp, tree_image, zoom_factor, treemode, tile_rect):
+def get_tile_img(tree_image, zoom_factor, treemode, tile_rect):
     # Create an empty tile image
     source_rect = QRectF(*tile_rect)
     target_rect = QRectF(0, 0, source_rect.width(), source_rect.height())
-    ii = QImage(source_rect.width(), source_rect.height(),
+    ii = QImage(int(source_rect.width()), int(source_rect.height()),
                 QImage.Format_ARGB32_Premultiplied)
     ii.fill(QColor(Qt.white).rgb())
 
@@ -174,11 +293,21 @@ def get_tile_img(pp, tree_image, zoom_factor, treemode, tile_rect):
     matrix = QTransform().translate(-source_rect.left(), -source_rect.top())
     pp.setWorldTransform(matrix, True)
     # Paint on tile
-    draw_region(tree_image, pp, zoom_factor, source_rect)
+    draw_tree_scene_region(pp, tree_image, zoom_factor, source_rect)
     pp.end()
     return ii
 
 
+def get_tile_png(tree_image, zoom_factor, tile_rect):
+    """PNG image (bytes) of a tile of the scene."""
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    get_tile_img(tree_image, zoom_factor, tree_image.tree_style.mode, tile_rect).save(buf, "PNG")
+    buf.close()
+    return bytes(data)
+
+
 @timeit
 def draw_tree_scene_region(pp, tree_image, zoom_factor, scene_rect):
     """ Draws a region of the scene.
@@ -188,10 +317,10 @@ def draw_tree_scene_region(pp, tree_image, zoom_factor, scene_rect):
 
         """
 
-    img_data = tree_image.img_data
+    img_data = tree_image.scene_data
+    root_open = tree_image.root_open
     treemode = tree_image.tree_style.mode
     if treemode == 'c':
-        collision_paths = tree_image.circ_collision_paths
         cx = tree_image.radius[0]
         cy = cx
 
@@ -209,8 +338,6 @@ def draw_tree_scene_region(pp, tree_image, zoom_factor, scene_rect):
         M.translate(cx, cy)
 
     elif treemode == 'r':
-        collision_paths = tree_image.rect_collision_paths
-
         # untransformed scene rect used to calculate overlaps with original node
         # positions and sizes
         m = QTransform()
@@ -231,51 +358,87 @@ def draw_tree_scene_region(pp, tree_image, zoom_factor, scene_rect):
     # DEBUG INFO
     DRAWN, OUTSIDE, COLLAPSED, ITERS = 0, 0, 0, 0
 
-    curr = 0
-    nid = curr
-    end = img_data[curr][_max_leaf_idx] + 1
+    # nodes visited at this zoom (all their ancestors are expanded) in the
+    # scene region, in preorder
+    zoom_index = tree_image.zoom_index
+    nodes = tree_image.region_index.visible(zoom_index, zoom_factor,
+                                            m_scene_rect.left(), m_scene_rect.top(),
+                                            m_scene_rect.right(), m_scene_rect.bottom())
+    # full bounds of all the nodes, and whether they overlap the scene rect.
+    # The vertical range is checked on the bounding boxes alone
+    rect = (m_scene_rect.left(), m_scene_rect.top(),
+            m_scene_rect.right(), m_scene_rect.bottom())
+    fbounds = collision.node_bounds(tree_image, nodes, full=True)
+    fboxes = collision.bounding_boxes(tree_image, fbounds)
+    in_y = ((fboxes[1] < rect[3]) & (fboxes[3] > rect[1]) &
+            (fboxes[2] > fboxes[0]) & (m_scene_rect.width() > 1))
+    in_rect = collision.intersects(tree_image, fbounds, rect)
+    # faces of all the nodes that can be drawn, loaded at once for batch
+    # layout functions
+    tree_image.load_node_faces(nodes[in_y & in_rect])
+
+    # In deep zoom mode, trees are drawn around a node of the region, so that
+    # Qt only gets small offsets from it. Circular positions are polar, so
+    # their cartesian coordinates are taken relative to the node's instead
+    ax, ay = 0.0, 0.0
+    if tree_image.frames is not None and len(nodes):
+        anchor = img_data[int(nodes[len(nodes) // 2])]
+        if treemode == "r":
+            ax, ay = anchor[_xend], anchor[_ystart]
+            img_data = img_data.anchored([ax, ay, ay, ay])
+            root_open -= ax
+            M = QTransform()
+            M.translate(ax * zoom_factor, ay * zoom_factor)
+            M.scale(zoom_factor, zoom_factor)
+        else:
+            ax, ay = pol2cart(anchor[_rad], anchor[_acenter])
+            M = QTransform()
+            M.scale(zoom_factor, zoom_factor)
+            M.translate(cx + ax, cy + ay)
+
+    # Branches of all the expanded nodes drawn below (those in the scene rect,
+    # and not under a node skipped for being out of the vertical range) are
+    # drawn at once, one call per style
+    topology = tree_image.topology
+    skipped = np.zeros(len(nodes) + 1, dtype=np.int64)
+    out_y = np.flatnonzero(~in_y)
+    np.add.at(skipped, out_y + 1, 1)
+    np.add.at(skipped, np.searchsorted(nodes, topology.end[nodes[out_y]] + 1), -1)
+    reached = np.cumsum(skipped)[:-1] == 0
+    expanded = topology.is_leaf[nodes] | (zoom_index.expand_zoom[nodes] <= zoom_factor)
+    draw_branches(pp, tree_image, img_data, nodes[reached & in_y & in_rect & expanded],
+                  M, root_open, (ax, ay), rect)
+
+    k = 0
     max_observed_radius = 0
     visible_leaves = []
     terminal_nodes = []
     visible_labels = []
     start_x_aligned_faces = 0
     farthest_fpath = None
-    while curr < end:
+    while k < len(nodes):
         ITERS += 1
         draw_collapsed = False
-        nid = curr
+        nid = int(nodes[k])
         node = tree_image.cached_preorder[nid]
         dim = img_data[nid]
-        nsize = nid - tree_image.img_data[nid][_max_leaf_idx]+1
+        nsize = nid - img_data[nid][_max_leaf_idx]+1
         branch_length = dim[_blen]
 
-        # Compute node and full paths for the node
-        if collision_paths[nid][0] is None:
-            if treemode == "c":
-                path, fpath = get_node_arc_path(tree_image, nid)
-            elif treemode == "r":
-                path, fpath = get_node_rect_path(tree_image, nid)
-            collision_paths[nid] = [path, fpath]
-        else:
-            path, fpath = collision_paths[nid]
-
         not_visible = False
-        brect = fpath.boundingRect()
-        top_left = brect.topLeft()
-        y_range = QRectF(m_scene_rect.x()+1, top_left.y(), brect.width(), brect.height())
-        if not m_scene_rect.intersects(y_range):
+        if not in_y[k]:
             # if the node is outside the vertical range, skip it (no draw no
             # visiable terminal nodes)
-            new_curr = max(int(dim[_max_leaf_idx]+1), curr)
             OUTSIDE += 1
-            curr = new_curr
 
-            y_range = QRectF(m_scene_rect.x()+1, top_left.y(), brect.width(), brect.height())
+            x0, y0, x1, y1 = (b[k] for b in fboxes)
+            y_range = QRectF(m_scene_rect.x()+1 - ax, y0 - ay, x1 - x0, y1 - y0)
             pp.setPen(QPen(QColor("red")))
             pp.drawRect(M.mapRect(y_range))
 
+            k = np.searchsorted(nodes, dim[_max_leaf_idx] + 1)
             continue
-        elif not fpath.intersects(m_scene_rect):
+        elif not in_rect[k]:
             # if in the y range, but not in the x range. Don't draw it, but
             # keeps the iteration to find terminal nodes.
             not_visible = True
@@ -288,39 +451,16 @@ def draw_tree_scene_region(pp, tree_image, zoom_factor, scene_rect):
         #     curr = new_curr
         #     continue
 
-        # Calculate how much space is there at this zoom for drawing the node
-        if treemode == 'c' and dim[_fnh] >= R180:
-            node_height = MAX_SCREEN_SIZE
-            node_height_up = MAX_SCREEN_SIZE
-            node_height_down = MAX_SCREEN_SIZE
-        elif treemode == 'c':
-            node_height = (
-                (math.sin(dim[_fnh]/2.0) * dim[_fnw]) * 2) * zoom_factor
-            node_height_up = (
-                (math.sin(dim[_acenter]-dim[_astart]) * dim[_fnw])) * zoom_factor
-            node_height_down = (
-                (math.sin(dim[_aend]-dim[_acenter]) * dim[_fnw])) * zoom_factor
-        elif treemode == 'r':
-            node_height = brect.height() * zoom_factor
-            node_width = brect.width() * zoom_factor
-            node_height_up = node_height / 2.0
-            node_height_down = node_height / 2.0
-
+        k += 1
         if dim[_is_leaf]:
-            curr += 1
             is_terminal = True
-        elif (node_height_up < COLLAPSE_RESOLUTION) \
-           or node_height_down < COLLAPSE_RESOLUTION \
-           or node_width < W_COLLAPSE_RESOLUTION \
-           or node_height/(len(node.children)+1) < 3:
-            # If this is an internal node which is being drawn very samll, draw
-            # it as a collapsed terminal, and skip the subtree down.
-            curr = int(dim[_max_leaf_idx] + 1)
+        elif zoom_index.is_collapsed(nid, zoom_factor):
+            # If this is an internal node which is being drawn very small, draw
+            # it as a collapsed terminal (its subtree is not visited)
             draw_collapsed = True
             is_terminal = True
             COLLAPSED += 1
         else:
-            curr += 1
             is_terminal = False
 
         if is_terminal:
@@ -334,50 +474,33 @@ def draw_tree_scene_region(pp, tree_image, zoom_factor, scene_rect):
             continue
 
         # If it gets to here, draw the node
-        pp.save()
         DRAWN += 1
 
         # Load faces and styles for the node by applying user's layout function
-        if not node._temp_faces:
-            node._temp_faces = None
-            for func in tree_image.tree_style.layout_fn:
-                func(node)
-
-            # if node was not visited yet, compute face dimensions
-            if not np.any(dim[_btw:_bah+1]):
-                face_pos_sizes = layout.compute_face_dimensions(
-                    node, node._temp_faces)
-                dim[_btw:_bah+1] = face_pos_sizes
+        facegrid = tree_image.load_faces(node)
 
         if draw_collapsed:
             pp.setPen(QPen(QColor("LightSteelBlue")))
 
             #pp.save()
             #pp.translate(1, 0)
-            pp.drawPath(M.map(fpath))
-            #parent_radius = img_data[int(dim[_parent])][_rad] if nid else tree_image.root_open
+            if treemode == "c":
+                _, fpath = get_node_arc_path(tree_image, nid)
+            else:
+                _, fpath = get_node_rect_path(tree_image, nid)
+            pp.drawPath(M.map(fpath.translated(-ax, -ay)))
+            #parent_radius = img_data[int(dim[_parent])][_rad] if nid else root_open
             #pp.drawLine(M.map(QLineF(parent_radius, dim[_acenter],
             #            parent_radius+branch_length, dim[_acenter])))
             #pp.restore()
 
-        else:
+        elif facegrid:
+            # branch lines were already drawn by draw_branches, only faces
+            # are left
+            pp.save()
             if treemode == "c":
                 parent_radius = img_data[int(
-                    dim[_parent])][_rad] if nid else tree_image.root_open
-
-                # Draw arc line connecting children
-                if not dim[_is_leaf] and len(node.children) > 1:
-                    acen_0 = tree_image.img_data[node.children[0]._id][_acenter]
-                    acen_1 = tree_image.img_data[node.children[-1]._id][_acenter]
-                    pp.setPen(QColor(node.img_style.vt_line_color))
-                    vLinePath = get_arc_path(
-                        dim[_rad], dim[_rad], [acen_0, acen_1])
-                    pp.drawPath(M.map(vLinePath))
-
-                hLinePath = get_arc_path(
-                    parent_radius, parent_radius+branch_length, [dim[_acenter]])
-                pp.setPen(QColor(node.img_style.hz_line_color))
-                pp.drawPath(M.map(hLinePath))
+                    dim[_parent])][_rad] if nid else root_open
 
                 new_rad, new_angle = get_qt_corrected_angle(
                     parent_radius, dim[_acenter])
@@ -389,26 +512,14 @@ def draw_tree_scene_region(pp, tree_image, zoom_factor, scene_rect):
 
             elif treemode == "r":
                 parent_radius = img_data[int(
-                    dim[_parent])][_xend] if nid else tree_image.root_open
+                    dim[_parent])][_xend] if nid else root_open
                 new_rad = parent_radius
-                # Draw vertical line connecting children
-                if not dim[_is_leaf] and len(node.children) > 1:
-                    acen_0 = tree_image.img_data[node.children[0]._id][_acenter]
-                    acen_1 = tree_image.img_data[node.children[-1]._id][_acenter]
-                    pp.setPen(QColor(node.img_style.vt_line_color))
-                    pp.drawLine(M.map(QLineF(parent_radius+branch_length, acen_0,
-                                             parent_radius+branch_length, acen_1)))
-
-                pp.setPen(QColor(node.img_style.hz_line_color))
-                pp.drawLine(M.map(QLineF(parent_radius, dim[_acenter],
-                                         parent_radius+branch_length, dim[_acenter])))
 
-                pp.translate(parent_radius*zoom_factor,
-                             dim[_ycenter]*zoom_factor)
+                pp.translate(M.map(QPointF(parent_radius, dim[_ycenter])))
 
                 endx = draw_faces(pp, 0, 0, node, zoom_factor, tree_image,
                                   is_collapsed=False, target_positions=set([0, 1, 2, 3]))
-        pp.restore()
+            pp.restore()
 
         # If the node is terminal, it should be used to adjust the aligned face
         # start_x position dynamically. If the end_x position of the terminal
@@ -459,28 +570,7 @@ def get_face_dimensions(node, facegrid, target_pos=None):
     poscol2faces = defaultdict(listdict)
 
     for index, (f, pos, row, col, _, _) in enumerate(facegrid):
-        f.node = node
-        fw, fh = f._size()
-        fw += f.margin_right + f.margin_left
-        fh += f.margin_top + f.margin_bottom
-
-        # correct dimensions in case face is rotated
-        if f.rotation:
-            if f.rotation == 90 or f.rotation == 270:
-                fw, fh = fh, fw
-            elif f.rotation == 180:
-                pass
-            else:
-                x0 =  fw / 2.0
-                y0 =  fh / 2.0
-                theta = (f.rotation * math.pi) / 180
-                trans = lambda x, y: (x0+(x-x0) * math.cos(theta) + (y-y0) * math.sin(theta),
-                                      y0-(x-x0) * math.sin(theta) + (y-y0) * math.cos(theta))
-                coords = (trans(0,0), trans(0,fh), trans(fw,0), trans(fw,fh))
-                x_coords = [e[0] for e in coords]
-                y_coords = [e[1] for e in coords]
-                fw = max(x_coords) - min(x_coords)
-                fh = max(y_coords) - min(y_coords)
+        fw, fh = layout.get_face_size(f, node)
 
         # Update overal grid data
         poscol2w[pos][col].append(fw)
@@ -498,25 +588,16 @@ def get_face_dimensions(node, facegrid, target_pos=None):
 
 def draw_aligned_panel_region(pp, terminal_nodes, tree_image, zoom_factor, scene_rect):
     #pp.setClipRect(scene_rect)
-    img_data = tree_image.img_data
+    img_data = tree_image.scene_data
     treemode = tree_image.tree_style.mode
 
+    tree_image.load_node_faces([node._id for node in terminal_nodes])
     for node in terminal_nodes:
-        dim = tree_image.img_data[node._id]
+        dim = img_data[node._id]
         avail_h = dim[_fnh] * zoom_factor
         avail_w = MAX_SCREEN_SIZE
 
-        if node._temp_faces is None:
-            for func in tree_image.tree_style.layout_fn:
-                func(node)
-            # if node was not visited yet, compute face dimensions
-            if not np.any(dim[_btw:_bah+1]):
-                face_pos_sizes = layout.compute_face_dimensions(
-                    node, node._temp_faces)
-                dim[_btw:_bah+1] = face_pos_sizes
-
-        # if node was not visited yet, compute face dimensions
-        pos2dim, poscol2w, poscol2h, poscol2faces = get_face_dimensions(node, node._temp_faces)
+        facegrid = tree_image.load_faces(node)
 
         pp.save()
         if treemode == "c":
@@ -529,10 +610,13 @@ def draw_aligned_panel_region(pp, terminal_nodes, tree_image, zoom_factor, scene
             pass
         elif treemode == "r":
             pp.translate(0, dim[_ycenter]*zoom_factor)
-            for col, colfaces in poscol2faces[4].items():
-                col_w = max(poscol2w[4][col])
-                col_h = sum(poscol2h[4][col])
-                draw_face_column(pp, node, colfaces, col_w, col_h, avail_w, avail_h)
+            for pos, columns in tree_image.get_face_grid(node):
+                if pos != 4:
+                    continue
+                for col, col_w, col_h, faceidxs in columns:
+                    colfaces = [(facegrid[i][0], facegrid[i][4], facegrid[i][5])
+                                for i in faceidxs]
+                    draw_face_column(pp, node, colfaces, col_w, col_h, avail_w, avail_h)
         pp.restore()
 
 def draw_face_column(pp, node, colfaces, col_w, col_h, avail_w, avail_h):
@@ -560,9 +644,9 @@ def draw_face_column(pp, node, colfaces, col_w, col_h, avail_w, avail_h):
 def draw_faces(pp, x, y, node, zoom_factor, tree_image, is_collapsed,
                target_positions=None, target_rect=None):
 
-    dim = tree_image.img_data[node._id]
+    dim = tree_image.scene_data[node._id]
     branch_length = dim[_blen]
-    facegrid = node._temp_faces
+    facegrid = tree_image.load_faces(node)
     tree_mode = tree_image.tree_style.mode
     if not facegrid:
         return
@@ -635,32 +719,20 @@ def draw_faces(pp, x, y, node, zoom_factor, tree_image, is_collapsed,
         pos2params[pos] = [start_x, available_pos_width,
                            available_pos_height, facegrid_width, facegrid_height]
 
-    # calculate face information per pos and columns (face list, column width
-    # and height)
-    pos2colfaces = {}
-    poscol2width = {}
-    poscol2height = {}
+    # face columns (face list, column width and height) of each position
+    skip_leaf_only = not dim[_is_leaf] and not is_collapsed
 
-    for faceidx, (face, pos, row, col, fw, fh) in enumerate(facegrid):
+    # Set up each face position and available space, and call draw_face
+    for pos, columns in tree_image.get_face_grid(node, skip_leaf_only):
         if target_positions is not None and pos not in target_positions:
             continue
-        if not dim[_is_leaf] and face.only_if_leaf and not is_collapsed:
-            continue
-        pos2colfaces.setdefault(pos, {}).setdefault(col, []).append(faceidx)
-        poscol2width[(pos, col)] = max(fw, poscol2width.get((pos, col), 0))
-        poscol2height[(pos, col)] = poscol2height.get((pos, col), 0) + fh
-
-    # Set up each face position and available space, and call draw_face
-    for pos, columns in pos2colfaces.items():
         (start_x, avail_pos_width, avail_pos_height,
          pos_width, pos_height) = pos2params[pos]
 
         # TODO: Skip if facegrid too small
 
-        for col, selected_faces in columns.items():
+        for col, col_width, col_height, selected_faces in columns:
 
-            col_height = poscol2height[(pos, col)]
-            col_width = poscol2width[(pos, col)]
             avail_col_width = min(col_width,
                                   ((col_width / pos_width) * avail_pos_width))
             avail_col_height = min(col_height,
@@ -862,7 +934,7 @@ def draw_faces(pp, x, y, node, zoom_factor, tree_image, is_collapsed,
 #                 func(node)
 
 #         pp.save()
-#         parent_radius = img_data[int(dim[_parent])][_rad] if nid else tree_image.root_open
+#         parent_radius = img_data[int(dim[_parent])][_rad] if nid else root_open
 #         node = tree_image.cached_preorder[nid]
 
 #         if draw_collapsed:
@@ -875,8 +947,8 @@ def draw_faces(pp, x, y, node, zoom_factor, tree_image, is_collapsed,
 
 #             # Draw arc line connecting children
 #             if not dim[_is_leaf] and len(node.children) > 1:
-#                 acen_0 = tree_image.img_data[node.children[0]._id][_acenter]
-#                 acen_1 = tree_image.img_data[node.children[-1]._id][_acenter]
+#                 acen_0 = img_data[node.children[0]._id][_acenter]
+#                 acen_1 = img_data[node.children[-1]._id][_acenter]
 #                 pp.setPen(QColor(node.img_style.vt_line_color))
 #                 vLinePath = get_arc_path(dim[_rad], dim[_rad], [acen_0, acen_1])
 #                 pp.drawPath(M.map(vLinePath))
@@ -1,23 +1,24 @@
-import bottle
 from random import randint
 from json import dumps
+import os
 import time
 import logging
 from .alg import SparseAlg, TreeAlignment, Alg, DiskHashAlg
 from .utils import colorify
 from .common import *
 from . import common
-from .main import TreeImage, gui
+from .main import TreeImage
+from . import gui, server, async_server, prefork, tiles
+from .tree_registry import TreeRegistry
 from .face import RectFace, TextFace, AttrFace, LabelFace, CircleLabelFace, GradientFace, HeatmapArcFace, HeatmapFace, SeqMotifFace
-from .style import TreeStyle, add_face_to_node
+from .style import TreeStyle, add_face_to_node, batch_layout, face_batch
+from . import branch_lengths
 from .ctree import Tree
 from argparse import ArgumentParser
 import numpy as np
 import math
 import random
 import sys
-import pyximport
-pyximport.install()
 
 #from .. import Tree
 
@@ -52,6 +53,9 @@ def populate_args(parser):
         "-t", dest="src_trees", type=str, help="target tree in newick format")
     tree_input_args.add_argument(
         "-s", dest="size", type=int, help="Random tree size (for testing purposes)")
+    tree_input_args.add_argument(
+        "--trees", dest="trees", type=str,
+        help="serve the trees in a directory or JSON manifest ({id: newick path}), implies --nogui")
 
     parser.add_argument("-a", dest="alg", help="Bind alignment")
 
@@ -59,8 +63,47 @@ def populate_args(parser):
                         help="(c)icular or (r)ect ")
 
     parser.add_argument("-b", dest='branch_mode', default=None,
-                        help="")
+                        choices=sorted(branch_lengths.STRATEGIES),
+                        help="branch length adjustment strategy")
+    parser.add_argument("--bench_branch_modes", dest="bench_branch_modes",
+                        action="store_true",
+                        help="time all branch length strategies on the tree and exit")
     parser.add_argument("--scale", dest="scale", type=float, default=None)
+    parser.add_argument("--optimal_scale", dest="optimal_scale", action="store_true",
+                        help="scale circular trees so that all leaves fit in their apertures")
+    parser.add_argument("--deep_zoom", dest="deep_zoom", action="store_true",
+                        help="use float64 node positions, to zoom into single leaves of huge trees")
+    parser.add_argument("--layout_workers", dest="layout_workers", type=int, default=0,
+                        help="number of processes used to lay out large trees (only faster "
+                        "for trees of millions of nodes, with as many idle cores)")
+    parser.add_argument("--face_cache_mb", dest="face_cache_mb", type=float, default=64,
+                        help="memory (in MB) for the faces of drawn nodes")
+    parser.add_argument("--async_server", dest="async_server", action="store_true",
+                        help="with --nogui, use the asynchronous server (needs aiohttp)")
+    parser.add_argument("--server_workers", dest="server_workers", type=int, default=1,
+                        help="number of processes rendering scene regions in the asynchronous server")
+    parser.add_argument("--prefork", dest="prefork", type=int, default=0,
+                        help="with --nogui, serve from this number of pre-forked worker processes")
+    parser.add_argument("--prefetch", dest="prefetch_budget", type=float, default=0,
+                        const=0.5, nargs="?", metavar="BUDGET",
+                        help="prefetch the regions likely to be requested next, using up to "
+                        "this fraction of a core (0.5 if not given)")
+    parser.add_argument("--server_cache_mb", dest="server_cache_mb", type=float, default=128,
+                        help="memory (in MB) for the scene regions cached by the server")
+    parser.add_argument("--tree_id", dest="tree_id", type=str, default="tree",
+                        help="id of the tree in the server urls (/tiles/<tree_id>/...)")
+    parser.add_argument("--trees_mb", dest="trees_mb", type=float, default=1024,
+                        help="memory (in MB) for the trees loaded by the server with --trees "
+                        "(per worker with --prefork; faces and the region cache not included)")
+    parser.add_argument("--tiles_dir", dest="tiles_dir", type=str, default=None,
+                        help="directory with pre-rendered tiles for the server")
+    parser.add_argument("--prerender_tiles", dest="prerender_tiles", type=str, default=None,
+                        help="render the top --tile_levels levels of tiles to this directory and exit")
+    parser.add_argument("--tile_levels", dest="tile_levels", type=int, default=4)
+    parser.add_argument("--tile_format", dest="tile_format", default="png",
+                        choices=["png", "bin"])
+    parser.add_argument("--tile_workers", dest="tile_workers", type=int, default=1,
+                        help="number of processes rendering tiles")
     parser.add_argument("--newick_format", dest="nwformat",
                         type=int, default=0)
 
@@ -73,7 +116,7 @@ def populate_args(parser):
     parser.add_argument("-z", dest="zoom_factor",
                         type=float, help="initial zoom level")
     parser.add_argument("-l", dest="layout", type=str,
-                        help="layout function to use", default="basic_layout")
+                        help="layout function to use", default="basic_batch_layout")
     parser.add_argument("--debug", dest="debug",
                         action="store_true", help="enable debug mode")
     parser.add_argument("--mem", dest="track_mem",
@@ -217,6 +260,19 @@ def basic_layout(node):
             #add_face_to_node(nameF, node, column=0, position="branch-top")
 
 
+@batch_layout
+def basic_batch_layout(nodes, img_data, tree_data):
+    """Same faces as basic_layout, added to all nodes at once."""
+    leaves = nodes[img_data[nodes, _is_leaf] == 1]
+    internal = nodes[img_data[nodes, _is_leaf] == 0]
+    internal = internal[tree_data.get_node_column("name")[internal] != ""]
+    return face_batch([nameF, distF], np.concatenate([leaves, internal]),
+                      np.repeat([0, 1], [len(leaves), len(internal)]),
+                      np.repeat([FACEPOS2CODE["branch-right"], FACEPOS2CODE["branch-bottom"]],
+                                [len(leaves), len(internal)]),
+                      0)
+
+
 def stacked_layout(node, dim=None):
     if node.is_leaf():
         add_face_to_node(nameF, node, column=0, position="branch-right")
@@ -277,6 +333,50 @@ def clean_layout(node):
     pass
 
 
+def get_tree_style(args):
+    ts = TreeStyle()
+    ts.layout_fn = globals()[args.layout]
+    ts.mode = args.mode
+    ts.branch_mode = args.branch_mode
+    ts.optimal_scale = args.optimal_scale
+    ts.deep_zoom = args.deep_zoom
+    ts.layout_workers = args.layout_workers
+    ts.face_cache_mb = args.face_cache_mb
+    ts.arc_span = args.arc_span
+    ts.arc_start = args.arc_start
+    return ts
+
+
+def serve(trees, args, tree_id):
+    if args.async_server:
+        async_server.start_async_server(trees, workers=args.server_workers,
+                                        cache_mb=args.server_cache_mb,
+                                        tree_id=tree_id, tiles_dir=args.tiles_dir,
+                                        prefetch_budget=args.prefetch_budget)
+    elif args.prefork:
+        prefork.start_prefork_server(trees, workers=args.prefork,
+                                     cache_mb=args.server_cache_mb,
+                                     tree_id=tree_id, tiles_dir=args.tiles_dir,
+                                     prefetch_budget=args.prefetch_budget)
+    else:
+        server.start_server(trees, cache_mb=args.server_cache_mb,
+                            tree_id=tree_id, tiles_dir=args.tiles_dir,
+                            prefetch_budget=args.prefetch_budget)
+
+
+def serve_trees(args):
+    """Serves the trees in args.trees, loading them on first request."""
+    registry = TreeRegistry.from_path(args.trees, get_tree_style=lambda: get_tree_style(args),
+                                      max_mb=args.trees_mb, newick_format=args.nwformat)
+    if not len(registry):
+        logger.error("No trees found in %s" % args.trees)
+        return
+    logger.info(colorify("Serving %d trees" % len(registry), "lblue"))
+    # requests without tree id go to --tree_id, or to the first tree
+    tree_id = args.tree_id if args.tree_id in registry else registry.ids()[0]
+    serve(registry, args, tree_id)
+
+
 def run(args):
     global N2LEAVES, N2CONTENT, ALG, MATRIX, BLOCK_SEQ_FACE
 
@@ -290,6 +390,9 @@ def run(args):
         h = hpy()
         h.setref()
 
+    if args.trees:
+        return serve_trees(args)
+
     logger.info(colorify("Building ETE tree", "lblue"))
 
     if args.size:
@@ -359,9 +462,7 @@ def run(args):
                                  for x in range(10)])
                 MATRIX[ch._id] = MATRIX[n._id] * rand
 
-    ts = TreeStyle()
-
-    ts.layout_fn = globals()[args.layout]
+    ts = get_tree_style(args)
     if args.alg:
         global ALG, BLOCK_SEQ_FACE
         #alg_dict = seqio.load_fasta(args.alg)
@@ -374,9 +475,6 @@ def run(args):
             ALG, seqtype='aa', seq_format="seq", gap_format="blank", poswidth=3, total_width=None)
         ts.layout_fn.append(alg_layout)
 
-    ts.mode = args.mode
-    ts.arc_span = args.arc_span
-    ts.arc_start = args.arc_start
     if args.scale:
         for n in t.traverse():
             n.dist *= args.scale
@@ -384,10 +482,24 @@ def run(args):
         for n in t.traverse():
             n.dist = np.log(1+n.dist) * 10
             n.dist = 5
-    gui.start_app()  # need to have a QtApp initiated for some operations
+    if not (args.nogui or args.prerender_tiles):
+        # servers only start it for PNG tiles (see tiles.render_tile)
+        gui.start_app()
 
     tree_image = TreeImage(t, ts)
 
+    if args.prerender_tiles:
+        ntiles = tiles.prerender_tiles(tree_image, args.prerender_tiles, args.tree_id,
+                                       args.tile_levels, args.tile_format, args.tile_workers)
+        print("%d tiles rendered in %s" % (ntiles, args.prerender_tiles))
+        return
+
+    if args.bench_branch_modes:
+        results = branch_lengths.benchmark(tree_image.topology,
+                                           tree_image.img_data[:, _fnh])
+        branch_lengths.print_benchmark(results, title="Branch length strategies")
+        return
+
     if args.profile:
         import cProfile
         import pstats
@@ -398,7 +510,7 @@ def run(args):
     if not args.nogui:
         gui.display(tree_image, zoom_factor=args.zoom_factor)
     else:
-        gui.start_server(tree_image)
+        serve(tree_image, args, args.tree_id)
 
     if args.profile:
         pr.disable()
@@ -5,7 +5,11 @@ import numpy as np
 import re
 from . import colors
 import colorsys
-from .utils import timeit, debug
+from .utils import timeit, debug, LRUCache
+
+# Text sizes are measured with QFontMetrics only once per font and text
+TEXT_SIZE_CACHE_SIZE = 100000
+text_sizes = LRUCache(TEXT_SIZE_CACHE_SIZE)
 
 # Pick two colors. Values from 0 to 1. See "hue" at
 # http://en.wikipedia.org/wiki/HSL_and_HSV
@@ -340,19 +344,23 @@ class BaseTextFace(Face):
         self.formatter = formatter
 
     def _width(self):
-        fm = QFontMetrics(self._get_font())
-        text_rect = fm.boundingRect(self.text)
-        return text_rect.width()
+        return self._size()[0]
 
     def _height(self):
-        fm = QFontMetrics(self._get_font())
-        text_rect = fm.boundingRect(self.text)
-        return text_rect.height()
+        return self._size()[1]
+
+    def _size_key(self):
+        return (self.__class__, self.ftype, self.fsize, self.fstyle, self.text)
 
     def _size(self):
-        fm = QFontMetrics(self._get_font())
-        text_rect = fm.boundingRect(self.text)
-        return text_rect.width(), text_rect.height()
+        key = self._size_key()
+        size = text_sizes.get(key)
+        if size is None:
+            fm = QFontMetrics(self._get_font())
+            text_rect = fm.boundingRect(key[-1])
+            size = (text_rect.width(), text_rect.height())
+            text_sizes.put(key, size)
+        return size
 
     def _draw(self, painter, x, y, zoom_factor, w=None, h=None):
         painter.save()
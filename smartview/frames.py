@@ -0,0 +1,139 @@
+""" Float64 node positions for deep zoom.
+
+img_data keeps absolute positions in float32, which cannot tell leaves apart
+once a tree has millions of them (angles in circular mode run out of precision
+first). In deep zoom mode (TreeStyle.deep_zoom) positions are recomputed in
+float64 from the same layout data, and kept in hierarchical local frames: every
+clade of up to FRAME_LEAVES leaves shares a float64 origin, and its nodes only
+store small float32 offsets from it.
+
+Drawers read node rows through a FrameView, which returns float64 positions
+relative to an anchor, so that Qt only gets small coordinates. Parent and
+subtree end ids are taken from the topology too, since float32 cannot hold
+node ids above 2**24 either.
+"""
+import math
+
+import numpy as np
+
+from .common import *
+from .layout import cumsum_from_root
+from .nplayout import _first_leaves, _center_from_children
+
+# max number of leaves sharing the same frame origin
+FRAME_LEAVES = 1024
+
+# img_data columns holding node positions (_rad, _acenter, _astart, _aend in
+# circular mode, and _xend, _ycenter, _ystart, _yend in rect mode)
+POSITION_COLS = [_rad, _acenter, _astart, _aend]
+
+
+def get_positions(img_data, topology, mode, leaf_apertures=None, arc_start=0.0,
+                  root_opening=0.0):
+    """Returns the positions of all nodes (as in POSITION_COLS) in float64,
+    computed as the layout kernels do."""
+    nnodes = len(img_data)
+    leaves = topology.is_leaf
+    positions = np.zeros((nnodes, 4))
+    if mode == "c":
+        positions[:, 0] = root_opening + cumsum_from_root(img_data[:, _blen], topology.end)
+        steps = np.maximum(np.asarray(leaf_apertures, dtype=np.float64), 0.0)
+        start = math.radians(arc_start) + np.cumsum(steps) - steps
+        center = start + steps / 2.0
+    else:
+        positions[:, 0] = cumsum_from_root(img_data[:, _blen], topology.end)
+        dim = img_data[leaves].astype(np.float64)
+        steps = dim[:, _nht] + dim[:, _nhb] + dim[:, _bh]
+        start = np.cumsum(steps) - steps
+        center = start + dim[:, _nht] + dim[:, _bh] / 2.0
+
+    leaf_start = np.zeros(nnodes)
+    leaf_start[leaves] = start
+    leaf_end = np.zeros(nnodes)
+    leaf_end[leaves] = start + steps
+    leaf_center = np.zeros(nnodes)
+    leaf_center[leaves] = center
+
+    positions[:, 1] = _center_from_children(leaf_center, topology)
+    positions[:, 2] = leaf_start[_first_leaves(topology)]
+    positions[:, 3] = leaf_end[topology.end]
+    return positions
+
+
+class LocalFrames(object):
+    """Node positions stored as float32 offsets from float64 frame origins.
+
+    The frame of a node is its topmost ancestor with at most FRAME_LEAVES
+    leaves. Larger nodes (a few, near the root) are their own frame.
+    """
+    def __init__(self, positions, topology):
+        small = topology.nleaves <= FRAME_LEAVES
+        top = ~small.copy()
+        top[1:] |= ~small[topology.parent[1:]]
+        top[0] = True
+
+        frame_root = np.arange(len(positions))
+        for level in topology.levels[1:]:
+            inner = level[~top[level]]
+            frame_root[inner] = frame_root[topology.parent[inner]]
+
+        self.roots = np.flatnonzero(top)
+        self.frame = np.searchsorted(self.roots, frame_root).astype(np.int32)
+        self.origin = positions[self.roots]
+        self.offset = (positions - self.origin[self.frame]).astype(np.float32)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def positions(self, nodes):
+        """Absolute float64 positions of nodes (an id or an array of ids)."""
+        return self.origin[self.frame[nodes]] + self.offset[nodes]
+
+    def column(self, nodes, j):
+        """Absolute float64 values of the j-th position column."""
+        return self.origin[self.frame[nodes], j] + self.offset[nodes, j]
+
+
+class FrameView(object):
+    """Read-only img_data lookalike, where the position columns come from the
+    local frames as float64 values minus anchor (one value per position
+    column), and node ids from the topology.
+
+    Supports the indexing used by drawers and indexes: view[nid],
+    view[nodes] and view[nodes, col].
+    """
+    def __init__(self, img_data, frames, topology, anchor=None):
+        self.img_data = img_data
+        self.frames = frames
+        self.topology = topology
+        self.anchor = np.zeros(4) if anchor is None else np.asarray(anchor, dtype=np.float64)
+        self.shape = img_data.shape
+
+    def __len__(self):
+        return len(self.img_data)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            nodes, col = key
+            if isinstance(col, (int, np.integer)):
+                if col in POSITION_COLS:
+                    j = POSITION_COLS.index(col)
+                    return self.frames.column(nodes, j) - self.anchor[j]
+                elif col == _parent:
+                    return self.topology.parent[nodes]
+                elif col == _max_leaf_idx:
+                    return self.topology.end[nodes]
+            return self.img_data[key]
+
+        rows = self.img_data[key].astype(np.float64)
+        rows[..., POSITION_COLS] = self.frames.positions(key) - self.anchor
+        rows[..., _parent] = self.topology.parent[key]
+        rows[..., _max_leaf_idx] = self.topology.end[key]
+        return rows
+
+    def astype(self, dtype):
+        return self[np.arange(len(self))].astype(dtype)
+
+    def anchored(self, anchor):
+        """Same view, with positions relative to a new anchor."""
+        return FrameView(self.img_data, self.frames, self.topology, anchor)
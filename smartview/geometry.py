@@ -0,0 +1,244 @@
+""" Qt-free scene geometry.
+
+Computes the primitives drawn in a region of the scene (branch lines, arcs,
+collapsed node boxes and text anchors) as numpy arrays, with the style id of
+the node that produced each of them. Nodes are found with the same indexes as
+the Qt drawers, but nothing here imports Qt, so that the web server can run
+headless.
+
+All coordinates are in the transformed scene (zoomed, and translated to the
+tree center in circular mode), as the scene rect requested by clients.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from .common import *
+from . import collision
+
+# hz_lines, vt_lines: (n, 4) arrays of x0, y0, x1, y1
+# arcs: (n, 5) arrays of cx, cy, radius, start angle, end angle (radians,
+#   clockwise, since the y axis points down)
+# rects: (n, 4) arrays of x, y, w, h (boxes of collapsed nodes)
+# anchors: (n, 3) arrays of x, y, angle at the end of the branch of
+#   anchor_nodes, where their faces start
+# terminal: leaves and collapsed nodes reached in the region, as in the
+#   drawers (aligned faces are drawn for them)
+# bounds: (1, 4) array with the box x0, y0, x1, y1 around the full bounds
+#   (faces and descendants included) of the drawn nodes, or (0, 4) if none
+SceneGeometry = namedtuple("SceneGeometry", [
+    "hz_lines", "hz_styles", "vt_lines", "vt_styles", "arcs", "arc_styles",
+    "rects", "rect_styles", "anchors", "anchor_nodes", "terminal", "bounds"])
+
+
+def get_scene_transform(tree_image, zoom):
+    """Returns the (scale, dx, dy) that maps the untransformed scene into the
+    transformed one (x * scale + dx, y * scale + dy)."""
+    if tree_image.tree_style.mode == "c":
+        cx = float(tree_image.radius[0])
+        return zoom, cx * zoom, cx * zoom
+    return zoom, 0.0, 0.0
+
+def get_untransformed_rect(tree_image, zoom, x, y, w, h):
+    """Scene rect (x0, y0, x1, y1) in the untransformed scene."""
+    scale, dx, dy = get_scene_transform(tree_image, zoom)
+    return ((x - dx) / scale, (y - dy) / scale,
+            (x + w - dx) / scale, (y + h - dy) / scale)
+
+def get_overlaps(tree_image, fbounds, fboxes, rect):
+    """Masks of the nodes (with full bounds fbounds, and their boxes fboxes)
+    that overlap the vertical range of the (untransformed) rect, and the rect
+    itself."""
+    in_y = ((fboxes[1] < rect[3]) & (fboxes[3] > rect[1]) &
+            (fboxes[2] > fboxes[0]) & (rect[2] - rect[0] > 1))
+    return in_y, collision.intersects(tree_image, fbounds, rect)
+
+def get_region_nodes(tree_image, zoom, rect):
+    """Nodes visited at zoom in the (untransformed) scene rect, and masks
+    telling which ones are reached (no ancestor skipped for being out of
+    the vertical range), which ones overlap the rect, and which ones are
+    expanded."""
+    zoom_index = tree_image.zoom_index
+    topology = tree_image.topology
+    nodes = tree_image.region_index.visible(zoom_index, zoom, *rect)
+
+    fbounds = collision.node_bounds(tree_image, nodes, full=True)
+    fboxes = collision.bounding_boxes(tree_image, fbounds)
+    in_y, in_rect = get_overlaps(tree_image, fbounds, fboxes, rect)
+
+    # nodes out of the vertical range skip their whole subtree
+    skipped = np.zeros(len(nodes) + 1, dtype=np.int64)
+    out_y = np.flatnonzero(~in_y)
+    np.add.at(skipped, out_y + 1, 1)
+    np.add.at(skipped, np.searchsorted(nodes, topology.end[nodes[out_y]] + 1), -1)
+    reached = (np.cumsum(skipped)[:-1] == 0) & in_y
+    expanded = topology.is_leaf[nodes] | (zoom_index.expand_zoom[nodes] <= zoom)
+    return nodes, reached, reached & in_rect, expanded, fboxes
+
+def get_branch_ends(tree_image, nodes):
+    """Radius (x in rect mode) where the branch of each node starts and ends,
+    and its center angle (y)."""
+    img_data = tree_image.scene_data
+    col = _rad if tree_image.tree_style.mode == "c" else _xend
+    start = np.asarray(img_data[tree_image.topology.parent[nodes], col], dtype=np.float64)
+    start = np.where(nodes == 0, tree_image.root_open, start)
+    end = start + img_data[nodes, _blen]
+    return start, end, np.asarray(img_data[nodes, _acenter], dtype=np.float64)
+
+def get_branches(tree_image, nodes):
+    """Branches of nodes (hz_lines), and the lines (vt_lines, in rect mode)
+    or arcs (in circular mode) connecting their first and last children, in
+    the untransformed scene, with their style ids."""
+    img_data = tree_image.scene_data
+    topology = tree_image.topology
+    styles = tree_image.tree_data.style_ids[nodes]
+    start, end, center = get_branch_ends(tree_image, nodes)
+
+    # internal nodes with more than one child
+    ptr = topology.child_ptr
+    inner = np.flatnonzero(ptr[nodes + 1] - ptr[nodes] > 1)
+    acen_0 = np.asarray(img_data[topology.child_ids[ptr[nodes[inner]]], _acenter],
+                        dtype=np.float64)
+    acen_1 = np.asarray(img_data[topology.child_ids[ptr[nodes[inner] + 1] - 1], _acenter],
+                        dtype=np.float64)
+    if tree_image.tree_style.mode == "c":
+        cos, sin = np.cos(center), np.sin(center)
+        hz_lines = np.column_stack([start * cos, start * sin, end * cos, end * sin])
+        arcs = np.column_stack([np.zeros((len(inner), 2)), end[inner], acen_0, acen_1])
+        return hz_lines, styles, np.zeros((0, 4)), styles[:0], arcs, styles[inner]
+    hz_lines = np.column_stack([start, center, end, center])
+    vt_lines = np.column_stack([end[inner], acen_0, end[inner], acen_1])
+    return hz_lines, styles, vt_lines, styles[inner], np.zeros((0, 5)), styles[:0]
+
+def get_anchors(tree_image, nodes):
+    """Points (x, y, angle) at the end of the branch of nodes."""
+    _, end, center = get_branch_ends(tree_image, nodes)
+    if tree_image.tree_style.mode == "c":
+        return np.column_stack([end * np.cos(center), end * np.sin(center), center])
+    return np.column_stack([end, center, np.zeros(len(nodes))])
+
+def get_scene_geometry(tree_image, zoom, x, y, w, h):
+    """Returns the SceneGeometry of the scene rect (x, y, w, h) of
+    tree_image at zoom."""
+    zoom = max(0.00001, zoom)
+    rect = get_untransformed_rect(tree_image, zoom, x, y, w, h)
+    return make_scene_geometry(tree_image, zoom,
+                               *get_region_nodes(tree_image, zoom, rect))
+
+def get_scene_batches(tree_image, zoom, x, y, w, h, first_batch=256, max_batch=8192):
+    """Returns the nodes of the scene rect (x, y, w, h) of tree_image at zoom
+    in batches, coarse first: collapsed nodes, and then the branches of the
+    biggest clades down to the leaves. Batches start with first_batch nodes
+    and double up to max_batch. Each batch is (nodes, reached, drawn,
+    expanded, fboxes), as make_scene_geometry takes them."""
+    zoom = max(0.00001, zoom)
+    rect = get_untransformed_rect(tree_image, zoom, x, y, w, h)
+    nodes, reached, drawn, expanded, fboxes = get_region_nodes(tree_image, zoom, rect)
+
+    useful = np.flatnonzero(drawn | reached)
+    nleaves = tree_image.topology.nleaves[nodes[useful]]
+    order = useful[np.lexsort((-nleaves, expanded[useful]))]
+    batches = []
+    start, size = 0, first_batch
+    while True:
+        idx = order[start:start + size]
+        batches.append((nodes[idx], reached[idx], drawn[idx], expanded[idx],
+                        [b[idx] for b in fboxes]))
+        start += size
+        size = min(2 * size, max_batch)
+        if start >= len(order):
+            return batches
+
+def iter_scene_geometry(tree_image, zoom, x, y, w, h, first_batch=256, max_batch=8192):
+    """Yields the SceneGeometry of the scene rect (x, y, w, h) of tree_image
+    at zoom in batches of nodes (see get_scene_batches)."""
+    zoom = max(0.00001, zoom)
+    for batch in get_scene_batches(tree_image, zoom, x, y, w, h, first_batch, max_batch):
+        yield make_scene_geometry(tree_image, zoom, *batch)
+
+def join_scenes(scenes):
+    """SceneGeometry with the primitives of all scenes."""
+    arrays = [np.concatenate(arrs) for arrs in zip(*scenes)]
+    bounds = arrays[-1]
+    if len(bounds):
+        arrays[-1] = np.concatenate([bounds[:, :2].min(axis=0),
+                                     bounds[:, 2:].max(axis=0)])[np.newaxis]
+    return SceneGeometry(*arrays)
+
+def subtract_rect(rect, other):
+    """Parts (x, y, w, h) of rect not covered by other: up to 4 rects,
+    the ones above and below other as wide as rect."""
+    x, y, w, h = rect
+    ox, oy, ow, oh = other
+    x0, y0 = max(x, ox), max(y, oy)
+    x1, y1 = min(x + w, ox + ow), min(y + h, oy + oh)
+    if x0 >= x1 or y0 >= y1:
+        return [rect]
+    parts = [(x, y, w, y0 - y), (x, y1, w, y + h - y1),
+             (x, y0, x0 - x, y1 - y0), (x1, y0, x + w - x1, y1 - y0)]
+    return [part for part in parts if part[2] > 0 and part[3] > 0]
+
+def get_scene_delta(tree_image, zoom, x, y, w, h, known):
+    """Returns the SceneGeometry of the nodes drawn in the scene rect (x, y,
+    w, h) at zoom that are not drawn in the rect known (x, y, w, h, at the same
+    zoom), for clients that already have the primitives of known. Only the
+    parts of the rect out of known are searched."""
+    zoom = max(0.00001, zoom)
+    parts = [get_region_nodes(tree_image, zoom,
+                              get_untransformed_rect(tree_image, zoom, *part))
+             for part in subtract_rect((x, y, w, h), known)]
+    if not parts:
+        parts = [get_region_nodes(tree_image, zoom, (0, 0, 0, 0))]
+    nodes, reached, drawn, expanded = (np.concatenate([part[i] for part in parts])
+                                       for i in range(4))
+    fboxes = [np.concatenate([part[4][i] for part in parts]) for i in range(4)]
+
+    # nodes found in several parts, where they are drawn (or reached) if they
+    # are in any of them
+    order = np.lexsort((~reached, ~drawn, nodes))
+    _, first = np.unique(nodes[order], return_index=True)
+    keep = order[first]
+    nodes, reached, drawn, expanded = nodes[keep], reached[keep], drawn[keep], expanded[keep]
+    fboxes = [b[keep] for b in fboxes]
+
+    krect = get_untransformed_rect(tree_image, zoom, *known)
+    in_y, in_known = get_overlaps(tree_image,
+                                  collision.node_bounds(tree_image, nodes, full=True),
+                                  fboxes, krect)
+    known_nodes = in_y & in_known
+    return make_scene_geometry(tree_image, zoom, nodes, reached & ~known_nodes,
+                               drawn & ~known_nodes, expanded, fboxes)
+
+def make_scene_geometry(tree_image, zoom, nodes, reached, drawn, expanded, fboxes):
+    """Returns the SceneGeometry of the nodes at zoom, from the masks and
+    boxes of get_region_nodes()."""
+    hz_lines, hz_styles, vt_lines, vt_styles, arcs, arc_styles = get_branches(
+        tree_image, nodes[drawn & expanded])
+
+    # collapsed nodes are drawn as the bounding box of their subtree
+    collapsed = drawn & ~expanded
+    x0, y0, x1, y1 = (b[collapsed] for b in fboxes)
+    rects = np.column_stack([x0, y0, x1 - x0, y1 - y0])
+    rect_styles = tree_image.tree_data.style_ids[nodes[collapsed]]
+
+    anchor_nodes = nodes[drawn]
+    anchors = get_anchors(tree_image, anchor_nodes)
+
+    x0, y0, x1, y1 = (b[drawn] for b in fboxes)
+    if len(x0):
+        bounds = np.array([[x0.min(), y0.min(), x1.max(), y1.max()]], dtype=np.float64)
+    else:
+        bounds = np.zeros((0, 4))
+
+    # to the transformed scene
+    scale, dx, dy = get_scene_transform(tree_image, zoom)
+    hz_lines = hz_lines * scale + [dx, dy, dx, dy]
+    vt_lines = vt_lines * scale + [dx, dy, dx, dy]
+    arcs[:, :3] = arcs[:, :3] * scale + [dx, dy, 0.0]
+    rects = rects * scale + [dx, dy, 0.0, 0.0]
+    anchors[:, :2] = anchors[:, :2] * scale + [dx, dy]
+    bounds = bounds * scale + [dx, dy, dx, dy]
+
+    terminal = nodes[reached & (tree_image.topology.is_leaf[nodes] | ~expanded)]
+    return SceneGeometry(hz_lines, hz_styles, vt_lines, vt_styles, arcs, arc_styles,
+                         rects, rect_styles, anchors, anchor_nodes, terminal, bounds)
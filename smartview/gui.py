@@ -1,7 +1,5 @@
 
 from . import drawer
-from . import drawer_noqt
-import json
 import os
 
 from . import layout
@@ -11,7 +9,6 @@ from .utils import timeit, debug
 import time
 from multiprocessing import Pool, Queue, Process
 import numpy as np
-import bottle
 
 import signal
 import math
@@ -41,10 +38,14 @@ def exit_gui(a, b):
     _QApp.exit(0)
 
 
-def start_app():
+def start_app(offscreen=False):
+    """Starts the QApplication, if not started yet. With offscreen, it needs
+    no display (unless QT_QPA_PLATFORM says otherwise)."""
     global _QApp
 
     if not _QApp:
+        if offscreen:
+            os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
         _QApp = QApplication(["ETE"])
 
 
@@ -73,77 +74,6 @@ def display(tree_image, win_name="ETE", donotshow=False, zoom_factor=1):
     _QApp.exec_()
 
 
-class Painter(object):
-    def __init__(self):
-        self.stack = []
-
-    def drawRect(self, x, y, w, h, fgcolor, bgcolor):
-        self.stack.append(["r", x, y, w, h])
-
-    def drawLine(self, x1, y1, x2, y2, color):
-        self.stack.append(["l", x1, y1, x2, y2, color])
-
-
-def start_server(tree_image):
-    app = bottle.Bottle()
-
-    @app.error(405)
-    def method_not_allowed(res):
-        if bottle.request.method == 'OPTIONS':
-            new_res = bottle.HTTPResponse()
-            new_res.set_header('Access-Control-Allow-Origin', '*')
-            return new_res
-        res.headers['Allow'] += ', OPTIONS'
-        return bottle.request.app.default_error_handler(res)
-
-    @app.hook('after_request')
-    def enable_cors():
-        """
-        You need to add some headers to each request.
-        Don't use the wildcard '*' for Access-Control-Allow-Origin in production.
-        """
-        bottle.response.headers['Access-Control-Allow-Origin'] = '*'
-        bottle.response.headers['Access-Control-Allow-Methods'] = 'PUT, GET, POST, DELETE, OPTIONS'
-        bottle.response.headers['Access-Control-Allow-Headers'] = 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
-
-    @app.get("/get_scene_region/<scene>/", method=['GET', 'OPTIONS'])
-    def get_scene_region(scene):
-        print('  --> scene:', scene)
-        zoom, x, y, w, h = map(float, scene.split(','))
-        target_tree_scene = QRectF(x, y, w, h)
-
-        zoom = max(0.00001, zoom)
-
-        t1 = time.time()
-        bottle.response.content_type = 'application/json'
-        ii = QImage(1000, 1000, QImage.Format_ARGB32_Premultiplied)
-        ii.fill(QColor(Qt.white).rgb())
-        pp = QPainter()
-        pp.begin(ii)
-        painter = Painter()
-
-        terminal_nodes = drawer_noqt.draw_tree_scene_region(pp, painter, tree_image,
-                                                            zoom, target_tree_scene)
-        pp.end()
-        # return json.dumps({"items": [["r", 10, 10, 200, 200]]})
-
-        # TODO: call here drawer.py draw_aligned_panel_region() and send the
-        # results to pixi.
-
-        print("web return:", time.time() - t1,
-              len(painter.stack), len(terminal_nodes))
-        return json.dumps({"items": painter.stack})
-
-    @app.get("/static/<filepath:path>")
-    def webfile(filepath):
-        import pathlib
-        basepath = os.path.join(pathlib.Path().absolute(), 'pixigui')
-        print(os.path.join(basepath, filepath))
-        return bottle.static_file(filepath, root=basepath)
-
-    bottle.run(app, address="localhost", port=8090, debug=True, reload=True)
-
-
 class TreeCanvas(QOpenGLWidget):
     def __init__(self, tree_image, zoom_factor):
         super().__init__()
@@ -553,42 +483,23 @@ class TiledTreeView(QGraphicsView):
         mouse_pos = viewport.mapFromGlobal(QCursor.pos())
         scene_mouse_pos = self.mapToScene(mouse_pos)
 
+        M = QTransform()
+        M.scale(self.zoom_factor, self.zoom_factor)
         if self.tree_image.tree_style.mode == "c":
-            collision_paths = self.tree_image.circ_collision_paths
-            M = QTransform()
-            M.scale(self.zoom_factor, self.zoom_factor)
             M.translate(self.tree_image.radius[-1], self.tree_image.radius[-1])
-        elif self.tree_image.tree_style.mode == "r":
-            collision_paths = self.tree_image.rect_collision_paths
-            M = QTransform()
-            M.scale(self.zoom_factor, self.zoom_factor)
-
-        img_data = self.tree_image.img_data
-        curr = 0
-        end = len(collision_paths)
-        iters = 0
-        match = None
-
-        while curr < end:
-            if not collision_paths[curr][0]:
-                curr += 1
-                continue
-            path = M.map(collision_paths[curr][0])
-            fpath = M.map(collision_paths[curr][1])
-            if path.contains(scene_mouse_pos):
-                dim = self.tree_image.img_data[curr]
-                angle = (dim[_aend] - dim[_astart])
-                return curr, path, fpath
-
-            if not img_data[curr][_is_leaf] and not fpath.contains(scene_mouse_pos):
-                curr = int(img_data[curr][_max_leaf_idx] + 1)
-            elif not img_data[curr][_is_leaf]:
-                end = img_data[curr][_max_leaf_idx] + 1
-                curr += 1
-            else:
-                curr += 1
 
-        return None, None, None
+        # find the node in the untransformed scene
+        pos = M.inverted()[0].map(scene_mouse_pos)
+        nid = self.tree_image.region_index.node_at(self.tree_image.zoom_index,
+                                                   self.zoom_factor, pos.x(), pos.y())
+        if nid is None:
+            return None, None, None
+
+        if self.tree_image.tree_style.mode == "c":
+            path, fpath = drawer.get_node_arc_path(self.tree_image, nid)
+        else:
+            path, fpath = drawer.get_node_rect_path(self.tree_image, nid)
+        return nid, M.map(path), M.map(fpath)
 
     @timeit
     def _fit_to_window(self):
@@ -654,29 +565,29 @@ class TiledTreeView(QGraphicsView):
 
         # 1
         elif key == 49:
-            self.tree_image.adjust_branch_lengths(layout.real)
-            self.tree_image.update_collision_paths()
+            self.tree_image.adjust_branch_lengths("real")
+            self.tree_image.update_scene_index()
             self.update_tile_view()
             self._fit_to_window()
 
         # 2
         elif key == 50:
-            self.tree_image.adjust_branch_lengths(layout.by_size)
-            self.tree_image.update_collision_paths()
+            self.tree_image.adjust_branch_lengths("by_size")
+            self.tree_image.update_scene_index()
             self.update_tile_view()
             self._fit_to_window()
 
         # 3
         elif key == 51:
-            self.tree_image.adjust_branch_lengths(layout.by_size_new)
-            self.tree_image.update_collision_paths()
+            self.tree_image.adjust_branch_lengths("adjust_lengths_by_size")
+            self.tree_image.update_scene_index()
             self.update_tile_view()
             self._fit_to_window()
 
         # L(abels)
         elif key == 76:
             self.tree_image.tree_style.show_labels ^= True
-            self.tree_image.update_collision_paths()
+            self.tree_image.update_scene_index()
             self.update_tile_view()
         logger.debug("PRESSED %s" % key)
         QGraphicsView.keyReleaseEvent(self, e)
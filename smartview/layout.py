@@ -1,6 +1,5 @@
 import math
-from collections import defaultdict, deque
-import bisect
+from collections import defaultdict, namedtuple
 import numpy as np
 
 from .utils import timeit
@@ -35,12 +34,93 @@ def update_node_dimensions(img_data, cached_prepostorder, cached_preorder,
             #  face_pos_sizes = compute_face_dimensions(node, node._temp_faces)
             #  dim[_btw:_bah+1] = face_pos_sizes
             dim[_blen] = node.dist if not force_topology else 1.0
-            dim[_bh] = max(node.img_style.hz_line_width, 1.0)
+            # node._img_style is None for nodes with the default style
+            style = node._img_style
+            dim[_bh] = max(style.hz_line_width, 1.0) if style else 1.0
             dim[_parent] = node.up._id if nid > 0 else 0
             dim[_is_leaf] = 1 # assumes it is a leaf, fixed in postorder for internal nodes
             dim[_max_leaf_idx] = nid
             prev_id = nid
 
+# Read-only topology arrays in preorder. parent[0] is 0 (root points to itself,
+# as in img_data[_parent]) and end[i] is the last preorder index under node i,
+# so the subtree of i is the slice [i, end[i]].
+Topology = namedtuple("Topology", ["parent", "end", "is_leaf", "dist", "depth",
+                                   "nleaves", "rootdist", "child_ptr", "child_ids",
+                                   "levels"])
+
+def get_topology(parent, end, dist):
+    """Builds the Topology arrays of a tree from its preorder parent ids, subtree
+    ends and branch distances."""
+    parent = np.asarray(parent, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+    dist = np.asarray(dist, dtype=np.float64)
+    nnodes = len(parent)
+    is_leaf = end == np.arange(nnodes)
+
+    depth = cumsum_from_root(np.ones(nnodes), end).astype(np.int64) - 1
+    nleaves = subtree_sum(is_leaf, end).astype(np.int64)
+    # distance to root (root branch excluded)
+    rootdist = cumsum_from_root(dist, end) - dist[0]
+
+    # children in CSR format. Preorder ids are already sorted, so a stable sort
+    # by parent keeps children in their original order
+    child_ids = np.argsort(parent[1:], kind="stable") + 1
+    child_ptr = np.zeros(nnodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parent[1:], minlength=nnodes), out=child_ptr[1:])
+
+    # node ids grouped by depth, from the root down
+    by_depth = np.argsort(depth, kind="stable")
+    bounds = np.cumsum(np.bincount(depth))
+    levels = np.split(by_depth, bounds[:-1])
+
+    return Topology(parent, end, is_leaf, dist, depth, nleaves, rootdist,
+                    child_ptr, child_ids, levels)
+
+def subtree_sum(values, end):
+    """Sum of values over each subtree (node included)."""
+    csum = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+    return csum[np.asarray(end) + 1] - csum[:len(end)]
+
+def cumsum_from_root(values, end):
+    """Sum of values along the path from the root to each node (node included).
+
+    Every node adds its value to its whole preorder range, so a single
+    cumulative sum over a difference array resolves all paths at once.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    nnodes = len(values)
+    diff = np.bincount(np.asarray(end) + 1, weights=-values, minlength=nnodes + 1)
+    diff[:nnodes] += values
+    return np.cumsum(diff)[:nnodes]
+
+def get_face_size(face, node):
+    """Returns the width and height taken by face on node, including margins
+    and rotation."""
+    face.node = node
+    fw, fh = face._size()
+    fw += face.margin_right + face.margin_left
+    fh += face.margin_top + face.margin_bottom
+
+    # correct dimensions in case face is rotated
+    if face.rotation:
+        if face.rotation == 90 or face.rotation == 270:
+            fw, fh = fh, fw
+        elif face.rotation == 180:
+            pass
+        else:
+            x0 =  fw / 2.0
+            y0 =  fh / 2.0
+            theta = (face.rotation * math.pi) / 180
+            trans = lambda x, y: (x0+(x-x0) * math.cos(theta) + (y-y0) * math.sin(theta),
+                                  y0-(x-x0) * math.sin(theta) + (y-y0) * math.cos(theta))
+            coords = (trans(0,0), trans(0,fh), trans(fw,0), trans(fw,fh))
+            x_coords = [e[0] for e in coords]
+            y_coords = [e[1] for e in coords]
+            fw = max(x_coords) - min(x_coords)
+            fh = max(y_coords) - min(y_coords)
+    return fw, fh
+
 def compute_face_dimensions(node, facegrid):
     if facegrid is None:
         facegrid = []
@@ -48,29 +128,7 @@ def compute_face_dimensions(node, facegrid):
     cols_w = defaultdict(listdict)
     cols_h = defaultdict(listdict)
     for index, (f, pos, row, col, _, _) in enumerate(facegrid):
-        f.node = node
-        fw, fh = f._size()
-        fw += f.margin_right + f.margin_left
-        fh += f.margin_top + f.margin_bottom
-
-        # correct dimensions in case face is rotated
-        if f.rotation:
-            if f.rotation == 90 or f.rotation == 270:
-                fw, fh = fh, fw
-            elif f.rotation == 180:
-                pass
-            else:
-                x0 =  fw / 2.0
-                y0 =  fh / 2.0
-                theta = (f.rotation * math.pi) / 180
-                trans = lambda x, y: (x0+(x-x0) * math.cos(theta) + (y-y0) * math.sin(theta),
-                                      y0-(x-x0) * math.sin(theta) + (y-y0) * math.cos(theta))
-                coords = (trans(0,0), trans(0,fh), trans(fw,0), trans(fw,fh))
-                x_coords = [e[0] for e in coords]
-                y_coords = [e[1] for e in coords]
-                fw = max(x_coords) - min(x_coords)
-                fh = max(y_coords) - min(y_coords)
-
+        fw, fh = get_face_size(f, node)
         facegrid[index][4] = fw
         facegrid[index][5] = fh
         # Update overal grid data
@@ -85,6 +143,26 @@ def compute_face_dimensions(node, facegrid):
         face_pos_sizes.extend((total_w, total_h))
     return face_pos_sizes
 
+def get_face_grid(facegrid, skip_leaf_only=False):
+    """Groups the faces of a facegrid (already measured by
+    compute_face_dimensions) by position and column.
+
+    Returns a tuple of (pos, columns) in facegrid order, where columns is a
+    tuple of (col, width, height, face indexes). Faces shown only on leaves
+    are left out if skip_leaf_only is True.
+    """
+    pos2columns = {}
+    for faceidx, (face, pos, row, col, fw, fh) in enumerate(facegrid or []):
+        if skip_leaf_only and face.only_if_leaf:
+            continue
+        column = pos2columns.setdefault(pos, {}).setdefault(col, [0, 0, []])
+        column[0] = max(fw, column[0])
+        column[1] += fh
+        column[2].append(faceidx)
+    return tuple((pos, tuple((col, w, h, tuple(faces))
+                             for col, (w, h, faces) in columns.items()))
+                 for pos, columns in pos2columns.items())
+
 def compute_aligned_region_width(tree_image):
     current_w = 0.0
     max_w = 0.0
@@ -102,272 +180,3 @@ def compute_aligned_region_width(tree_image):
             else:
                 current_w += dim[_baw]
     return max_w
-
-def by_size2(tree_image, stop=None):
-    if stop is None:
-        stop = 100
-    n2leaves = {}
-    root = tree_image.root_node
-    for n in root.traverse("postorder"):
-        if n.children:
-            n2leaves[n] = sum([n2leaves[ch] for ch in n.children])
-        else:
-            n2leaves[n] = 1
-
-        if n2leaves[n] >= stop*3:
-            for ch in n.children:
-                tree_image.img_data[ch._id][_blen] = n.dist * 1000
-        elif n2leaves[n] >= stop*2:
-            for ch in n.children:
-                tree_image.img_data[ch._id][_blen] = n.dist * 20
-        elif n2leaves[n] >= stop:
-            for ch in n.children:
-                tree_image.img_data[ch._id][_blen] = n.dist * 10
-        else:
-            for ch in n.children:
-                tree_image.img_data[n._id][_blen] =  n.dist * 3
-@timeit
-def by_size(tree_image, stop=None):
-    if stop is None:
-        stop = 100
-
-    root = tree_image.root_node.copy('newick')
-    distances = []
-    nleaves = 0
-    for count, n in enumerate(root.traverse('preorder')):
-        distances.append(n.dist)
-        if not n.children:
-            nleaves += 1
-        n._id = count
-
-
-    median_dist = np.median(distances)
-    min_dist = np.median(distances)
-    scale = 10.0 / min_dist
-
-    # minimum distance to allocate 3 pixels per terminal node
-    angle = tree_image.tree_style.arc_span / float(nleaves)
-    theta = math.radians(angle/2.0)
-
-    min_sep = 3.0 / math.sin(theta)
-
-    init_zoom_factor = min_sep / 1080
-    #print "INIT ZOOM FACTOR", init_zoom_factor
-
-
-    # angle = tree_image.tree_style.arc_span / nleaves
-    # theta = (angle * math.pi) / 180
-    # min_sep = 3 / math.sin(theta)
-
-    n2leaves = root.get_cached_content()
-    while True:
-        for nleaves, leaf in enumerate(root.get_leaves(is_leaf_fn=lambda x: len(n2leaves[x])<=stop)):
-            dim = tree_image.img_data[n._id]
-
-            # if dim[_fnh] > R180:
-            #     node_height = 999999999
-            # else:
-            #     node_height = ((math.sin(dim[_fnh]/2.0) * dim[_fnw]) * 2)
-
-            # scale = ((stop*3) / node_height)
-
-
-            for ch in leaf.get_children():
-                for n in ch.traverse():
-                    tree_image.img_data[n._id][_blen] = n.dist * scale
-                ch.detach()
-        print("scale used:", scale)
-        print("leaves processed:", nleaves)
-        print("new size of tree:", len(root))
-        print("----------------")
-        scale = scale * 10
-        n2leaves = root.get_cached_content()
-        if len(n2leaves[root]) < stop:
-            print('break')
-            break
-    for nleaves, n in enumerate(root.traverse()):
-        tree_image.img_data[n._id][_blen] = n.dist * scale
-    print("scale used:", scale)
-    print("leaves processed:", nleaves)
-    print("new size of tree:", len(root))
-    print("----------------")
-
-@timeit
-def adjust_lengths_by_size(tree_image, stop=None):
-    opt_size = 200
-    root = tree_image.root_node
-
-    n2leaves = {}
-    n2rootdist = {}
-    n2farthest = {}
-    n2scale = {}
-    for post,  n in root.iter_prepostorder():
-        if post:
-            if n.children:
-                n2leaves[n] = sum([n2leaves[ch] for ch in n.children])
-                n2farthest[n] = n.dist + max(n2farthest[ch] for ch in n.children)
-        else:
-            if not n.children:
-                n2leaves[n] = 1
-                n2farthest[n] = n.dist
-
-            if n.up:
-                n2rootdist[n] = n2rootdist[n.up] + n.dist
-            else:
-                n2rootdist[n] = 1
-
-
-    seeds = [root]
-    while seeds:
-        seed = seeds.pop()
-        if not seed.children:
-            continue
-        sorted_leaves = [(n2leaves[seed], seed)]
-        while len(sorted_leaves) < opt_size:
-            if sorted_leaves[-1][0] <= opt_size:
-                break
-            size, largest = sorted_leaves.pop()
-            for ch in largest.children:
-                i = bisect.bisect_left([s[0] for s in sorted_leaves], n2leaves[ch])
-                sorted_leaves.insert(i, (n2leaves[ch], ch))
-
-        if sorted_leaves:
-            leaves = [i[1] for i in sorted_leaves]
-            dist, most_dist = sorted([(n2rootdist[lf], lf) for lf in leaves], key=lambda x: x[0])[-1]
-
-            aperture = tree_image.img_data[seed._id][_fnh]
-            if aperture < R180:
-                hyp = (n2leaves[seed] * 1) / math.sin(aperture/ 2.0)
-                #hyp = (len(leaves) * 1) / math.sin(aperture/ 2.0)
-            else:
-                hyp = (n2leaves[seed] * 1)
-                #hyp = (len(leaves) * 1)
-
-            if seed is root:
-                dist = max([n2rootdist[lf] for lf in leaves])
-                clade_scale = hyp / dist
-                n2scale[seed] = dist * clade_scale
-            else:
-                dist = max([n2rootdist[lf] for lf in leaves])
-
-                diff = dist - n2rootdist[seed]
-
-                current_rad = n2scale[seed]
-                if current_rad >= hyp:
-                    clade_scale = 500 / diff
-                else:
-                    clade_scale = (hyp-current_rad) / diff
-
-
-            #print 'node_size:', n2leaves[seed], 'nodeRootdist:', n2rootdist[seed], 'scale', clade_scale
-            for n in seed.traverse(is_leaf_fn=lambda x: x in leaves):
-                for ch in n.children:
-                    tree_image.img_data[ch._id][_blen] = ch.dist * clade_scale
-                    n2scale[ch] = n2scale[n] + (ch.dist * clade_scale)
-
-            seeds.extend([lf for lf in leaves if n2leaves[lf]> opt_size ])
-        else:
-            aperture = tree_image.img_data[seed._id][_fnh]
-            if aperture < R180:
-                hyp = (n2leaves[seed] * 3) / math.sin(aperture/ 2.0)
-            else:
-                hyp = (n2leaves[seed] * 3)
-
-
-            dist = max([n2rootdist[lf] for lf in seed])
-            diff = dist - n2rootdist[seed]
-
-            current_rad = n2scale[seed]
-            if current_rad >= hyp:
-                clade_scale = 500 / diff
-            else:
-                clade_scale = (hyp-current_rad) / diff
-
-            for n in seed.traverse():
-                for ch in n.children:
-                    tree_image.img_data[ch._id][_blen] = ch.dist * clade_scale
-
-    for dim in tree_image.img_data:
-         dim[_blen] *= 0.1
-
-def by_level(tree_image, stop=None):
-    if stop is None:
-        stop = 4
-
-    n2level = {}
-
-    root = tree_image.root_node
-    n2leaves = root.get_cached_content()
-    for n in root.traverse("preorder"):
-        if n.up:
-            n2level[n] = n2level[n.up] + 1
-        else:
-            n2level[n] = 0
-
-        if n2level[n] <= stop:
-            tree_image.img_data[n._id][_blen] = n.dist * 1000
-        else:
-            tree_image.img_data[n._id][_blen] =  n.dist * 1.5
-
-def by_scale(tree_image, stop=20, sca=10):
-    n2dist = {}
-
-    root = tree_image.root_node
-    leaf, maxd = root.get_farthest_leaf()
-    distances = [n.dist for n in root.iter_descendants()]
-
-    scale_ranges = [(maxd/4, 100), (maxd/3, 16), (maxd/2, 16), (maxd**maxd, 1)]
-
-
-    for n in root.traverse("preorder"):
-        if n.up:
-            fbranch = n.dist
-            parent_branch = n2dist[n.up]
-            n2dist[n] = parent_branch + fbranch
-            blen = 0
-            current_pos = parent_branch
-            for scamax, sca in scale_ranges:
-                if current_pos <= scamax:
-                    offset = min(scamax, current_pos + fbranch)
-                    current_pos += offset
-                    blen += offset * sca
-
-            tree_image.img_data[n._id][_blen] = blen
-        else:
-            tree_image.img_data[n._id][_blen] = maxd/2
-            n2dist[n] = 0
-
-def by_islands(tree_image, stop=None):
-    if stop is None:
-        stop = 150
-
-    n2leaves = {}
-    root = tree_image.root_node
-    for n in root.traverse("postorder"):
-        if n.children:
-            n2leaves[n] = sum([n2leaves[ch] for ch in n.children])
-        else:
-            n2leaves[n] = 1
-
-        if n2leaves[n] >= stop*3:
-            for ch in n.children:
-                tree_image.img_data[ch._id][_blen] = n.dist * 1000
-        elif n2leaves[n] >= stop*2:
-            for ch in n.children:
-                tree_image.img_data[ch._id][_blen] = n.dist * 20
-        elif n2leaves[n] >= stop:
-            for ch in n.children:
-                tree_image.img_data[ch._id][_blen] = n.dist * 10
-        else:
-            for ch in n.children:
-                tree_image.img_data[n._id][_blen] =  n.dist * 3
-
-def real(tree_image, stop=None):
-    root = tree_image.root_node
-    #distances = [n.dist for n in root.iter_descendants()]
-    #scale = 10 / min(distances)
-
-    for n in root.traverse("preorder"):
-        tree_image.img_data[n._id][_blen] =  n.dist
-
-default_adjust_branch=adjust_lengths_by_size
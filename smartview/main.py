@@ -1,39 +1,261 @@
-from collections import defaultdict
+import sys
+
 import numpy as np
 
-from .utils import timeit
-from . import (layout, layout_circular, layout_rect, gui, links)
+from .utils import timeit, LRUCache
+from . import (layout, branch_lengths, scene_index, frames,
+               parallel_layout, node_styles)
 from .common import *
 
+try:
+    from . import clayout as layout_kernels
+except ImportError:
+    from . import nplayout as layout_kernels
+
 import math
 
+def get_facegrid_bytes(facegrid):
+    """Approximate memory used by the faces of a node."""
+    if not facegrid:
+        return sys.getsizeof(facegrid)
+    return sys.getsizeof(facegrid) + sum(sys.getsizeof(f) + sys.getsizeof(f[0])
+                                         for f in facegrid)
+
+
+class TreeData(object):
+    """Data of a tree shared by all its views (TreeImage): node caches in
+    preorder, the topology, the node dimensions and the node styles
+    (style_ids, with the id of each node in the styles table).
+
+    Dimensions and topologies are computed on demand, once per value of
+    TreeStyle.force_topology, and never change. Node styles are tree-wide:
+    the layout functions of any view can change them (see update_styles),
+    and the change shows in all views.
+    """
+    def __init__(self, root_node):
+        self.root_node = root_node
+
+        self.cached_prepostorder = None
+        self.cached_preorder = None
+        self.cached_leaves = None
+        self.cached_content = None
+        self.cached_parents = None
+        self.cached_ends = None
+        self.styles = node_styles.StyleTable()
+        self.style_ids = None
+        # changes with the style of any node
+        self.style_version = 0
+
+        self._dimensions = {}
+        self._topologies = {}
+        self._node_columns = {}
+
+        self.initialize()
+
+    @timeit
+    def initialize(self):
+        self.cached_prepostorder = []
+        self.cached_preorder = []
+        self.cached_leaves = []
+        self.cached_parents = []
+        self.cached_ends = []
+        node_id = 0
+        leaf_id = 0
+        for post, node in self.root_node.iter_prepostorder():
+            if not post:
+                self.cached_parents.append(node.up._id if node_id else 0)
+                self.cached_ends.append(node_id)
+                node._id = node_id
+                self.cached_prepostorder.append(node._id)
+                node_id += 1
+                self.cached_preorder.append(node)
+                if node.is_leaf():
+                    leaf_id += 1
+                    self.cached_leaves.append(node._id)
+                # for func in self.tree_style.layout_fn:
+                #     func(node)
+            else:
+                self.cached_prepostorder.append(-node._id)
+                self.cached_ends[node._id] = node_id - 1
+        self.style_ids = self.styles.get_style_ids(self.cached_preorder)
+
+    def update_styles(self, nodes):
+        """Updates the style ids of nodes (preorder ids), after their styles
+        are changed, for all the views of the tree."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        style_ids = self.styles.get_style_ids(
+            [self.cached_preorder[nid] for nid in nodes.tolist()])
+        if np.any(self.style_ids[nodes] != style_ids):
+            self.style_ids[nodes] = style_ids
+            self.style_version += 1
+
+    def get_dimensions(self, force_topology=False):
+        """Returns the (read-only) img_data matrix with the dimensions of all
+        nodes, and no positions."""
+        if force_topology not in self._dimensions:
+            img_data = layout.get_empty_matrix(len(self.cached_preorder))
+            layout.update_node_dimensions(img_data=img_data,
+                                          cached_prepostorder=self.cached_prepostorder,
+                                          cached_preorder=self.cached_preorder,
+                                          force_topology=force_topology)
+            img_data.setflags(write=False)
+            self._dimensions[force_topology] = img_data
+        return self._dimensions[force_topology]
+
+    def get_node_column(self, attr):
+        """Returns an array with the value of attribute attr of every node (by
+        id), as used by batch layout functions."""
+        if attr not in self._node_columns:
+            column = np.array([getattr(node, attr, None) for node in self.cached_preorder])
+            column.setflags(write=False)
+            self._node_columns[attr] = column
+        return self._node_columns[attr]
+
+    def get_topology(self, force_topology=False):
+        if force_topology not in self._topologies:
+            dims = self.get_dimensions(force_topology)
+            self._topologies[force_topology] = layout.get_topology(
+                self.cached_parents, self.cached_ends, dims[:, _blen])
+        return self._topologies[force_topology]
+
+
 class TreeImage(object):
+    """A view of a tree: its style, apertures, collapsed nodes, positions
+    (img_data) and faces (by node id). Views of the same tree can share its
+    TreeData (pass it instead of the root node, or use new_view()), and with
+    it the node styles."""
     def __init__(self, root_node, tree_style):
+        if isinstance(root_node, TreeData):
+            self.tree_data = root_node
+        else:
+            self.tree_data = TreeData(root_node)
         self.tree_style = tree_style
-        self.root_node = root_node
         self.scale = tree_style.scale
         self.root_open = 0
+        if tree_style.layout_workers > 1:
+            self.layout_kernels = parallel_layout.ParallelKernels(tree_style.layout_workers)
+        else:
+            self.layout_kernels = layout_kernels
 
-        self.cached_prepostorder = None
-        self.cached_preorder = None
-        self.cached_content = None
+        # user collapsed nodes, and faces created by the layout functions
+        self.collapsed = set()
+        self.reset_faces()
 
         self.img_data = None
+        self.topology = None
         self.leaf_apertures = None
         self.width = 0.0
         self.height = 0.0
         self.break_points = None
 
         self.link_paths = []
-        self.circ_collision_paths = None
-        self.rect_collision_paths = None
+        self.zoom_index = None
+        self.region_index = None
+        # img_data, or its float64 view in deep zoom mode
+        self.scene_data = None
+        self.frames = None
+        # changes every time the scene index is rebuilt
+        self.scene_version = 0
 
-        self.initialize()
         self.set_leaf_aperture()
         self.adjust_dimensions()
         self.adjust_apertures()
-        self.adjust_branch_lengths()
-        self.update_collision_paths()
+        self.adjust_branch_lengths(tree_style.branch_mode)
+        self.update_scene_index()
+
+    root_node = property(lambda self: self.tree_data.root_node)
+    cached_prepostorder = property(lambda self: self.tree_data.cached_prepostorder)
+    cached_preorder = property(lambda self: self.tree_data.cached_preorder)
+    cached_leaves = property(lambda self: self.tree_data.cached_leaves)
+    cached_content = property(lambda self: self.tree_data.cached_content)
+    cached_parents = property(lambda self: self.tree_data.cached_parents)
+    cached_ends = property(lambda self: self.tree_data.cached_ends)
+
+    def new_view(self, tree_style):
+        """Returns a new view of the same tree, sharing its TreeData."""
+        return TreeImage(self.tree_data, tree_style)
+
+    def load_faces(self, node):
+        """Returns the faces of node in this view, running the layout
+        functions on it only the first time."""
+        if node._id not in self.face_cache:
+            self.load_node_faces([node._id])
+        return self.face_cache[node._id]
+
+    def load_node_faces(self, nodes):
+        """Runs the layout functions of this view on the nodes (preorder ids)
+        whose faces were not loaded yet, and measures their faces. Batch
+        layout functions (see style.batch_layout) are called once for all of
+        them."""
+        nodes = [nid for nid in np.unique(nodes).tolist() if nid not in self.face_cache]
+        if not nodes:
+            return
+        facegrids = dict.fromkeys(nodes)
+        for func in self.tree_style.layout_fn:
+            if getattr(func, "batch", False):
+                batch = func(np.array(nodes), self.img_data, self.tree_data)
+                for nid, face_id, pos, col, row in zip(
+                        batch.nodes.tolist(), batch.face_ids.tolist(),
+                        batch.positions.tolist(), batch.columns.tolist(),
+                        batch.rows.tolist()):
+                    f = [batch.faces[face_id], pos, row if row >= 0 else None, col, 0, 0]
+                    if facegrids[nid] is None:
+                        facegrids[nid] = [f]
+                    else:
+                        facegrids[nid].append(f)
+            else:
+                # layout functions add faces to node._temp_faces, which only
+                # holds them while they run (nodes are shared by all views)
+                for nid in nodes:
+                    node = self.cached_preorder[nid]
+                    node._temp_faces = facegrids[nid]
+                    try:
+                        func(node)
+                        facegrids[nid] = node._temp_faces
+                    finally:
+                        node._temp_faces = None
+                # layout functions may customize node styles too
+                self.tree_data.update_styles(nodes)
+
+        for nid, facegrid in facegrids.items():
+            if facegrid:
+                face_pos_sizes = layout.compute_face_dimensions(
+                    self.cached_preorder[nid], facegrid)
+                # face sizes are kept in img_data, and only set the first time
+                if not np.any(self.img_data[nid, _btw:_bah+1]):
+                    self.img_data[nid, _btw:_bah+1] = face_pos_sizes
+        self.face_cache.update(facegrids)
+
+    def reset_faces(self):
+        """Starts new, empty face caches: faces created by the layout functions
+        (up to TreeStyle.face_cache_mb, the least recently used are dropped)
+        and face columns of each node, as (nid, skip_leaf_only) -> face grid.
+        Faces are created again when needed."""
+        self.face_cache = LRUCache(self.tree_style.face_cache_mb * 2**20,
+                                   sizeof=get_facegrid_bytes,
+                                   on_evict=self._drop_faces)
+        self.face_grids = {}
+
+    def _drop_faces(self, nid, facegrid):
+        self.face_grids.pop((nid, False), None)
+        self.face_grids.pop((nid, True), None)
+
+    def get_face_grid(self, node, skip_leaf_only=False):
+        """Returns the face columns of node (see layout.get_face_grid),
+        computed only the first time. Its faces must be loaded and measured."""
+        key = (node._id, skip_leaf_only)
+        if key not in self.face_grids:
+            self.face_grids[key] = layout.get_face_grid(self.face_cache[node._id],
+                                                        skip_leaf_only)
+        return self.face_grids[key]
+
+    def set_collapsed(self, nid, collapsed=True):
+        """Collapses (or expands back) node nid in this view, at any zoom."""
+        if collapsed:
+            self.collapsed.add(nid)
+        else:
+            self.collapsed.discard(nid)
+        self.update_scene_index()
 
     @timeit
     def set_leaf_aperture(self, nodeid=None, factor=None):
@@ -81,43 +303,55 @@ class TreeImage(object):
                 self.leaf_apertures[:start] = reduction
 
     def adjust_dimensions(self):
-        self.img_data = layout.get_empty_matrix(len(self.cached_preorder))
+        force_topology = self.tree_style.force_topology
+        self.img_data = self.tree_data.get_dimensions(force_topology).copy()
+        self.topology = self.tree_data.get_topology(force_topology)
 
-        layout.update_node_dimensions(img_data=self.img_data,
-                                      cached_prepostorder=self.cached_prepostorder,
-                                      cached_preorder=self.cached_preorder,
-                                      scale=self.scale,
-                                      force_topology=self.tree_style.force_topology)
     @timeit
     def adjust_apertures(self):
         if self.tree_style.mode == 'r':
-            layout_rect.update_rect_positions(img_data=self.img_data,
-                                              cached_prepostorder=self.cached_prepostorder,
-                                              cached_preorder=self.cached_preorder,
-                                              leaf_apertures=self.leaf_apertures)
+            self.layout_kernels.update_rect_positions(self.img_data, self.topology)
 
         elif self.tree_style.mode == "c":
-            layout_circular.update_node_angles(img_data=self.img_data,
-                                               arc_start=self.tree_style.arc_start,
-                                               cached_prepostorder=self.cached_prepostorder,
-                                               cached_preorder=self.cached_preorder,
-                                               leaf_apertures=self.leaf_apertures)
+            self.layout_kernels.update_node_angles(self.img_data, self.topology,
+                                                   self.leaf_apertures,
+                                                   self.tree_style.arc_start)
+
+    @timeit
+    def get_optimal_circular_scale(self):
+        """Returns (best scale, max radius, max distance) for the current
+        circular layout, or 0.0 if all branches are empty."""
+        return self.layout_kernels.get_optimal_circular_scale(
+            self.img_data, self.topology, self.tree_style.optimal_scale_level,
+            self.tree_style.root_opening_factor)
 
 
-    def adjust_branch_lengths(self, adjust_fn=None):
-        if not adjust_fn:
-            adjust_fn = layout.default_adjust_branch
-        #adjust_fn(self)
+    @timeit
+    def adjust_branch_lengths(self, strategy=None, stop=None):
+        """Recomputes the length of branches using a strategy from the
+        branch_lengths registry (its name or the function itself). If None,
+        branch lengths are left as they are."""
+        if strategy is not None:
+            if not callable(strategy):
+                strategy = branch_lengths.get_strategy(strategy)
+            self.img_data[:, _blen] = strategy(self.topology, self.img_data[:, _fnh], stop=stop)
 
         self.root_open = 0.0
         self.scale = 1.0
         aligned_region_width = 100
 
         if self.tree_style.mode == 'c':
+            if self.tree_style.optimal_scale:
+                optimal = self.get_optimal_circular_scale()
+                if optimal and np.isfinite(optimal[0]) and optimal[0] > 0:
+                    scale, _, most_distant = optimal
+                    self.img_data[:, _blen] *= scale
+                    self.scale = scale
+                    self.root_open = most_distant * scale * self.tree_style.root_opening_factor
+
             #aligned_region_width = layout.compute_aligned_region_width(self)
-            max_leaf_radius = layout_circular.update_node_radius(self.img_data,
-                                                                 self.cached_prepostorder, self.cached_preorder,
-                                                                 self.scale, self.root_open)
+            max_leaf_radius = self.layout_kernels.update_node_radius(
+                self.img_data, self.topology, self.root_open)
 
             # set image total size
             self.width = (max_leaf_radius + aligned_region_width) * 2
@@ -129,29 +363,24 @@ class TreeImage(object):
             self.height = self.img_data[0][_fnh]
 
 
-    def update_collision_paths(self):
+    def update_scene_index(self):
+        self.scene_version += 1
+        if self.tree_style.deep_zoom:
+            positions = frames.get_positions(self.img_data, self.topology,
+                                             self.tree_style.mode, self.leaf_apertures,
+                                             self.tree_style.arc_start, self.root_open)
+            self.frames = frames.LocalFrames(positions, self.topology)
+            self.scene_data = frames.FrameView(self.img_data, self.frames,
+                                               self.topology)
+        else:
+            self.frames = None
+            self.scene_data = self.img_data
+
+        self.zoom_index = scene_index.ZoomIndex(self.img_data, self.topology,
+                                                self.tree_style.mode, self.collapsed)
         if self.tree_style.mode == 'c':
-            self.circ_collision_paths = defaultdict(lambda: [None, None])
+            self.region_index = scene_index.PolarIndex(self.scene_data, self.topology,
+                                                       self.root_open)
         elif self.tree_style.mode == 'r':
-            self.rect_collision_paths = defaultdict(lambda: [None, None])
-
-    @timeit
-    def initialize(self):
-        self.cached_prepostorder = []
-        self.cached_preorder = []
-        self.cached_leaves = []
-        node_id = 0
-        leaf_id = 0
-        for post, node in self.root_node.iter_prepostorder():
-            if not post:
-                node._id = node_id
-                self.cached_prepostorder.append(node._id)
-                node_id += 1
-                self.cached_preorder.append(node)
-                if node.is_leaf():
-                    leaf_id += 1
-                    self.cached_leaves.append(node._id)
-                # for func in self.tree_style.layout_fn:
-                #     func(node)
-            else:
-                self.cached_prepostorder.append(-node._id)
+            self.region_index = scene_index.RectIndex(self.scene_data, self.topology,
+                                                      self.root_open)
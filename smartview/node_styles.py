@@ -0,0 +1,69 @@
+""" Interned node styles.
+
+Nodes with no custom style (node._img_style is None, as long as node.img_style
+is never touched) share the default style. Custom NodeStyle objects are only
+created for the nodes that ask for them (copy on write), and all equal styles
+share the same id in a StyleTable, so that drawers can work with an array of
+style ids (one per node) and palettes (one value per style id).
+"""
+import numpy as np
+
+from .cstyle import NodeStyle
+
+# NodeStyle attributes that tell styles apart
+NODE_STYLE_ATTRS = ["hz_line_type", "vt_line_type", "hz_line_width", "vt_line_width",
+                    "size", "collapse", "fgcolor", "bgcolor", "vt_line_color",
+                    "hz_line_color", "shape"]
+
+DEFAULT_NODE_STYLE = NodeStyle()
+
+
+def get_node_style(node):
+    """Style of node, without creating one for nodes with the default
+    style."""
+    return node._img_style or DEFAULT_NODE_STYLE
+
+def get_style_key(style):
+    return tuple(getattr(style, attr) for attr in NODE_STYLE_ATTRS)
+
+
+class StyleTable(object):
+    """Distinct node styles, by id (0 is the default style)."""
+    def __init__(self):
+        self.keys = []
+        self.ids = {}
+        self._palettes = {}
+        self.intern(DEFAULT_NODE_STYLE)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def intern(self, style):
+        """Returns the id of style, adding it if it is new."""
+        key = get_style_key(style or DEFAULT_NODE_STYLE)
+        if key not in self.ids:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return self.ids[key]
+
+    def get_style_ids(self, nodes):
+        """Array with the style id of each node."""
+        return np.array([self.intern(node._img_style) for node in nodes],
+                        dtype=np.int32)
+
+    def get(self, style_id, attr):
+        return self.keys[style_id][NODE_STYLE_ATTRS.index(attr)]
+
+    def palette(self, attr, resolve=None):
+        """Array with the value of attribute attr of every style, optionally
+        converted with resolve(value) (e.g. color names to RGBA integers).
+        Palettes are kept until new styles are added."""
+        palette = self._palettes.get((attr, resolve))
+        if palette is None or len(palette) != len(self.keys):
+            j = NODE_STYLE_ATTRS.index(attr)
+            values = [key[j] for key in self.keys]
+            if resolve is not None:
+                values = [resolve(v) for v in values]
+            palette = np.array(values)
+            self._palettes[(attr, resolve)] = palette
+        return palette
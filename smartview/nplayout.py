@@ -0,0 +1,159 @@
+""" NumPy layout kernels, used when the compiled clayout module is not
+available. Both modules share the same API.
+
+Top-down values are path sums from the root (layout.cumsum_from_root), and
+values that depend on children are resolved level by level, from the deepest
+level up to the root.
+"""
+import math
+import numpy as np
+
+from .common import *
+from .layout import cumsum_from_root
+
+
+def subtree_max(values, topology):
+    """Max of values over each subtree (node included)."""
+    values = np.array(values, dtype=np.float64)
+    for level in reversed(topology.levels[1:]):
+        np.maximum.at(values, topology.parent[level], values[level])
+    return values
+
+def _first_leaves(topology):
+    leaves = np.flatnonzero(topology.is_leaf)
+    return leaves[np.searchsorted(leaves, np.arange(len(topology.parent)))]
+
+def _center_from_children(center, topology):
+    """Sets the center of internal nodes to the middle point between the
+    centers of their first and last children."""
+    if not len(topology.child_ids):
+        return center
+    last_child = topology.child_ids[np.maximum(topology.child_ptr[1:] - 1, 0)]
+    for level in reversed(topology.levels):
+        level = level[~topology.is_leaf[level]]
+        center[level] = center[level + 1] + (center[last_child[level]] - center[level + 1]) / 2.0
+    return center
+
+def _set_span(img_data, topology, start, end, center, col_start, col_end, col_center):
+    """Spans internal nodes from the start of their first leaf to the end of
+    their last one, given the start, end and center of every leaf."""
+    first_leaf = _first_leaves(topology)
+    start = start[first_leaf]
+    end = end[topology.end]
+    img_data[:, col_start] = start
+    img_data[:, col_end] = end
+    img_data[:, col_center] = _center_from_children(center, topology)
+    return end - start
+
+
+def update_node_radius(img_data, topology, root_opening):
+    """Sets the end radius of every node and returns the max radius."""
+    radius = root_opening + cumsum_from_root(img_data[:, _blen], topology.end)
+    img_data[:, _rad] = radius
+    img_data[:, _nht] = img_data[:, _bh] / 2.0
+    img_data[:, _nhb] = img_data[:, _bh] / 2.0
+    img_data[:, _fnw] = subtree_max(np.where(topology.is_leaf, radius, -np.inf), topology)
+    return max(0.0, radius.max())
+
+def update_node_angles(img_data, topology, leaf_apertures, arc_start):
+    """Sets the start, center and end angles of every node, given the aperture
+    (in radians) of every leaf and the start angle (in degrees) of the tree."""
+    nnodes = len(img_data)
+    leaves = topology.is_leaf
+    steps = np.maximum(np.asarray(leaf_apertures, dtype=np.float64), 0.0)
+    astart = np.zeros(nnodes)
+    astart[leaves] = math.radians(arc_start) + np.cumsum(steps) - steps
+    aend = astart.copy()
+    aend[leaves] += steps
+    acenter = astart.copy()
+    acenter[leaves] += steps / 2.0
+    img_data[:, _fnh] = _set_span(img_data, topology, astart, aend, acenter,
+                                  _astart, _aend, _acenter)
+
+def update_rect_positions(img_data, topology):
+    """Sets the x end and y start, center and end of every node."""
+    nnodes = len(img_data)
+    leaves = topology.is_leaf
+    dim = img_data[leaves].astype(np.float64)
+    heights = dim[:, _nht] + dim[:, _nhb] + dim[:, _bh]
+    ystart = np.zeros(nnodes)
+    ystart[leaves] = np.cumsum(heights) - heights
+    yend = ystart.copy()
+    yend[leaves] += heights
+    ycenter = ystart.copy()
+    ycenter[leaves] += dim[:, _nht] + dim[:, _bh] / 2.0
+    img_data[:, _fnh] = _set_span(img_data, topology, ystart, yend, ycenter,
+                                  _ystart, _yend, _ycenter)
+
+    # full node width is the widest child plus the node's own branch
+    blen = img_data[:, _blen]
+    xend = cumsum_from_root(blen, topology.end)
+    img_data[:, _xend] = xend
+    img_data[:, _fnw] = subtree_max(np.where(leaves, xend, -np.inf), topology) - xend + blen
+
+def get_min_radii(img_data, topology):
+    """Returns the min radius of every node at scale 1 (so that its faces fit
+    in its aperture), and the widths of its faces."""
+    dim = img_data.astype(np.float64)
+    lw = dim[:, _bh] / 2.0
+    htop = np.maximum(dim[:, _bth] + lw, dim[:, _brh] / 2.0)
+    hbot = np.maximum(dim[:, _bbh] + lw, dim[:, _brh] / 2.0)
+    wtop = dim[:, _btw] + dim[:, _brw]
+    wbot = dim[:, _bbw] + dim[:, _brw]
+
+    # narrow apertures need a min radius, regardless of the parent radius
+    with np.errstate(divide="ignore", invalid="ignore"):
+        min_radius = np.zeros(len(dim))
+        for w, h, aperture in [(wtop, htop, dim[:, _acenter] - dim[:, _astart]),
+                               (wbot, hbot, dim[:, _aend] - dim[:, _acenter])]:
+            narrow = aperture < R90
+            adjacent = h[narrow] / np.tan(aperture[narrow])
+            min_radius[narrow] = np.fmax(min_radius[narrow], np.hypot(adjacent + w[narrow], h[narrow]))
+
+    # parents are always resolved in the level above
+    for depth, level in enumerate(topology.levels):
+        pr = min_radius[topology.parent[level]] if depth else 0.0
+        min_radius[level] = np.fmax(min_radius[level],
+                                    np.fmax(np.hypot(pr + wtop[level], htop[level]),
+                                            np.hypot(pr + wbot[level], hbot[level])))
+    return min_radius, np.maximum(wtop, wbot)
+
+def get_optimal_circular_scale(img_data, topology, optimization_level="med",
+                               root_opening_factor=0.0):
+    """ Returns the minimum branch scale necessary to display all faces
+    avoiding extra (dashed) branch lines, the max radius of the tree at that
+    scale, and the distance to the most distant node. Returns 0.0 if there
+    are no branch lengths.
+
+    A node at scale s has a radius of sumdist*s + sumwidth + opening, where
+    opening is the root opening (most_distant * s * root_opening_factor). Each
+    node gives a lower bound for s, so the scale is the max of all of them.
+    """
+    min_radius, width = get_min_radii(img_data, topology)
+    blen = img_data[:, _blen].astype(np.float64)
+    sumdist = cumsum_from_root(blen, topology.end)
+    sumwidth = cumsum_from_root(width, topology.end)
+    most_distant = sumdist.max()
+    if most_distant == 0:
+        return 0.0
+
+    scale = (min_radius[0] - sumwidth[0]) / blen[0] if blen[0] else 0.0
+    denom = sumdist[1:] + most_distant * root_opening_factor
+    # nodes at distance 0 cannot be fixed by scaling
+    fixable = denom > 0
+    if fixable.any():
+        bounds = (min_radius[1:] - sumwidth[1:])[fixable] / denom[fixable]
+        scale = max(scale, bounds.max())
+
+    # If the width of branch top/bottom faces is not covered, we can also
+    # increase the scale to adjust it. This may produce huge scales, so let's
+    # keep it optional
+    if optimization_level == "full":
+        min_w = np.maximum(img_data[1:, _btw], img_data[1:, _bbw])
+        has_dist = blen[1:] > 0
+        if has_dist.any():
+            scale = max(scale, (min_w[has_dist] / blen[1:][has_dist]).max())
+
+    root_opening = most_distant * scale * root_opening_factor
+    max_rad = max(0.0, (sumdist * scale + sumwidth).max() + root_opening)
+    return scale, max_rad, most_distant
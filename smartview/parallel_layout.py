@@ -0,0 +1,253 @@
+""" Parallel layout kernels.
+
+The tree is split into large independent clades (preorder ranges of up to a
+fixed number of nodes). Worker processes lay out each clade as if it were a
+whole tree, in place, over img_data and topology arrays kept in
+multiprocessing.shared_memory. The parent process then shifts every clade by
+its offset (the position of the clade parent, and the aperture or height of
+all the leaves before it), and resolves the few backbone nodes above the
+clades.
+
+ParallelKernels has the same API as the clayout/nplayout modules. The worker
+processes only live while a layout pass runs.
+
+This only pays off with several idle cores and trees of millions of nodes:
+starting the workers and copying the arrays to and from shared memory cost
+more than what the compiled kernels (clayout) take to lay out smaller trees in
+a single process, so parallel layout is never used unless asked for.
+"""
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .common import *
+from .layout import get_topology
+
+try:
+    from . import clayout as layout_kernels
+except ImportError:
+    from . import nplayout as layout_kernels
+
+# clades are only sent to workers if they have at least these many nodes...
+MIN_CLADE_NODES = 10000
+# ... and if they cover this fraction of the tree. Otherwise, the backbone
+# (walked in python) would be too large and the sequential kernels are used
+MIN_PARALLEL_FRACTION = 0.5
+
+
+def split_clades(topology, max_nodes):
+    """Returns the topmost nodes whose subtrees have up to max_nodes nodes, and
+    the ids of the remaining (backbone) nodes, all in preorder."""
+    nnodes = len(topology.parent)
+    size = topology.end - np.arange(nnodes) + 1
+    small = size <= max_nodes
+    top = small.copy()
+    top[1:] &= ~small[topology.parent[1:]]
+
+    clades = np.flatnonzero(top)
+    covered = np.zeros(nnodes + 1, dtype=np.int64)
+    np.add.at(covered, clades, 1)
+    np.add.at(covered, topology.end[clades] + 1, -1)
+    backbone = np.flatnonzero(np.cumsum(covered)[:nnodes] == 0)
+    return clades, backbone
+
+
+class SharedArrays(object):
+    """Copies of numpy arrays in shared memory blocks, so that worker
+    processes can attach to them by name."""
+    def __init__(self, **arrays):
+        self.blocks = {}
+        self.arrays = {}
+        self.specs = {}
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+            shared[...] = arr
+            self.blocks[name] = shm
+            self.arrays[name] = shared
+            self.specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        self.arrays.clear()
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks.clear()
+
+
+def _attach(specs):
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return blocks, arrays
+
+
+def _layout_clade(task):
+    """Lays out the clade [first, last] in place, as a tree on its own
+    (positions start at 0)."""
+    specs, layout_pass, first, last, first_leaf, last_leaf = task
+    blocks, arrays = _attach(specs)
+    try:
+        block = arrays["img_data"][first:last + 1]
+        parent = arrays["parent"][first:last + 1] - first
+        parent[0] = 0
+        end = arrays["end"][first:last + 1] - first
+        topology = get_topology(parent, end, block[:, _blen])
+        if layout_pass == "rect":
+            layout_kernels.update_rect_positions(block, topology)
+        elif layout_pass == "radius":
+            layout_kernels.update_node_radius(block, topology, 0.0)
+        elif layout_pass == "angles":
+            apertures = arrays["leaf_apertures"][first_leaf:last_leaf + 1]
+            layout_kernels.update_node_angles(block, topology, apertures, 0.0)
+        del block
+    finally:
+        arrays.clear()
+        for shm in blocks:
+            shm.close()
+
+
+class ParallelKernels(object):
+    """Layout kernels over a pool of worker processes (started and closed
+    for every layout pass that splits the tree)."""
+    def __init__(self, workers):
+        self.workers = workers
+
+    def _split(self, topology):
+        """Returns the clades for workers, or None if the tree is not worth
+        splitting."""
+        nnodes = len(topology.parent)
+        max_nodes = max(MIN_CLADE_NODES, nnodes // (self.workers * 4))
+        clades, backbone = split_clades(topology, max_nodes)
+        sizes = topology.end[clades] - clades + 1
+        large = sizes >= MIN_CLADE_NODES
+        if sizes[large].sum() < nnodes * MIN_PARALLEL_FRACTION:
+            return None
+        return clades, backbone, large
+
+    def _run(self, img_data, topology, layout_pass, clades, large, **arrays):
+        """Lays out every clade (the large ones in the pool) and copies the
+        results back into img_data."""
+        # index of the first leaf under each node
+        leaf_index = np.cumsum(topology.is_leaf) - topology.is_leaf
+        shared = SharedArrays(img_data=img_data, parent=topology.parent,
+                              end=topology.end, **arrays)
+        try:
+            tasks = [(shared.specs, layout_pass, int(c), int(topology.end[c]),
+                      int(leaf_index[c]), int(leaf_index[topology.end[c]]))
+                     for c in clades]
+            large_tasks = [t for t, is_large in zip(tasks, large) if is_large]
+            pool = multiprocessing.get_context("fork").Pool(
+                min(self.workers, len(large_tasks)))
+            try:
+                jobs = pool.map_async(_layout_clade, large_tasks)
+                for task, is_large in zip(tasks, large):
+                    if not is_large:
+                        _layout_clade(task)
+                jobs.get()
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+            img_data[...] = shared["img_data"]
+        finally:
+            shared.close()
+
+    def update_rect_positions(self, img_data, topology):
+        split = self._split(topology)
+        if split is None:
+            return layout_kernels.update_rect_positions(img_data, topology)
+        clades, backbone, large = split
+        self._run(img_data, topology, "rect", clades, large)
+
+        # clades are shifted right by the x end of their parent, and down by
+        # the height of all the leaves before them
+        parent = topology.parent
+        xend = {}
+        for nid in backbone:
+            xend[nid] = (xend[parent[nid]] if nid else 0.0) + img_data[nid, _blen]
+        leaves = topology.is_leaf
+        dim = img_data[leaves].astype(np.float64)
+        heights = np.zeros(len(img_data))
+        heights[leaves] = dim[:, _nht] + dim[:, _nhb] + dim[:, _bh]
+        ystart = np.cumsum(heights) - heights
+        for c in clades:
+            rows = img_data[c:topology.end[c] + 1]
+            rows[:, _xend] += xend[parent[c]] if c else 0.0
+            rows[:, [_ystart, _ycenter, _yend]] += ystart[c]
+
+        for nid in backbone:
+            img_data[nid, _xend] = xend[nid]
+        self._stitch_backbone(img_data, topology, backbone, _ystart, _yend, _ycenter)
+        for nid in backbone[::-1]:
+            children = self._children(topology, nid)
+            img_data[nid, _fnw] = img_data[children, _fnw].max() + img_data[nid, _blen]
+
+    def update_node_radius(self, img_data, topology, root_opening):
+        split = self._split(topology)
+        if split is None:
+            return layout_kernels.update_node_radius(img_data, topology, root_opening)
+        clades, backbone, large = split
+        self._run(img_data, topology, "radius", clades, large)
+
+        # clades are shifted out by the radius of their parent
+        parent = topology.parent
+        rad = {}
+        for nid in backbone:
+            rad[nid] = (rad[parent[nid]] if nid else root_opening) + img_data[nid, _blen]
+        for c in clades:
+            rows = img_data[c:topology.end[c] + 1]
+            rows[:, [_rad, _fnw]] += rad[parent[c]] if c else root_opening
+
+        for nid in backbone[::-1]:
+            img_data[nid, _rad] = rad[nid]
+            img_data[nid, _nht] = img_data[nid, _bh] / 2.0
+            img_data[nid, _nhb] = img_data[nid, _bh] / 2.0
+            img_data[nid, _fnw] = img_data[self._children(topology, nid), _fnw].max()
+        return max(0.0, float(img_data[:, _rad].max()))
+
+    def update_node_angles(self, img_data, topology, leaf_apertures, arc_start):
+        split = self._split(topology)
+        if split is None:
+            return layout_kernels.update_node_angles(img_data, topology, leaf_apertures,
+                                                     arc_start)
+        clades, backbone, large = split
+        steps = np.maximum(np.asarray(leaf_apertures, dtype=np.float64), 0.0)
+        self._run(img_data, topology, "angles", clades, large, leaf_apertures=steps)
+
+        # clades are rotated by the aperture of all the leaves before them
+        leaf_start = math.radians(arc_start) + np.cumsum(steps) - steps
+        leaf_index = np.cumsum(topology.is_leaf) - topology.is_leaf
+        for c in clades:
+            rows = img_data[c:topology.end[c] + 1]
+            rows[:, [_astart, _acenter, _aend]] += leaf_start[leaf_index[c]]
+        self._stitch_backbone(img_data, topology, backbone, _astart, _aend, _acenter)
+
+    def get_optimal_circular_scale(self, img_data, topology, optimization_level="med",
+                                   root_opening_factor=0.0):
+        return layout_kernels.get_optimal_circular_scale(img_data, topology,
+                                                         optimization_level,
+                                                         root_opening_factor)
+
+    @staticmethod
+    def _children(topology, nid):
+        return topology.child_ids[topology.child_ptr[nid]:topology.child_ptr[nid + 1]]
+
+    def _stitch_backbone(self, img_data, topology, backbone, col_start, col_end, col_center):
+        """Spans backbone nodes over their children, deepest first."""
+        for nid in backbone[::-1]:
+            children = self._children(topology, nid)
+            first, last = img_data[children[0]], img_data[children[-1]]
+            img_data[nid, col_start] = first[col_start]
+            img_data[nid, col_end] = last[col_end]
+            img_data[nid, col_center] = (first[col_center] +
+                                         (last[col_center] - first[col_center]) / 2.0)
+            img_data[nid, _fnh] = img_data[nid, col_end] - img_data[nid, col_start]
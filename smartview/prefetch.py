@@ -0,0 +1,93 @@
+""" Prefetching of the scene regions likely to be requested next.
+
+After a request for a scene rect, the next one is usually the same rect zoomed
+in or out by the factors of the keys of the web client (ZOOM_FACTORS, around
+its center), or panned by a part of its size. The regions of those candidates
+that are not in the RegionCache yet are computed while the server has nothing
+else to do, and kept there. Prefetching stops as soon as a new request arrives,
+and only uses a fraction (the budget) of the time of one core: after working
+for some time, it rests long enough to keep within it.
+"""
+import threading
+import time
+
+from . import geometry
+
+ZOOM_FACTORS = (1.2, 0.8)
+PAN_FRACTION = 0.5
+
+
+def get_candidates(zoom, x, y, w, h):
+    """Scene requests (zoom, x, y, w, h) likely to follow the given one,
+    the most likely first."""
+    cx, cy = x + w / 2, y + h / 2
+    candidates = [(zoom * f, cx * f - w / 2, cy * f - h / 2, w, h) for f in ZOOM_FACTORS]
+    for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+        candidates.append((zoom, x + dx * w * PAN_FRACTION, y + dy * h * PAN_FRACTION, w, h))
+    return candidates
+
+def get_missing_regions(cache, tree_image, tree_id, zoom, x, y, w, h):
+    """Regions of the candidates after the given request that are not in
+    cache."""
+    regions = {}
+    for candidate in get_candidates(zoom, x, y, w, h):
+        region = cache.get_region(tree_image, *candidate, tree_id)
+        if region not in cache and region.key not in regions:
+            regions[region.key] = region
+    return list(regions.values())
+
+def get_rest(work_time, budget):
+    """Time to rest after working for work_time, to use only a fraction
+    budget of the time."""
+    return work_time * (1 - budget) / budget
+
+
+class Prefetcher(object):
+    """Prefetches regions into a RegionCache in a thread, for the servers
+    that answer one request at a time. Call cancel() when a request arrives,
+    and prefetch() when it is answered."""
+    def __init__(self, cache, budget=0.5):
+        self.cache = cache
+        self.budget = budget
+        self.job = None
+        self.generation = 0  # changes with every request
+        self.prefetched = 0
+        self.cancelled = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.job = None
+            self.condition.notify()
+
+    def prefetch(self, tree_image, tree_id, zoom, x, y, w, h):
+        with self.condition:
+            self.generation += 1
+            self.job = (self.generation, tree_image, tree_id, zoom, x, y, w, h)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None:
+                    self.condition.wait()
+                job, self.job = self.job, None
+            generation, tree_image, tree_id = job[:3]
+            regions = get_missing_regions(self.cache, tree_image, tree_id, *job[3:])
+            for region in regions:
+                if generation != self.generation:
+                    self.cancelled += 1
+                    break
+                t0 = time.time()
+                scene = geometry.get_scene_geometry(tree_image, *region[1:])
+                self.cache.put(region, scene)
+                self.prefetched += 1
+                with self.condition:  # resting, unless a request arrives
+                    self.condition.wait_for(lambda: generation != self.generation,
+                                            get_rest(time.time() - t0, self.budget))
+
+    def stats(self):
+        return {"prefetched": self.prefetched, "prefetch_cancelled": self.cancelled}
@@ -0,0 +1,85 @@
+""" Pre-forked web server.
+
+The server process loads the trees (their layout and scene indexes) and then
+forks the workers, which inherit all of it copy-on-write and accept connections
+from the same listening socket, so requests go to whichever worker is idle.
+
+Rendering only reads the shared arrays. What changes with the requests (the
+cache of scene regions, and the faces made for PNG tiles) is created by each
+worker after the fork, and the objects of the server process are frozen out of
+the garbage collector (gc.freeze) so that collections in the workers don't
+write to the shared pages either.
+
+Trees of a TreeRegistry that are not loaded before the fork are loaded by every
+worker that needs them.
+"""
+import gc
+import os
+import signal
+from wsgiref.simple_server import make_server
+
+from . import server, tiles, tree_registry
+
+import logging
+logger = logging.getLogger("smartview")
+
+
+def warm_up(tree_image):
+    """Computes the data that tree_image builds on the first request (style
+    palettes...), for the workers to share it."""
+    server.render_scene_region(tree_image, tiles.get_tile_zoom(tree_image, 0),
+                               0, 0, tiles.TILE_SIZE, tiles.TILE_SIZE, "bin")
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+def _serve(httpd, registry, cache_mb, tree_id, tiles_dir, prefetch_budget):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for tid in registry.ids():
+        if registry.is_loaded(tid):
+            registry.get(tid).reset_faces()
+    httpd.set_app(server.get_app(registry, cache_mb, tree_id, tiles_dir, prefetch_budget))
+    httpd.serve_forever()
+
+
+def start_prefork_server(trees, host="localhost", port=8090, workers=2, cache_mb=128,
+                         tree_id="tree", tiles_dir=None, prefetch_budget=0):
+    """Serves trees (a TreeImage or a TreeRegistry, see server.get_app)
+    from worker processes, restarting the ones that exit."""
+    registry = tree_registry.as_registry(trees, tree_id)
+    for tid in registry.ids():
+        if registry.is_loaded(tid):
+            warm_up(registry.get(tid))
+
+    httpd = make_server(host, port, None)
+    gc.freeze()
+
+    pids = set()
+    def fork_worker():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve(httpd, registry, cache_mb, tree_id, tiles_dir, prefetch_budget)
+            finally:
+                os._exit(0)
+        pids.add(pid)
+
+    signal.signal(signal.SIGTERM, _stop)
+    logger.info("Serving on http://%s:%d with %d workers" % (host, port, workers))
+    try:
+        for _ in range(max(1, workers)):
+            fork_worker()
+        while True:
+            pid, status = os.wait()
+            pids.discard(pid)
+            logger.warning("Worker %d exited with status %d, restarting it" % (pid, status))
+            fork_worker()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        httpd.server_close()
@@ -0,0 +1,120 @@
+""" Cache of scene regions for the web servers.
+
+Requests are rounded up to cacheable regions: zoom is snapped down to one of
+ZOOM_STEPS levels per doubling, and the requested rect (at that zoom) is
+widened to the grid of TILE_SIZE pixels. The SceneGeometry of such a region is
+computed once and kept in a LRU cache with a memory budget, so that repeated or
+nearby views (the same tree opened by several users, or panning back and
+forth) are served from memory.
+
+Transformed scene coordinates are proportional to zoom (in circular mode too,
+as the tree center is scaled with the rest), so a region computed at the
+snapped zoom is rescaled to the requested one. Only the zoom at which nodes
+are collapsed can differ, by less than a zoom step.
+"""
+import hashlib
+import math
+import threading
+from collections import namedtuple
+
+from .utils import LRUCache
+from . import geometry
+
+ZOOM_STEPS = 8
+TILE_SIZE = 512
+
+# columns with coordinates (scaled with zoom) of each SceneGeometry array
+SCALED_COLUMNS = {"hz_lines": 4, "vt_lines": 4, "arcs": 3, "rects": 4, "anchors": 2,
+                  "bounds": 4}
+
+Region = namedtuple("Region", "key zoom x y w h")
+
+
+def get_scene_bytes(scene):
+    return sum(arr.nbytes for arr in scene)
+
+def rescale_scene(scene, factor):
+    """Returns the SceneGeometry with its coordinates multiplied by factor."""
+    if factor == 1:
+        return scene
+    arrays = {}
+    for name, ncols in SCALED_COLUMNS.items():
+        arr = getattr(scene, name).copy()
+        arr[:, :ncols] *= factor
+        arrays[name] = arr
+    return scene._replace(**arrays)
+
+def get_scene_delta(tree_image, qzoom, zoom, x, y, w, h, known):
+    """geometry.get_scene_delta() computed at qzoom (the zoom of the cached
+    regions, so that nodes are collapsed as in them) and rescaled to zoom.
+    Deltas depend on what each client has, and are not cached."""
+    factor = qzoom / zoom
+    scene = geometry.get_scene_delta(tree_image, qzoom, x * factor, y * factor,
+                                     w * factor, h * factor, [v * factor for v in known])
+    return rescale_scene(scene, 1 / factor)
+
+def get_version(tree_image):
+    """Changes every time the scene or the node styles of tree_image change."""
+    return (tree_image.scene_version, tree_image.tree_data.style_version)
+
+
+class RegionCache(object):
+    """SceneGeometry of the regions of one or more trees (told apart by
+    tree_id) within max_mb of memory. It can be shared by threads."""
+    def __init__(self, max_mb=128):
+        self.scenes = LRUCache(max_mb * 2**20, sizeof=get_scene_bytes)
+        self.lock = threading.Lock()
+        self.not_modified = 0
+
+    def get_region(self, tree_image, zoom, x, y, w, h, tree_id=0):
+        """Region (with its cache key) covering the scene rect (x, y, w, h)
+        at zoom."""
+        zoom = max(0.00001, zoom)
+        level = math.floor(math.log2(zoom) * ZOOM_STEPS)
+        qzoom = 2.0 ** (level / ZOOM_STEPS)
+        factor = qzoom / zoom
+        x0 = math.floor(x * factor / TILE_SIZE)
+        y0 = math.floor(y * factor / TILE_SIZE)
+        x1 = math.ceil((x + w) * factor / TILE_SIZE)
+        y1 = math.ceil((y + h) * factor / TILE_SIZE)
+        key = (tree_id, get_version(tree_image), level, x0, y0, x1, y1)
+        return Region(key, qzoom, x0 * TILE_SIZE, y0 * TILE_SIZE,
+                      (x1 - x0) * TILE_SIZE, (y1 - y0) * TILE_SIZE)
+
+    def get_etag(self, region, *request):
+        """ETag of the response to a request (zoom, scene rect, format...)
+        served from region."""
+        return '"%s"' % hashlib.md5(repr((region.key,) + request).encode()).hexdigest()
+
+    def get(self, region, zoom):
+        """Cached SceneGeometry of region rescaled to zoom, or None."""
+        with self.lock:
+            scene = self.scenes.get(region.key)
+        if scene is None:
+            return None
+        return rescale_scene(scene, zoom / region.zoom)
+
+    def __contains__(self, region):
+        with self.lock:
+            return region.key in self.scenes
+
+    def put(self, region, scene):
+        with self.lock:
+            self.scenes.put(region.key, scene)
+
+    def get_scene(self, tree_image, zoom, x, y, w, h, tree_id=0):
+        """SceneGeometry of a region that covers the scene rect (x, y, w, h),
+        at zoom."""
+        zoom = max(0.00001, zoom)
+        region = self.get_region(tree_image, zoom, x, y, w, h, tree_id)
+        scene = self.get(region, zoom)
+        if scene is None:
+            scene = geometry.get_scene_geometry(tree_image, *region[1:])
+            self.put(region, scene)
+            scene = rescale_scene(scene, zoom / region.zoom)
+        return scene
+
+    def stats(self):
+        return {"hits": self.scenes.hits, "misses": self.scenes.misses,
+                "not_modified": self.not_modified, "regions": len(self.scenes),
+                "bytes": self.scenes.size, "max_bytes": self.scenes.maxsize}
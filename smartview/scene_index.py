@@ -0,0 +1,264 @@
+""" Precomputed indexes used to find the nodes drawn in a scene region.
+
+They are rebuilt by TreeImage.update_scene_index() every time the layout
+changes, so drawers only deal with arrays at render time.
+"""
+import math
+
+import numpy as np
+
+from .common import *
+from . import collision
+
+# Internal nodes are drawn collapsed when their full height (or width, in
+# rect mode) falls below these sizes (in pixels)
+COLLAPSE_RESOLUTION = 5
+W_COLLAPSE_RESOLUTION = 5
+# min pixels between the branches of the children of an expanded node
+CHILD_RESOLUTION = 3
+
+
+def get_expand_zoom(img_data, topology, mode):
+    """Returns the min zoom factor at which every node is drawn expanded (0
+    for leaves, inf for nodes never expanded)."""
+    dim = img_data.astype(np.float64)
+    nchildren = np.diff(topology.child_ptr)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if mode == "c":
+            height = 2 * np.sin(dim[:, _fnh] / 2.0) * dim[:, _fnw]
+            height_up = np.sin(dim[:, _acenter] - dim[:, _astart]) * dim[:, _fnw]
+            height_down = np.sin(dim[:, _aend] - dim[:, _acenter]) * dim[:, _fnw]
+            zoom = np.fmax(COLLAPSE_RESOLUTION / height_up,
+                           COLLAPSE_RESOLUTION / height_down)
+        else:
+            height = dim[:, _fnh]
+            zoom = np.fmax(2 * COLLAPSE_RESOLUTION / height,
+                           W_COLLAPSE_RESOLUTION / dim[:, _fnw])
+        zoom = np.fmax(zoom, CHILD_RESOLUTION * (nchildren + 1) / height)
+
+    zoom[~(zoom >= 0)] = np.inf
+    if mode == "c":
+        # nodes spanning half a circle have room at any zoom
+        zoom[dim[:, _fnh] >= R180] = 0.0
+    zoom[topology.is_leaf] = 0.0
+    return zoom
+
+
+class ZoomIndex(object):
+    """Expand zoom factors of all nodes.
+
+    A node is visited (drawn, either expanded or collapsed) at zoom z if all
+    its ancestors are expanded, that is, if visit_zoom[node] <= z. Nodes are
+    kept sorted by visit_zoom, so the visited nodes at any zoom are a prefix
+    of that order.
+    """
+    def __init__(self, img_data, topology, mode, collapsed=()):
+        self.topology = topology
+        self.expand_zoom = get_expand_zoom(img_data, topology, mode)
+        # nodes collapsed by the user are never expanded
+        collapsed = np.fromiter(collapsed, dtype=np.int64)
+        self.expand_zoom[collapsed[~topology.is_leaf[collapsed]]] = np.inf
+
+        # max expand zoom of all the ancestors of each node
+        visit_zoom = np.zeros(len(img_data))
+        for level in topology.levels[1:]:
+            up = topology.parent[level]
+            visit_zoom[level] = np.fmax(visit_zoom[up], self.expand_zoom[up])
+        self.visit_zoom = visit_zoom
+
+        self.order = np.argsort(visit_zoom, kind="stable")
+        self.sorted_zoom = visit_zoom[self.order]
+
+    def is_collapsed(self, nid, zoom):
+        return zoom < self.expand_zoom[nid]
+
+    def visited(self, zoom):
+        """Preorder ids of the nodes visited at zoom."""
+        nvisited = np.searchsorted(self.sorted_zoom, zoom, side="right")
+        return np.sort(self.order[:nvisited])
+
+    def terminal(self, zoom):
+        """Preorder ids of the leaves and collapsed nodes visited at zoom."""
+        nodes = self.visited(zoom)
+        return nodes[self.topology.is_leaf[nodes] | (self.expand_zoom[nodes] > zoom)]
+
+    def visited_in(self, zoom, ranges, radial=None):
+        """Preorder ids of the nodes visited at zoom whose subtree overlaps any
+        of the given preorder ranges [(first, last), ...] (sorted and
+        disjoint).
+
+        Only the ancestors of each range and the range itself are walked, and
+        collapsed subtrees are jumped over, so the cost does not depend on the
+        size of the tree. If radial=(inner, outer, rmin, rmax) is given,
+        subtrees whose [inner, outer] radii fall out of [rmin, rmax] are
+        skipped too.
+        """
+        end = self.topology.end
+        is_leaf = self.topology.is_leaf
+        expand_zoom = self.expand_zoom
+        if radial is not None:
+            inner, outer, rmin, rmax = radial
+            outside = lambda nid: outer[nid] < rmin or inner[nid] > rmax
+        else:
+            outside = lambda nid: False
+
+        nodes = []
+        for first, last in ranges:
+            nxt = first + 1
+            for nid in self.ancestors(first):
+                if outside(nid):
+                    nxt = end[nid] + 1
+                    break
+                # ancestors shared with a previous range are already there
+                if not nodes or nid > nodes[-1]:
+                    nodes.append(nid)
+                if not is_leaf[nid] and zoom < expand_zoom[nid]:
+                    nxt = end[nid] + 1
+                    break
+            while nxt <= last:
+                if outside(nxt):
+                    nxt = end[nxt] + 1
+                    continue
+                nodes.append(nxt)
+                if is_leaf[nxt] or zoom < expand_zoom[nxt]:
+                    nxt = end[nxt] + 1
+                else:
+                    nxt += 1
+        return np.array(nodes, dtype=np.int64)
+
+    def visited_ancestors(self, zoom, nid):
+        """Path from the root to nid, up to the first node collapsed at zoom."""
+        path = self.ancestors(nid)
+        collapsed = (self.expand_zoom[path] > zoom) & ~self.topology.is_leaf[path]
+        if collapsed.any():
+            path = path[:np.argmax(collapsed) + 1]
+        return np.array(path, dtype=np.int64)
+
+    def hit(self, zoom, leaf, inside):
+        """Returns the first node visited at zoom among the ancestors of leaf,
+        for which the inside(nodes) mask is True, or None."""
+        path = self.visited_ancestors(zoom, leaf)
+        mask = inside(path)
+        return int(path[np.argmax(mask)]) if mask.any() else None
+
+    def ancestors(self, nid):
+        """Path from the root to nid (both included)."""
+        parent = self.topology.parent
+        path = [nid]
+        while nid:
+            nid = parent[nid]
+            path.append(nid)
+        return path[::-1]
+
+
+class RectIndex(object):
+    """Leaves in rect mode are sorted by their y extent, so any y range of the
+    scene maps to a single preorder range of leaves.
+
+    All coordinates are in the untransformed scene (zoom 1).
+    """
+    def __init__(self, img_data, topology, root_opening=0.0):
+        self.img_data = img_data
+        self.root_opening = root_opening
+        self.leaves = np.flatnonzero(topology.is_leaf)
+        self.ystart = img_data[self.leaves, _ystart].astype(np.float64)
+        self.yend = img_data[self.leaves, _yend].astype(np.float64)
+
+    def visible(self, zoom_index, zoom, x0, y0, x1, y1):
+        """Preorder ids of the nodes visited at zoom in the scene rect."""
+        return zoom_index.visited_in(zoom, self.leaf_ranges(x0, y0, x1, y1))
+
+    def node_at(self, zoom_index, zoom, x, y):
+        """Id of the node whose branch contains the scene point, or None."""
+        i = np.searchsorted(self.ystart, y, side="right") - 1
+        if i < 0 or y > self.yend[i]:
+            return None
+        inside = lambda nodes: collision.boxes_contain(
+            collision.rect_boxes(self.img_data, nodes, self.root_opening), x, y)
+        return zoom_index.hit(zoom, int(self.leaves[i]), inside)
+
+    def leaf_ranges(self, x0, y0, x1, y1):
+        """Preorder ranges [(first leaf, last leaf)] overlapping the
+        (untransformed) scene rect."""
+        first = np.searchsorted(self.yend, y0, side="right")
+        last = np.searchsorted(self.ystart, y1, side="left") - 1
+        if first > last:
+            return []
+        return [(int(self.leaves[first]), int(self.leaves[last]))]
+
+
+class PolarIndex(object):
+    """Leaves in circular mode are sorted by angle, so any angular interval of
+    the scene maps to one preorder range of leaves (or two, if it crosses the
+    start of the tree arc). Radii are used to skip whole subtrees.
+
+    Coordinates are in the untransformed scene, relative to the tree center.
+    Angles grow clockwise (y axis points down), as in the layout.
+    """
+    def __init__(self, img_data, topology, root_opening=0.0):
+        self.img_data = img_data
+        self.root_opening = root_opening
+        self.leaves = np.flatnonzero(topology.is_leaf)
+        self.astart = img_data[self.leaves, _astart].astype(np.float64)
+        self.aend = img_data[self.leaves, _aend].astype(np.float64)
+        self.arc_start = float(img_data[0, _astart])
+
+        # radius where each node starts and where its subtree ends
+        self.inner = img_data[topology.parent, _rad].astype(np.float64)
+        self.inner[0] = root_opening
+        self.outer = img_data[:, _fnw].astype(np.float64)
+
+    def to_tree_angle(self, angle):
+        """Maps any angle to the [arc_start, arc_start + 2pi) range."""
+        return self.arc_start + (angle - self.arc_start) % R360
+
+    def polar_ranges(self, x0, y0, x1, y1):
+        """Returns the angular interval (None if the rect contains the center)
+        and the min and max radius covered by a rect."""
+        xs = np.array([x0, x1, x1, x0])
+        ys = np.array([y0, y0, y1, y1])
+        rmax = np.hypot(xs, ys).max()
+        if x0 <= 0 <= x1 and y0 <= 0 <= y1:
+            return None, 0.0, rmax
+        rmin = math.hypot(min(max(0.0, x0), x1), min(max(0.0, y0), y1))
+        # corners are less than half a circle away from the rect center
+        center = math.atan2((y0 + y1) / 2.0, (x0 + x1) / 2.0)
+        offsets = (np.arctan2(ys, xs) - center + R180) % R360 - R180
+        start = self.to_tree_angle(center + offsets.min())
+        return (start, start + offsets.max() - offsets.min()), rmin, rmax
+
+    def leaf_ranges(self, x0, y0, x1, y1):
+        """Preorder ranges [(first leaf, last leaf)] overlapping the scene
+        rect."""
+        interval = self.polar_ranges(x0, y0, x1, y1)[0]
+        if interval is None:
+            return [(int(self.leaves[0]), int(self.leaves[-1]))]
+        a0, a1 = interval
+        if a1 > self.arc_start + R360:
+            intervals = [(self.arc_start, a1 - R360), (a0, self.arc_start + R360)]
+        else:
+            intervals = [(a0, a1)]
+
+        ranges = []
+        for a0, a1 in intervals:
+            first = np.searchsorted(self.aend, a0, side="right")
+            last = np.searchsorted(self.astart, a1, side="left") - 1
+            if first <= last:
+                ranges.append((int(self.leaves[first]), int(self.leaves[last])))
+        return ranges
+
+    def visible(self, zoom_index, zoom, x0, y0, x1, y1):
+        """Preorder ids of the nodes visited at zoom in the scene rect."""
+        _, rmin, rmax = self.polar_ranges(x0, y0, x1, y1)
+        return zoom_index.visited_in(zoom, self.leaf_ranges(x0, y0, x1, y1),
+                                     radial=(self.inner, self.outer, rmin, rmax))
+
+    def node_at(self, zoom_index, zoom, x, y):
+        """Id of the node whose branch contains the scene point, or None."""
+        angle = self.to_tree_angle(math.atan2(y, x))
+        i = np.searchsorted(self.astart, angle, side="right") - 1
+        if i < 0 or angle > self.aend[i]:
+            return None
+        inside = lambda nodes: collision.sectors_contain(
+            collision.sectors(self.img_data, nodes, self.root_opening), x, y)
+        return zoom_index.hit(zoom, int(self.leaves[i]), inside)
@@ -0,0 +1,222 @@
+""" Web server for the PIXI client (pixigui/).
+
+Scene regions are computed by the geometry module, so neither the server nor
+its requests need Qt.
+
+Every scene region sent comes with a region id (the zoom, the rect and the
+version of the tree). When the viewport changes at the same zoom (panning),
+clients can send the id of the region they have (?known=<region id>) to get
+only the primitives of the nodes that were not in it ("delta": true). The
+"bounds" of each response (the box around the nodes in it) and its "region"
+(the rect the client has all the nodes of, with it) tell which responses
+can be dropped: the ones with bounds out of the region of the last one.
+"""
+import json
+import os
+import time
+
+import bottle
+
+from . import geometry, wire, region_cache, tiles, tree_registry, prefetch
+
+import logging
+logger = logging.getLogger("smartview")
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'PUT, GET, POST, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token',
+}
+
+# files of the web client, served at /static/ (wherever the server runs from)
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "pixigui")
+
+
+def get_style_colors(tree_image, attr):
+    """Color (as given in NodeStyle) of attribute attr of every style id."""
+    return tree_image.tree_data.styles.palette(attr).tolist()
+
+def get_scene_items(tree_image, scene):
+    """Items of a SceneGeometry as sent to the client: ["l", x0, y0, x1, y1,
+    color], ["a", cx, cy, radius, start angle, end angle, color],
+    ["r", x, y, w, h] and text anchors ["t", x, y, angle, node id]."""
+    hz_colors = get_style_colors(tree_image, "hz_line_color")
+    vt_colors = get_style_colors(tree_image, "vt_line_color")
+    items = []
+    for lines, styles, colors in [(scene.vt_lines, scene.vt_styles, vt_colors),
+                                  (scene.hz_lines, scene.hz_styles, hz_colors)]:
+        items.extend(["l"] + line + [colors[sid]]
+                     for line, sid in zip(lines.tolist(), styles.tolist()))
+    items.extend(["a"] + arc + [vt_colors[sid]]
+                 for arc, sid in zip(scene.arcs.tolist(), scene.arc_styles.tolist()))
+    items.extend(["r"] + rect for rect in scene.rects.tolist())
+    items.extend(["t"] + anchor + [nid] for anchor, nid in
+                 zip(scene.anchors.tolist(), scene.anchor_nodes.tolist()))
+    return items
+
+def get_scene_bytes(tree_image, scene, origin, info=None):
+    """SceneGeometry in the binary wire format, with the colors of every
+    style id (and info) in its metadata."""
+    return wire.encode_scene(scene, origin, dict(
+        info or {},
+        hz_colors=get_style_colors(tree_image, "hz_line_color"),
+        vt_colors=get_style_colors(tree_image, "vt_line_color")))
+
+def encode_scene_region(tree_image, scene, origin, fmt="json", info=None):
+    """Returns the content type and body of the response with a
+    SceneGeometry (and info), in JSON or binary ("bin") format."""
+    if fmt == "bin":
+        return 'application/octet-stream', get_scene_bytes(tree_image, scene, origin, info)
+    return 'application/json', json.dumps(dict(info or {},
+                                               items=get_scene_items(tree_image, scene)))
+
+def get_region_id(tree_image, zoom, rect):
+    """Id of the scene rect (x, y, w, h) at zoom of the current version of
+    tree_image."""
+    return ",".join(map(repr, (zoom,) + tuple(rect) + region_cache.get_version(tree_image)))
+
+def get_known_rect(tree_image, zoom, region_id):
+    """Scene rect of the region with region_id (sent by a client that has
+    it), or None if it is not at zoom or not of the current version of
+    tree_image."""
+    try:
+        values = [float(v) for v in region_id.split(',')]
+    except ValueError:
+        return None
+    if (len(values) != 7 or values[0] != zoom or
+            tuple(values[5:]) != region_cache.get_version(tree_image)):
+        return None
+    return values[1:5]
+
+def get_region_info(tree_image, scene, zoom, rect, delta=False):
+    """Region id, rect, bounds (x0, y0, x1, y1 or None) and delta flag of a
+    response with the SceneGeometry of rect at zoom."""
+    return {"region_id": get_region_id(tree_image, zoom, rect), "region": list(rect),
+            "bounds": scene.bounds[0].tolist() if len(scene.bounds) else None,
+            "delta": delta}
+
+def render_scene_region(tree_image, zoom, x, y, w, h, fmt="json", cache=None, tree_id=0,
+                        known=None):
+    """Returns the content type and body of the response to a request for
+    the scene rect (x, y, w, h) at zoom. With a RegionCache, the region
+    around it is taken from (or kept in) the cache. With the rect known of
+    a region the client has, only the nodes not in it are sent."""
+    rect = (x, y, w, h)
+    if known is not None:
+        if cache is None:
+            scene = geometry.get_scene_delta(tree_image, zoom, *rect, known)
+        else:
+            region = cache.get_region(tree_image, zoom, *rect, tree_id)
+            scene = region_cache.get_scene_delta(tree_image, region.zoom, zoom, *rect, known)
+    elif cache is None:
+        scene = geometry.get_scene_geometry(tree_image, zoom, *rect)
+    else:
+        scene = cache.get_scene(tree_image, zoom, *rect, tree_id)
+    info = get_region_info(tree_image, scene, zoom, rect, known is not None)
+    return encode_scene_region(tree_image, scene, (x, y), fmt, info)
+
+
+def get_app(trees, cache_mb=128, tree_id="tree", tiles_dir=None, prefetch_budget=0):
+    """Bottle app serving trees, a TreeImage (with id tree_id) or a
+    TreeRegistry. Requests without a tree id (/get_scene_region/...) go to
+    tree_id. With a prefetch_budget (fraction of a core), the regions likely
+    to be requested next are prefetched into the cache."""
+    app = bottle.Bottle()
+    registry = tree_registry.as_registry(trees, tree_id)
+    cache = region_cache.RegionCache(cache_mb)
+    prefetcher = prefetch.Prefetcher(cache, prefetch_budget) if prefetch_budget > 0 else None
+
+    @app.error(405)
+    def method_not_allowed(res):
+        if bottle.request.method == 'OPTIONS':
+            new_res = bottle.HTTPResponse()
+            new_res.set_header('Access-Control-Allow-Origin', '*')
+            return new_res
+        res.headers['Allow'] += ', OPTIONS'
+        return bottle.request.app.default_error_handler(res)
+
+    @app.hook('after_request')
+    def enable_cors():
+        """
+        You need to add some headers to each request.
+        Don't use the wildcard '*' for Access-Control-Allow-Origin in production.
+        """
+        bottle.response.headers.update(CORS_HEADERS)
+
+    def get_tree_image(tid):
+        if tid not in registry:
+            raise bottle.HTTPError(404, "Unknown tree: %s" % tid)
+        return registry.get(tid)
+
+    @app.get("/trees")
+    def get_trees():
+        return {"trees": registry.ids()}
+
+    @app.get("/get_scene_region/<scene>/", method=['GET', 'OPTIONS'])
+    def get_scene_region(scene):
+        return get_tree_scene_region(str(tree_id), scene)
+
+    @app.get("/trees/<tid>/get_scene_region/<scene>/", method=['GET', 'OPTIONS'])
+    def get_tree_scene_region(tid, scene):
+        """Primitives of a scene region, as JSON items or, with
+        ?format=bin, in the binary format of the wire module."""
+        zoom, x, y, w, h = map(float, scene.split(','))
+        tree_image = get_tree_image(tid)
+        if prefetcher is not None:
+            prefetcher.cancel()
+
+        t1 = time.time()
+        fmt = bottle.request.query.get("format", "json")
+        known_id = bottle.request.query.get("known")
+        known = get_known_rect(tree_image, zoom, known_id) if known_id else None
+        region = cache.get_region(tree_image, zoom, x, y, w, h, tid)
+        etag = cache.get_etag(region, zoom, x, y, w, h, fmt, known)
+        if bottle.request.headers.get('If-None-Match') == etag:
+            cache.not_modified += 1
+            response = bottle.HTTPResponse(status=304, ETag=etag)
+        else:
+            content_type, response = render_scene_region(tree_image, zoom, x, y, w, h, fmt,
+                                                         cache, tid, known)
+            bottle.response.content_type = content_type
+            bottle.response.set_header('ETag', etag)
+            bottle.response.set_header('Cache-Control', 'no-cache')
+            logger.debug("scene region %s of %s: %d bytes, %.3fs",
+                         (zoom, x, y, w, h), tid, len(response), time.time() - t1)
+        if prefetcher is not None:
+            prefetcher.prefetch(tree_image, tid, zoom, x, y, w, h)
+        return response
+
+    @app.get("/tiles/<tid>/<z:int>/<x:int>/<y>")
+    def get_tile(tid, z, x, y):
+        """Tile z/x/y of the tree (y with the format extension: .png or
+        .bin), pre-rendered in tiles_dir or rendered on demand."""
+        y, _, fmt = y.partition('.')
+        tree_image = get_tree_image(tid)  # before tid makes a tile path
+        if fmt not in tiles.FORMATS:
+            return bottle.HTTPError(404)
+        y = int(y)
+        body = tiles.read_tile(tiles_dir, tid, z, x, y, fmt)
+        if body is None:
+            body = tiles.render_tile(tree_image, z, x, y, fmt)
+        bottle.response.content_type = tiles.FORMATS[fmt]
+        return body
+
+    @app.get("/cache_stats")
+    def cache_stats():
+        stats = dict(cache.stats(), trees=registry.stats())
+        if prefetcher is not None:
+            stats.update(prefetcher.stats())
+        return stats
+
+    @app.get("/static/<filepath:path>")
+    def webfile(filepath):
+        return bottle.static_file(filepath, root=STATIC_DIR)
+
+    return app
+
+
+def start_server(trees, host="localhost", port=8090, cache_mb=128,
+                 tree_id="tree", tiles_dir=None, prefetch_budget=0):
+    app = get_app(trees, cache_mb, tree_id, tiles_dir, prefetch_budget)
+    bottle.run(app, host=host, port=port, debug=True, reload=True)
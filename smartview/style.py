@@ -1,5 +1,8 @@
 from collections import namedtuple
 import re
+
+import numpy as np
+
 from .face import Face
 
 from .checkers import *
@@ -101,6 +104,23 @@ class TreeStyle(object):
     :param False force_topology: Convert tree branches to a fixed length, thus allowing to
       observe the topology of tight nodes
 
+    :param None branch_mode: Name of the strategy used to adjust branch
+      lengths (see :mod:`branch_lengths`). If None, branch lengths are
+      drawn as they are.
+
+    :param False optimal_scale: In circular mode, scale branch lengths
+      using the optimal scale (see :attr:`optimal_scale_level` and
+      :attr:`root_opening_factor`).
+
+    :param False deep_zoom: Keep node positions in float64 (see
+      :mod:`frames`), so that single leaves can be zoomed into in very large
+      trees.
+
+    :param 0 layout_workers: Number of processes used to lay out large
+      trees (see :mod:`parallel_layout`). 0 or 1 lays them out in the main
+      process, which is faster unless the tree has millions of nodes and
+      there are that many idle cores.
+
     :param True draw_guiding_lines: Draw guidelines from leaf nodes
       to aligned faces
     
@@ -117,6 +137,10 @@ class TreeStyle(object):
       will be a lot smaller. Note that in most cases, manual setting
       of tree scale will be also necessary.
     
+    :param 64 face_cache_mb: Memory budget (approximate, in MB) for the
+      faces created by layout functions. Faces of the least recently drawn
+      nodes are dropped above it, and created again when needed.
+
     :param True draw_aligned_faces_as_table: Aligned faces will be
       drawn as a table, considering all columns in all node faces.
 
@@ -263,6 +287,21 @@ class TreeStyle(object):
         # observe the topology of tight nodes
         self.force_topology = False
 
+        # Strategy used to adjust branch lengths (see branch_lengths.py)
+        self.branch_mode = None
+
+        # Apply the optimal scale to circular trees
+        self.optimal_scale = False
+
+        # Draw from float64 node positions, for very large trees
+        self.deep_zoom = False
+
+        # Processes used to lay out large trees (0 or 1: no parallel layout)
+        self.layout_workers = 0
+
+        # Memory (in MB) for the faces of drawn nodes
+        self.face_cache_mb = 64
+
         # Draw guidelines from leaf nodes to aligned faces
         self.draw_guiding_lines = True
 
@@ -360,6 +399,39 @@ def add_face_to_node(face, node, column, row=None, position="branch-right"):
         raise ValueError("not a Face instance")
     return face
          
+# Faces added by a batch layout function: faces is a list of Face instances,
+# and the rest are arrays with one item per added face (node id, index in
+# faces, position code, column and row, -1 for no row)
+FaceBatch = namedtuple("FaceBatch", "faces nodes face_ids positions columns rows")
+
+def batch_layout(fn):
+    """Marks fn as a batch layout function, to be used in TreeStyle.layout_fn.
+
+    Instead of being called on every node, fn(nodes, img_data, tree_data) is
+    called once with the array of preorder ids of all the nodes about to be
+    drawn, the img_data matrix of the view (node columns) and its TreeData
+    (see TreeData.get_node_column). It returns a FaceBatch.
+    """
+    fn.batch = True
+    return fn
+
+def face_batch(faces, nodes, face_ids, positions, columns, rows=-1):
+    """Returns a FaceBatch. positions can be given as names (see
+    add_face_to_node) or codes, and any of face_ids, positions, columns and
+    rows as a single value for all the nodes."""
+    nodes = np.asarray(nodes, dtype=np.int64)
+    positions = np.asarray(positions)
+    if positions.dtype.kind in "US":
+        codes = np.full(positions.shape, -1)
+        for name, code in FACEPOS2CODE.items():
+            codes[positions == name] = code
+        if (codes < 0).any():
+            raise ValueError("face position not in %s" %list(FACEPOS2CODE.keys()))
+        positions = codes
+    column = lambda values: np.broadcast_to(np.asarray(values, dtype=np.int64), nodes.shape)
+    return FaceBatch(faces, nodes, column(face_ids), column(positions),
+                     column(columns), column(rows))
+
 class FaceContainer(list):
     def add_face(self, face, row, column):        
         self.__append__([face, row, column, 0, 0])
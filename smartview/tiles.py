@@ -0,0 +1,100 @@
+""" Slippy map style tiles (z/x/y) of a tree scene.
+
+At level z the whole tree fits in 2**z x 2**z tiles of TILE_SIZE pixels (in
+one tile at level 0), and tile (x, y) covers the rect (x * TILE_SIZE,
+y * TILE_SIZE, TILE_SIZE, TILE_SIZE) of the scene at that zoom. Tiles are PNG
+images (drawn by drawer.get_tile_img, which starts a QApplication) or primitives in the
+binary format of the wire module.
+
+The top levels of the pyramid can be rendered in advance to a directory (as
+<tiles_dir>/<tree id>/<z>/<x>/<y>.<format>), where servers look for tiles
+before rendering them.
+"""
+import math
+import multiprocessing
+import os
+
+from . import geometry, server
+
+TILE_SIZE = 256
+
+FORMATS = {"png": "image/png", "bin": "application/octet-stream"}
+
+# tree image of the worker processes (inherited on fork)
+_tree_image = None
+
+
+def get_tile_zoom(tree_image, z):
+    """Zoom factor of level z."""
+    return TILE_SIZE / max(tree_image.width, tree_image.height, 1e-9) * 2 ** z
+
+def get_tile_counts(tree_image, z):
+    """Number of columns and rows of tiles with some part of the tree at
+    level z."""
+    zoom = get_tile_zoom(tree_image, z)
+    return (max(1, math.ceil(tree_image.width * zoom / TILE_SIZE)),
+            max(1, math.ceil(tree_image.height * zoom / TILE_SIZE)))
+
+def render_tile(tree_image, z, x, y, fmt="png"):
+    """Tile (x, y) of level z, as bytes."""
+    zoom = get_tile_zoom(tree_image, z)
+    rect = (x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+    if fmt == "png":
+        from . import drawer, gui
+        gui.start_app(offscreen=True)  # only PNG tiles need Qt
+        return drawer.get_tile_png(tree_image, zoom, rect)
+    scene = geometry.get_scene_geometry(tree_image, zoom, *rect)
+    return server.get_scene_bytes(tree_image, scene, rect[:2])
+
+def get_tile_path(tiles_dir, tree_id, z, x, y, fmt="png"):
+    """Path of a tile in tiles_dir. Raises ValueError for tree ids (or
+    formats) that would lead out of tiles_dir/tree_id."""
+    tree_id = str(tree_id)
+    for name in (tree_id, fmt):
+        if (name in ("", ".", "..") or "/" in name or os.sep in name or
+                (os.altsep and os.altsep in name)):
+            raise ValueError("Invalid name in tile path: %r" % name)
+    return os.path.join(tiles_dir, tree_id, str(int(z)), str(int(x)),
+                        "%d.%s" % (y, fmt))
+
+def read_tile(tiles_dir, tree_id, z, x, y, fmt="png"):
+    """Pre-rendered tile, or None."""
+    if not tiles_dir:
+        return None
+    try:
+        with open(get_tile_path(tiles_dir, tree_id, z, x, y, fmt), "rb") as fh:
+            return fh.read()
+    except (FileNotFoundError, ValueError):  # ValueError: never pre-rendered
+        return None
+
+
+def _init_worker(tree_image):
+    global _tree_image
+    _tree_image = tree_image
+
+def _prerender_column(task):
+    tiles_dir, tree_id, z, x, nrows, fmt = task
+    os.makedirs(os.path.dirname(get_tile_path(tiles_dir, tree_id, z, x, 0, fmt)),
+                exist_ok=True)
+    for y in range(nrows):
+        with open(get_tile_path(tiles_dir, tree_id, z, x, y, fmt), "wb") as fh:
+            fh.write(render_tile(_tree_image, z, x, y, fmt))
+    return nrows
+
+def prerender_tiles(tree_image, tiles_dir, tree_id="tree", levels=4, fmt="png", workers=1):
+    """Renders all the tiles of the top levels of the pyramid to tiles_dir,
+    one column of tiles per task. Returns the number of tiles."""
+    tasks = []
+    for z in range(levels):
+        ncols, nrows = get_tile_counts(tree_image, z)
+        tasks.extend((tiles_dir, tree_id, z, x, nrows, fmt) for x in range(ncols))
+
+    if workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(workers, _init_worker, (tree_image,))
+        try:
+            return sum(pool.map(_prerender_column, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    _init_worker(tree_image)
+    return sum(_prerender_column(task) for task in tasks)
@@ -0,0 +1,123 @@
+""" Catalog of trees served by id.
+
+Trees come from a directory (the id of each tree file is its name without the
+extension) or from a JSON manifest ({"tree id": "path/to/newick", ...}, with
+paths relative to the manifest). Their TreeImage is only built on the first
+request, and the least recently used trees are dropped when the estimated
+memory of all the loaded ones goes over a budget (they are loaded again when
+requested).
+
+The budget is per process: the asynchronous server only loads trees in the
+server process and forks its workers again after that (see async_server), but
+the workers of the pre-forked server load the trees that were not loaded
+before the fork on their own, each within the whole budget (see prefork).
+"""
+import json
+import os
+
+from .utils import LRUCache
+
+TREE_EXTENSIONS = (".nw", ".nwk", ".newick", ".tree", ".tre")
+
+# approximate memory used by every node of a loaded tree (the node objects,
+# img_data, topology and indexes). The faces of each tree (up to
+# TreeStyle.face_cache_mb) and the cache of scene regions of the servers are
+# not included
+NODE_BYTES = 700
+
+
+def get_tree_image_bytes(tree_image):
+    return len(tree_image.img_data) * NODE_BYTES
+
+def find_trees(path):
+    """Tree files (id -> path) in a directory, or listed in a manifest."""
+    if os.path.isdir(path):
+        return {os.path.splitext(name)[0]: os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(TREE_EXTENSIONS)}
+    with open(path) as fh:
+        manifest = json.load(fh)
+    basepath = os.path.dirname(os.path.abspath(path))
+    return {str(tid): os.path.join(basepath, src) for tid, src in manifest.items()}
+
+def as_registry(trees, tree_id="tree"):
+    """trees if it is a TreeRegistry, or a registry with the TreeImage trees
+    as tree_id."""
+    if isinstance(trees, TreeRegistry):
+        return trees
+    registry = TreeRegistry()
+    registry.add(str(tree_id), trees)
+    return registry
+
+
+class TreeRegistry(object):
+    """TreeImages by id, built on demand from their newick files with the
+    TreeStyle returned by get_tree_style(), within max_mb of memory.
+
+    Trees added with add() have no file to be loaded from again, and are
+    never dropped.
+    """
+    def __init__(self, sources=None, get_tree_style=None, max_mb=1024, newick_format=0):
+        self.sources = dict(sources or {})
+        self.get_tree_style = get_tree_style
+        self.newick_format = newick_format
+        self.pinned = {}
+        self.images = LRUCache(max_mb * 2**20, sizeof=get_tree_image_bytes)
+        self.loads = 0
+
+    @classmethod
+    def from_path(cls, path, **kargs):
+        """Registry of the trees in a directory or manifest."""
+        return cls(find_trees(path), **kargs)
+
+    def __contains__(self, tree_id):
+        return tree_id in self.pinned or tree_id in self.sources
+
+    def __len__(self):
+        return len(set(self.pinned) | set(self.sources))
+
+    def ids(self):
+        return sorted(set(self.pinned) | set(self.sources))
+
+    def is_loaded(self, tree_id):
+        return tree_id in self.pinned or tree_id in self.images
+
+    def loaded(self):
+        """Loaded TreeImages by id (without changing which were used last)."""
+        return {**self.images.items, **self.pinned}
+
+    def add(self, tree_id, tree_image):
+        self.pinned[tree_id] = tree_image
+
+    def get(self, tree_id):
+        """TreeImage of the tree, loaded if needed. Raises KeyError for
+        unknown ids."""
+        if tree_id in self.pinned:
+            return self.pinned[tree_id]
+        tree_image = self.images.get(tree_id)
+        if tree_image is None:
+            tree_image = self.load(tree_id)
+            self.put(tree_id, tree_image)
+        return tree_image
+
+    def put(self, tree_id, tree_image):
+        """Keeps tree_image (made by load()), dropping the least recently
+        used trees if needed."""
+        self.images.put(tree_id, tree_image)
+
+    def load(self, tree_id):
+        from .ctree import Tree
+        from .main import TreeImage
+        if self.get_tree_style is None:
+            from .style import TreeStyle
+            tree_style = TreeStyle()
+        else:
+            tree_style = self.get_tree_style()
+        tree = Tree(self.sources[tree_id], format=self.newick_format)
+        self.loads += 1
+        return TreeImage(tree, tree_style)
+
+    def stats(self):
+        return {"trees": len(self), "loaded": len(self.images) + len(self.pinned),
+                "loads": self.loads, "bytes": self.images.size,
+                "max_bytes": self.images.maxsize}
@@ -2,6 +2,7 @@
 
 import re
 import time
+from collections import OrderedDict
 
 import logging
 logger = logging.getLogger("smartview")
@@ -196,3 +197,65 @@ def timeit(f):
 def debug(*args):
     if CONFIG["debug"]:
         print("DEBBUG: " + ' '.join(map(str, args)))
+
+
+class LRUCache(object):
+    """Dict-like cache keeping items up to a total size of maxsize, dropping
+    the least recently used ones first.
+
+    The size of each item is sizeof(value) (1 by default), and
+    on_evict(key, value) is called for every dropped item.
+    """
+    def __init__(self, maxsize, sizeof=None, on_evict=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        value = self.items[key]
+        self.items.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.items:
+            self.size -= self.sizes[key]
+        self.items[key] = value
+        self.items.move_to_end(key)
+        self.sizes[key] = self.sizeof(value) if self.sizeof else 1
+        self.size += self.sizes[key]
+        # the newest item is kept even if it is larger than maxsize
+        while self.size > self.maxsize and len(self.items) > 1:
+            old_key, old_value = self.items.popitem(last=False)
+            self.size -= self.sizes.pop(old_key)
+            if self.on_evict:
+                self.on_evict(old_key, old_value)
+
+    def update(self, items):
+        for key, value in items.items():
+            self.put(key, value)
+
+    def clear(self):
+        self.items.clear()
+        self.sizes.clear()
+        self.size = 0
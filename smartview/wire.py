@@ -0,0 +1,92 @@
+""" Binary wire format of scene regions.
+
+A response is a small header followed by framed sections of typed arrays, all
+little endian and aligned to 4 bytes, so that clients can read them as
+Float32Array / Uint16Array views of the same buffer without copies:
+
+    magic    4 bytes   b"STV1"
+    length   uint32    size of the metadata
+    metadata JSON      (utf-8), padded to 4 bytes
+    sections, each one:
+        kind     4 bytes   section name (see SECTIONS)
+        count    uint32    number of primitives
+        ncols    uint32    float32 values per primitive
+        idsize   uint32    bytes per id (2 for uint16 style ids, 4 for uint32)
+        coords   float32   count * ncols values
+        ids      uint16 or uint32, count values, padded to 4 bytes (style
+                 ids, or node ids for text anchors)
+
+Coordinates are relative to metadata["origin"] (the top left corner of the
+requested scene rect), which keeps float32 precise at any zoom.
+"""
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"STV1"
+
+# section name: (SceneGeometry primitives, style ids, columns offset by the
+# origin as x, y pairs)
+SECTIONS = {
+    b"hzln": ("hz_lines", "hz_styles", 2),
+    b"vtln": ("vt_lines", "vt_styles", 2),
+    b"arcs": ("arcs", "arc_styles", 1),
+    b"rect": ("rects", "rect_styles", 1),
+    b"anch": ("anchors", "anchor_nodes", 1),  # x, y, angle, with node ids
+}
+
+
+def _padding(nbytes):
+    return b"\0" * (-nbytes % 4)
+
+def encode_section(kind, coords, ids):
+    coords = np.ascontiguousarray(coords, dtype="<f4")
+    count, ncols = coords.shape
+    ids = np.asarray(ids)
+    if len(ids) and ids.max() >= 2**16:
+        ids = ids.astype("<u4")
+    else:
+        ids = ids.astype("<u2")
+    id_bytes = ids.tobytes()
+    return b"".join([kind, struct.pack("<III", count, ncols, ids.itemsize),
+                     coords.tobytes(), id_bytes, _padding(len(id_bytes))])
+
+def encode_scene(scene, origin, metadata=None):
+    """Returns the SceneGeometry scene as bytes, with coordinates relative to
+    origin (x, y). metadata (a json-serializable dict) goes in the header."""
+    metadata = dict(metadata or {}, origin=list(map(float, origin)))
+    meta = json.dumps(metadata).encode("utf-8")
+    parts = [MAGIC, struct.pack("<I", len(meta)), meta, _padding(len(meta))]
+    shift = np.array(origin, dtype=np.float64)
+    for kind, (coords_name, ids_name, npairs) in SECTIONS.items():
+        coords = np.array(getattr(scene, coords_name), dtype=np.float64)
+        coords[:, :2 * npairs] -= np.tile(shift, npairs)
+        parts.append(encode_section(kind, coords, getattr(scene, ids_name)))
+    return b"".join(parts)
+
+def decode_scene(data):
+    """Returns the metadata and a dict of sections {kind: (coords, ids)}
+    of an encoded scene, with absolute coordinates (as float64)."""
+    if data[:4] != MAGIC:
+        raise ValueError("not an encoded scene")
+    meta_len, = struct.unpack_from("<I", data, 4)
+    metadata = json.loads(data[8:8 + meta_len].decode("utf-8"))
+    offset = 8 + meta_len + len(_padding(meta_len))
+    origin = np.array(metadata["origin"])
+
+    sections = {}
+    while offset < len(data):
+        kind = data[offset:offset + 4]
+        count, ncols, idsize = struct.unpack_from("<III", data, offset + 4)
+        offset += 16
+        coords = np.frombuffer(data, dtype="<f4", count=count * ncols, offset=offset)
+        coords = coords.reshape(count, ncols).astype(np.float64)
+        offset += count * ncols * 4
+        ids = np.frombuffer(data, dtype="<u%d" % idsize, count=count, offset=offset)
+        offset += count * idsize + len(_padding(count * idsize))
+        if kind in SECTIONS:
+            npairs = SECTIONS[kind][2]
+            coords[:, :2 * npairs] += np.tile(origin, npairs)
+        sections[kind.decode("ascii")] = (coords, ids)
+    return metadata, sections